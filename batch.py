@@ -0,0 +1,267 @@
+"""
+无界面批量运行提示词。
+
+每行一个 JSON：{"id": "q1", "prompt": "...", "model": "gpt-4o", "config": "别名", "system": "..."}，
+只有 prompt(或 messages)是必须的。成功的提示词和回答写入 chat_message 作为一个新对话，
+结果追加到 -o 指定的 JSONL。重新运行时跳过结果文件中已经成功的 id，可以中断后续跑。
+
+python batch.py prompts.jsonl -o results.jsonl --config azure --model gpt-4o --concurrency 8 --rpm 60
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from loguru import logger
+
+import config
+import database
+import log_config
+import metrics
+from tsid import TSID
+
+
+class RateLimiter:
+    """
+    每个端点每分钟最多 rpm 次请求，请求之间至少间隔 60 / rpm 秒。rpm 为 0 时不限制。
+    """
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def prompt_id(item, line_no):
+    """
+    没有 id 时用内容哈希，保证重跑时同一条提示词得到同一个 id。
+
+    >>> prompt_id({'id': 7}, 1)
+    '7'
+    >>> prompt_id({'prompt': 'hi'}, 1) == prompt_id({'prompt': 'hi'}, 2)
+    True
+    """
+    if item.get('id') is not None:
+        return str(item['id'])
+    key = json.dumps([item.get('config'), item.get('model'), item.get('system'), item.get('prompt'),
+                      item.get('messages')], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16]
+
+
+def build_messages(item):
+    """
+    >>> build_messages({'prompt': 'hi'})[1]
+    {'role': 'user', 'content': 'hi'}
+    """
+    if item.get('messages'):
+        return item['messages']
+    return [{"role": "system", "content": item.get('system') or config.SYSTEM_PROMPT},
+            {"role": "user", "content": item['prompt']}]
+
+
+def last_prompt(messages):
+    """
+    只保存最后一条用户消息，system 与界面中的对话一致不入库。
+
+    >>> last_prompt([{'role': 'system', 'content': 's'}, {'role': 'user', 'content': 'a'},
+    ...              {'role': 'assistant', 'content': 'b'}, {'role': 'user', 'content': 'c'}])
+    'c'
+    >>> last_prompt([{'role': 'system', 'content': 's'}]) is None
+    True
+    """
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            return message.get('content') or ''
+    return None
+
+
+def read_prompts(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {'prompt': item}
+            yield prompt_id(item, line_no), item
+
+
+def completed_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # 中断时可能留下半行
+                continue
+            if result.get('status') == 'ok':
+                done.add(result['id'])
+    return done
+
+
+class BatchRunner:
+
+    def __init__(self, db_file, output, configs, default_config, default_model, concurrency=4, rpm=0,
+                 on_progress=None):
+        """
+        on_progress(ok, failed) 在每条结果写出后调用，在工作线程中。
+        """
+        self.db_file = db_file
+        self.output = output
+        self.configs = configs
+        self.default_config = default_config
+        self.default_model = default_model
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.on_progress = on_progress
+        self.clients = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.ok = 0
+        self.failed = 0
+
+    def client(self, name):
+        with self.lock:
+            client = self.clients.get(name)
+            if client is None:
+                client = config.make_client(self.configs[name])
+                self.clients[name] = client
+            return client
+
+    def limiter(self, endpoint):
+        with self.lock:
+            limiter = self.limiters.get(endpoint)
+            if limiter is None:
+                limiter = RateLimiter(self.rpm)
+                self.limiters[endpoint] = limiter
+            return limiter
+
+    def run(self, path):
+        database.init_database(self.db_file)
+        done = completed_ids(self.output)
+        skipped = 0
+        # 限制排队的任务数，提示词文件很大时也不会一次全部读入
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        with open(self.output, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch') as executor:
+            for id_, item in read_prompts(path):
+                if id_ in done:
+                    skipped += 1
+                    continue
+                done.add(id_)
+                slots.acquire()
+                future = executor.submit(self.run_one, id_, item, out)
+                future.add_done_callback(lambda _: slots.release())
+        logger.info(f'batch finished: {self.ok} ok, {self.failed} failed, {skipped} skipped')
+        return self.ok, self.failed, skipped
+
+    def run_one(self, id_, item, out):
+        name = item.get('config') or self.default_config
+        model = item.get('model') or self.default_model
+        gpt_config = self.configs.get(name)
+        endpoint = gpt_config.get('endpoint') if gpt_config else None
+        cid = TSID.create().to_string()
+        request_metrics = metrics.RequestMetrics(cid, model, endpoint)
+        result = {'id': id_, 'cid': cid, 'config': name, 'model': model}
+        try:
+            if gpt_config is None:
+                raise ValueError(f'config not found: {name}')
+            with logger.contextualize(batch_id=id_, cid=cid, model=model):
+                messages = build_messages(item)
+                self.limiter(endpoint).acquire()
+                request_metrics.start = time.perf_counter()
+                completion = self.client(name).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options=metrics.STREAM_OPTIONS
+                )
+                request_metrics.connected()
+                reply = ''
+                for chunk in completion:
+                    if len(chunk.choices) > 0:
+                        chunk_text = chunk.choices[0].delta.content or ''
+                        request_metrics.chunk(chunk_text)
+                        reply += chunk_text
+                        if request_metrics.mid is None:
+                            request_metrics.mid = chunk.id
+                    request_metrics.usage(chunk.usage)
+                request_metrics.finish()
+                if request_metrics.mid is None:
+                    request_metrics.mid = TSID.create().to_string()
+                # 请求成功后问题和回答一起写入，失败的提示词不会留下没有回答的对话
+                self.insert_exchange(cid, last_prompt(messages), request_metrics.mid, reply)
+                request_metrics.insert_to_db(self.db_file)
+                result.update({'status': 'ok', 'mid': request_metrics.mid})
+                result.update(request_metrics.to_dict())
+                result['reply'] = reply
+                logger.opt(lazy=True).debug('回答: {}', lambda: log_config.content(reply))
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            result.update({'status': 'error', 'error': str(e)})
+        self.write_result(out, result)
+
+    def insert_exchange(self, cid, prompt, mid, reply):
+        rows = []
+        if prompt is not None:
+            rows.append((TSID.create().number, cid, TSID.create().to_string(), prompt, 1, datetime.now()))
+        rows.append((TSID.create().number, cid, mid, reply, 0, datetime.now()))
+        conn = sqlite3.connect(self.db_file)
+        try:
+            with conn:
+                conn.executemany(
+                    "insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)", rows)
+        finally:
+            conn.close()
+
+    def write_result(self, out, result):
+        with self.lock:
+            if result['status'] == 'ok':
+                self.ok += 1
+            else:
+                self.failed += 1
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            out.flush()
+            if self.on_progress is not None:
+                self.on_progress(self.ok, self.failed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量运行提示词')
+    parser.add_argument('prompts', help='JSONL, 每行 {"id", "prompt", "model", "config"}')
+    parser.add_argument('-o', '--output', required=True, help='结果 JSONL, 重跑时跳过其中已成功的 id')
+    parser.add_argument('--config', help='默认配置别名, 默认取第一个')
+    parser.add_argument('--model', default='gpt-4o', help='默认模型')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rpm', type=int, default=0, help='每个端点每分钟最多请求数, 0 不限制')
+    parser.add_argument('--db', default=os.path.expanduser('~') + '/chatgpt_local.db')
+    args = parser.parse_args()
+
+    log_config.setup_logging(os.path.expanduser('~'), level='WARNING')
+    configs = config.read_gpt_config()
+    default_config = args.config or next(iter(configs.keys()), None)
+    runner = BatchRunner(args.db, args.output, configs, default_config, args.model, args.concurrency, args.rpm,
+                         on_progress=lambda ok, failed: print(f'\r{ok} ok, {failed} failed', end='', flush=True))
+    try:
+        runner.run(args.prompts)
+    finally:
+        print()
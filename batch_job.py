@@ -0,0 +1,290 @@
+"""
+Batch API 离线任务。
+
+不需要流式返回的大批量请求走服务商的 Batch API(更便宜，限额更高)：把选中的对话或提示词列表
+拼成请求文件上传并提交，后台定时查询状态，完成后流式下载结果，每条结果写入 chat_message 中各自的对话。
+已导入的请求在 batch_request 中标记，导入中断后重新查询只补写剩余的结果。
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple
+
+from loguru import logger
+
+import batch
+import compression
+import config
+from tsid import TSID
+
+BATCH_JOB_SQL = """
+create table if not exists batch_job (
+    ID TEXT PRIMARY KEY NOT NULL,
+    CONFIG TEXT NOT NULL,
+    MODEL TEXT NOT NULL,
+    INPUT_FILE_ID TEXT,
+    OUTPUT_FILE_ID TEXT,
+    ERROR_FILE_ID TEXT,
+    STATUS TEXT NOT NULL,
+    TOTAL INTEGER NOT NULL DEFAULT 0,
+    COMPLETED INTEGER NOT NULL DEFAULT 0,
+    FAILED INTEGER NOT NULL DEFAULT 0,
+    IMPORTED INTEGER NOT NULL DEFAULT 0,
+    CREATETIME DATETIME NOT NULL,
+    UPDATETIME DATETIME NOT NULL
+)
+"""
+
+BATCH_REQUEST_SQL = """
+create table if not exists batch_request (
+    BATCH_ID TEXT NOT NULL,
+    CUSTOM_ID TEXT NOT NULL,
+    CID TEXT NOT NULL,
+    PROMPT TEXT,
+    IMPORTED INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (BATCH_ID, CUSTOM_ID)
+)
+"""
+
+# 不会再变化的状态
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+POLL_INTERVAL_MS = 30 * 1000
+IMPORT_BATCH = 500
+# 定时查询和手动刷新可能同时进行，同一时间只导入一次
+_refresh_lock = threading.Lock()
+
+
+class BatchItem(NamedTuple):
+    # 结果写入的对话；prompt 不为 None 时导入结果前先写入这条提问
+    cid: str
+    prompt: str
+    messages: list
+
+
+class BatchJob(NamedTuple):
+    id: str
+    config: str
+    model: str
+    status: str
+    total: int
+    completed: int
+    failed: int
+    imported: int
+    createtime: str
+
+
+def init_tables(conn):
+    conn.execute(BATCH_JOB_SQL)
+    conn.execute(BATCH_REQUEST_SQL)
+
+
+def request_line(custom_id, model, messages, url='/v1/chat/completions'):
+    """
+    >>> request_line('c1', 'gpt-4o', [{'role': 'user', 'content': 'hi'}])
+    '{"custom_id": "c1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}}'
+    """
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': url,
+                       'body': {'model': model, 'messages': messages}}, ensure_ascii=False)
+
+
+def endpoint_url(gpt_config):
+    # Azure 的批处理请求行不带 /v1 前缀
+    return '/chat/completions' if gpt_config['type'] == 0 else '/v1/chat/completions'
+
+
+def prompt_items(prompts):
+    """
+    提示词列表(batch.py 的 JSONL 格式或纯字符串)，每条一个新对话。
+    """
+    items = []
+    for prompt in prompts:
+        item = {'prompt': prompt} if isinstance(prompt, str) else prompt
+        messages = batch.build_messages(item)
+        text = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+        items.append(BatchItem(TSID.create().to_string(), text, messages))
+    return items
+
+
+def conversation_items(db_file, cids):
+    """
+    选中的对话各作为一个请求(完整的上下文)，结果作为回答追加到原对话。
+    """
+    items = []
+    conn = sqlite3.connect(db_file)
+    try:
+        for cid in cids:
+            messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
+            for content, send in conn.execute(
+                    "select CONTENT, SEND from chat_message where CID = ? order by CREATETIME asc", (cid,)):
+                messages.append({"role": "user" if send == 1 else "assistant",
+                                 "content": compression.decode(db_file, content)})
+            if len(messages) > 1:
+                items.append(BatchItem(cid, None, messages))
+    finally:
+        conn.close()
+    return items
+
+
+def submit(client, db_file, config_name, gpt_config, model, items):
+    """
+    生成请求文件，上传并创建批处理任务，返回任务 ID。
+    """
+    start = time.perf_counter()
+    url = endpoint_url(gpt_config)
+    fd, path = tempfile.mkstemp(prefix='chatgpt_batch_', suffix='.jsonl', dir=os.path.dirname(db_file) or None)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for i, item in enumerate(items):
+                f.write(request_line(f'{item.cid}-{i}', model, item.messages, url) + '\n')
+        with open(path, 'rb') as f:
+            input_file = client.files.create(file=(os.path.basename(path), f), purpose='batch')
+    finally:
+        os.remove(path)
+    job = client.batches.create(input_file_id=input_file.id, endpoint=url, completion_window='24h')
+    now = datetime.now()
+    conn = sqlite3.connect(db_file)
+    try:
+        init_tables(conn)
+        with conn:
+            conn.execute("""
+            insert into batch_job(ID, CONFIG, MODEL, INPUT_FILE_ID, STATUS, TOTAL, CREATETIME, UPDATETIME)
+            values (?,?,?,?,?,?,?,?)
+            """, (job.id, config_name, model, input_file.id, job.status, len(items), now, now))
+            conn.executemany("insert into batch_request(BATCH_ID, CUSTOM_ID, CID, PROMPT) values (?,?,?,?)",
+                             [(job.id, f'{item.cid}-{i}', item.cid, item.prompt) for i, item in enumerate(items)])
+    finally:
+        conn.close()
+    logger.info(f'batch job {job.id} submitted: {len(items)} requests, {config_name}/{model} in '
+                f'{(time.perf_counter() - start) * 1000:.0f} ms')
+    return job.id
+
+
+def list_jobs(db_file, pending_only=False):
+    conn = sqlite3.connect(db_file)
+    try:
+        init_tables(conn)
+        sql = """
+        select ID, CONFIG, MODEL, STATUS, TOTAL, COMPLETED, FAILED, IMPORTED, CREATETIME from batch_job
+        """
+        if pending_only:
+            sql += f" where STATUS not in ({','.join('?' * len(FINAL_STATUSES))}) or (STATUS = 'completed' and " \
+                   f"IMPORTED = 0)"
+        sql += " order by CREATETIME desc"
+        rows = conn.execute(sql, FINAL_STATUSES if pending_only else ()).fetchall()
+        return [BatchJob(*row) for row in rows]
+    finally:
+        conn.close()
+
+
+def refresh(client, db_file, job_id):
+    """
+    查询任务状态并写回；完成且还没导入时导入结果。返回本次导入的条数。
+    """
+    with _refresh_lock:
+        return _refresh(client, db_file, job_id)
+
+
+def _refresh(client, db_file, job_id):
+    job = client.batches.retrieve(job_id)
+    counts = job.request_counts
+    conn = sqlite3.connect(db_file)
+    try:
+        with conn:
+            conn.execute("""
+            update batch_job set STATUS = ?, OUTPUT_FILE_ID = ?, ERROR_FILE_ID = ?, TOTAL = ?, COMPLETED = ?,
+            FAILED = ?, UPDATETIME = ? where ID = ?
+            """, (job.status, job.output_file_id, job.error_file_id, counts.total if counts else 0,
+                  counts.completed if counts else 0, counts.failed if counts else 0, datetime.now(), job_id))
+        imported = conn.execute("select IMPORTED from batch_job where ID = ?", (job_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    if job.status != 'completed' or imported:
+        return 0
+    count = 0
+    if job.output_file_id:
+        count = import_results(client, db_file, job_id, job.output_file_id)
+    if job.error_file_id:
+        log_errors(client, job.error_file_id)
+    conn = sqlite3.connect(db_file)
+    try:
+        with conn:
+            conn.execute("update batch_job set IMPORTED = 1, UPDATETIME = ? where ID = ?", (datetime.now(), job_id))
+    finally:
+        conn.close()
+    return count
+
+
+def import_results(client, db_file, job_id, file_id):
+    """
+    流式读取结果文件，每 IMPORT_BATCH 行一个事务写入 chat_message。
+    """
+    start = time.perf_counter()
+    count = 0
+    conn = sqlite3.connect(db_file)
+    try:
+        requests = {custom_id: (cid, prompt) for custom_id, cid, prompt in conn.execute(
+            "select CUSTOM_ID, CID, PROMPT from batch_request where BATCH_ID = ? and IMPORTED = 0", (job_id,))}
+        pending = []
+        with client.files.with_streaming_response.content(file_id) as response:
+            for line in response.iter_lines():
+                if line.strip() == '':
+                    continue
+                result = json.loads(line)
+                request = requests.pop(result.get('custom_id'), None)
+                if request is None:
+                    continue
+                response_ = result.get('response') or {}
+                if result.get('error') or response_.get('status_code') != 200:
+                    logger.warning(f'batch {job_id} request {result.get("custom_id")} failed: '
+                                   f'{result.get("error") or response_.get("body")}')
+                    continue
+                pending.append((result['custom_id'], request, response_['body']))
+                if len(pending) >= IMPORT_BATCH:
+                    count += write_results(conn, job_id, pending)
+                    pending = []
+        count += write_results(conn, job_id, pending)
+    finally:
+        conn.close()
+    logger.info(f'batch job {job_id}: imported {count} results in {(time.perf_counter() - start) * 1000:.0f} ms')
+    return count
+
+
+def write_results(conn, job_id, pending):
+    rows = []
+    for custom_id, (cid, prompt), body in pending:
+        if prompt is not None:
+            rows.append((TSID.create().number, cid, TSID.create().to_string(), prompt, 1, datetime.now()))
+        content = body['choices'][0]['message'].get('content') or ''
+        rows.append((TSID.create().number, cid, body.get('id') or TSID.create().to_string(), content, 0,
+                     datetime.now()))
+    with conn:
+        conn.executemany("insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)",
+                         rows)
+        conn.executemany("update batch_request set IMPORTED = 1 where BATCH_ID = ? and CUSTOM_ID = ?",
+                         [(job_id, custom_id) for custom_id, _, _ in pending])
+    return len(pending)
+
+
+def log_errors(client, file_id):
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line.strip() == '':
+                continue
+            result = json.loads(line)
+            logger.warning(f'batch request {result.get("custom_id")} failed: '
+                           f'{result.get("error") or (result.get("response") or {}).get("body")}')
+
+
+def cancel(client, db_file, job_id):
+    job = client.batches.cancel(job_id)
+    conn = sqlite3.connect(db_file)
+    try:
+        with conn:
+            conn.execute("update batch_job set STATUS = ?, UPDATETIME = ? where ID = ?",
+                         (job.status, datetime.now(), job_id))
+    finally:
+        conn.close()
@@ -0,0 +1,433 @@
+"""
+无界面基准测试，结果以 JSON 输出，便于不同版本之间对比。
+
+python benchmark.py -o stream.json stream --rounds 5 --chunk-size 4 --interval 0.01 --reply-length 2000
+python benchmark.py -o render.json render --sizes 100,1000,10000 --kinds short,long,code,cjk
+python benchmark.py -o search.json search --rows 500000
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import metrics
+from tsid import TSID
+
+
+def setup_headless(home=None):
+    """
+    使用 offscreen 平台，并把 HOME 指向临时目录，避免污染真实的数据库、配置和日志。
+    必须在 import main 之前调用。
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    home = home or tempfile.mkdtemp(prefix='chatgpt_bench_')
+    os.environ['HOME'] = home
+    os.environ['USERPROFILE'] = home
+    return home
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位为字节, Linux 为 KB
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stats(values):
+    """
+    >>> stats([1.0, 2.0, 3.0])
+    {'count': 3, 'mean': 2.0, 'p50': 2.0, 'p95': 2.9, 'max': 3.0}
+    >>> stats([])
+    {'count': 0}
+    """
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(metrics.percentile(values, 50), 3),
+        'p95': round(metrics.percentile(values, 95), 3),
+        'max': round(max(values), 3),
+    }
+
+
+class FrameMonitor:
+    """
+    用固定间隔的定时器探测 UI 线程卡顿：实际间隔明显超过预期即视为一次卡顿。
+    """
+
+    def __init__(self, interval_ms=16, stall_ms=50):
+        from PySide6.QtCore import QTimer
+
+        self.interval_ms = interval_ms
+        self.stall_ms = stall_ms
+        self.intervals = []
+        self.last = None
+        self.timer = QTimer()
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.tick)
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.intervals.append((now - self.last) * 1000)
+        self.last = now
+
+    def start(self):
+        self.last = None
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def result(self):
+        stalls = [i for i in self.intervals if i > self.stall_ms]
+        return {
+            'frame_interval_ms': stats(self.intervals),
+            'stalls': len(stalls),
+            'stall_ms': stats(stalls),
+        }
+
+
+def wait_until(app, predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        app.processEvents()
+        time.sleep(0.001)
+    return True
+
+
+def bench_db_writes(window, rows):
+    start = time.perf_counter()
+    for i in range(rows):
+        window.insert_message_to_db(f'bench-{i}', 'benchmark content ' * 20, i % 2)
+    elapsed = time.perf_counter() - start
+    return {'rows': rows, 'seconds': round(elapsed, 3), 'rows_per_sec': round(rows / elapsed, 1)}
+
+
+def run_stream(args):
+    home = setup_headless()
+    from PySide6.QtWidgets import QApplication
+
+    import log_config
+    import main
+    log_config.setup_logging(home)
+    from mock_server import MockOpenAIServer
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    server = MockOpenAIServer(args.chunk_size, args.interval, args.reply_length, args.first_token_delay).start()
+    window = main.MainWindow()
+    window.resize(1000, 800)
+    window.show()
+    window.gpt_config = {'name': 'mock', 'type': 1, 'endpoint': server.url, 'key': 'mock'}
+    window.init_client()
+
+    finished = []
+    window.metrics_signal.connect(finished.append)
+    monitor = FrameMonitor(stall_ms=args.stall_ms)
+
+    tracemalloc.start()
+    rss_before = rss_bytes()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    monitor.start()
+    rounds = []
+    for i in range(args.rounds):
+        expected = len(finished) + 1
+        window.input_field.setPlainText(f'benchmark question {i}')
+        window.send_message()
+        if not wait_until(app, lambda: len(finished) >= expected, args.timeout):
+            rounds.append({'timeout': True})
+            continue
+        m = finished[-1]
+        rounds.append({
+            'connect_ms': m.connect_time * 1000,
+            'ttft_ms': m.first_token_time * 1000 if m.first_token_time is not None else None,
+            'total_ms': m.end_time * 1000,
+            'tokens': m.tokens,
+            'tokens_per_sec': m.tokens_per_sec,
+            'render_lag_ms': [lag * 1000 for lag in m.render_lags],
+        })
+    monitor.stop()
+    traced_after, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_bytes()
+
+    ok = [r for r in rounds if not r.get('timeout')]
+    result = {
+        'benchmark': 'stream',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {k: v for k, v in vars(args).items() if k != 'func'},
+        'rounds': len(rounds),
+        'timeouts': len(rounds) - len(ok),
+        'connect_ms': stats([r['connect_ms'] for r in ok]),
+        'ttft_ms': stats([r['ttft_ms'] for r in ok if r['ttft_ms'] is not None]),
+        'total_ms': stats([r['total_ms'] for r in ok]),
+        'tokens_per_sec': stats([r['tokens_per_sec'] for r in ok if r['tokens_per_sec'] is not None]),
+        'chunk_to_paint_ms': stats([lag for r in ok for lag in r['render_lag_ms']]),
+        'ui': monitor.result(),
+        'memory': {
+            'rss_before': rss_before,
+            'rss_after': rss_after,
+            'rss_growth': rss_after - rss_before if rss_before and rss_after else None,
+            'traced_growth': traced_after - traced_before,
+            'traced_peak': traced_peak,
+            'peak_rss': peak_rss_bytes(),
+        },
+        'db_write': bench_db_writes(window, args.db_rows),
+    }
+    server.stop()
+    return result
+
+
+def synthetic_content(kind, i):
+    """
+    >>> synthetic_content('short', 0)
+    '好的, thanks #0'
+    >>> synthetic_content('code', 1).startswith('```python')
+    True
+    """
+    if kind == 'short':
+        return f'好的, thanks #{i}'
+    if kind == 'long':
+        return f'Paragraph {i}. ' + 'Streaming replies can get long and wrap over many lines. ' * 40
+    if kind == 'code':
+        lines = '\n'.join(f'    total += compute(item_{j}, offset={j})  # step {j}' for j in range(40))
+        return f'```python\ndef handler_{i}(items):\n    total = 0\n{lines}\n    return total\n```'
+    if kind == 'cjk':
+        return f'第{i}条：' + '这是一个用于测试中文换行和字体度量的较长段落，包含标点符号。' * 10
+    raise ValueError(f'unknown kind: {kind}')
+
+
+def insert_synthetic_chat(db_file, kind, size):
+    cid = TSID.create().to_string()
+    start = datetime.now() - timedelta(seconds=size)
+    rows = ((TSID.create().number, cid, f'{cid}-{i}', synthetic_content(kind, i), (i + 1) % 2,
+             start + timedelta(seconds=i)) for i in range(size))
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.executemany("""insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)""",
+                         rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return cid
+
+
+def widget_count():
+    from PySide6.QtWidgets import QApplication
+    return len(QApplication.allWidgets())
+
+
+def flush_deletes(app):
+    from PySide6.QtCore import QEvent, QCoreApplication
+    QCoreApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+    app.processEvents()
+
+
+def bench_render_case(app, window, kind, size, chunks):
+    case = {'kind': kind, 'size': size}
+    cid = insert_synthetic_chat(window.db_file, kind, size)
+
+    # fetch_chat 在 UI 线程直接调用时信号同步投递，chat_update 在返回前完成
+    start = time.perf_counter()
+    window.fetch_chat(cid)
+    case['chat_update_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    app.processEvents()
+    window.chat_content_widget.update()
+    app.processEvents()
+    case['layout_ms'] = (time.perf_counter() - start) * 1000
+    case['widgets'] = widget_count()
+    case['rss_loaded'] = rss_bytes()
+
+    scroll_bar = window.chat_content_widget.verticalScrollBar()
+    scroll_bar.setValue(0)
+    app.processEvents()
+    steps = []
+    start = time.perf_counter()
+    while scroll_bar.value() < scroll_bar.maximum():
+        step_start = time.perf_counter()
+        scroll_bar.setValue(scroll_bar.value() + max(1, scroll_bar.pageStep()))
+        window.chat_content_widget.scrollArea.viewport().repaint()
+        steps.append((time.perf_counter() - step_start) * 1000)
+    case['scroll_ms'] = (time.perf_counter() - start) * 1000
+    case['scroll_step_ms'] = stats(steps)
+
+    mid = f'{cid}-stream'
+    appends = []
+    for i in range(chunks):
+        start = time.perf_counter()
+        window.bubble_message_update({'text': synthetic_content('short', i) + ' ', 'is_send': False, 'mid': mid,
+                                      'emit_time': start})
+        app.processEvents()
+        appends.append((time.perf_counter() - start) * 1000)
+    case['append_ms'] = stats(appends)
+
+    start = time.perf_counter()
+    window.init_new_chat()
+    case['clear_message_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    flush_deletes(app)
+    case['deferred_delete_ms'] = (time.perf_counter() - start) * 1000
+    case['widgets_after_clear'] = widget_count()
+    case['peak_rss'] = peak_rss_bytes()
+    return case
+
+
+def run_render(args):
+    home = setup_headless()
+    from PySide6.QtWidgets import QApplication
+
+    import log_config
+    import main
+    log_config.setup_logging(home)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    window = main.MainWindow()
+    window.resize(1000, 800)
+    window.show()
+    app.processEvents()
+
+    cases = []
+    baseline_widgets = widget_count()
+    for size, kind in itertools.product(args.sizes, args.kinds):
+        cases.append(bench_render_case(app, window, kind, size, args.chunks))
+    return {
+        'benchmark': 'render',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {k: v for k, v in vars(args).items() if k != 'func'},
+        'baseline_widgets': baseline_widgets,
+        'cases': cases,
+        'peak_rss': peak_rss_bytes(),
+    }
+
+
+def run_search(args):
+    """
+    向量检索规模测试。向量直接随机生成写入 message_embedding，只测索引重建和查询，不含向量化耗时。
+    """
+    import numpy as np
+
+    import database
+    import embeddings
+
+    home = setup_headless()
+    db_file = os.path.join(home, 'chatgpt_local.db')
+    database.init_database(db_file)
+    embedder = embeddings.HashEmbedder(args.dimensions)
+    rng = np.random.default_rng(0)
+    now = datetime.now()
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute(embeddings.MESSAGE_EMBEDDING_SQL)
+        for offset in range(0, args.rows, 10000):
+            count = min(10000, args.rows - offset)
+            vectors = embeddings.normalize(rng.standard_normal((count, args.dimensions), dtype=np.float32))
+            ids = range(offset + 1, offset + count + 1)
+            conn.executemany("insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)",
+                             ((i, f'c{i // 20}', f'm{i}', synthetic_content('short', i), i % 2, now) for i in ids))
+            conn.executemany("insert into message_embedding(ID, MODEL, VECTOR, CREATETIME) values (?,?,?,?)",
+                             ((i, embedder.model, v.astype(np.float16).tobytes(), now) for i, v in zip(ids, vectors)))
+            conn.commit()
+    finally:
+        conn.close()
+
+    index = embeddings.VectorIndex(db_file, embedder)
+    start = time.perf_counter()
+    index.rebuild()
+    rebuild_ms = (time.perf_counter() - start) * 1000
+
+    top_k_ms = []
+    search_ms = []
+    for i in range(args.queries):
+        query = rng.standard_normal(args.dimensions, dtype=np.float32)
+        start = time.perf_counter()
+        index.top_k(query / np.linalg.norm(query), args.k)
+        top_k_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        index.search(f'connection pool question {i}', args.k)
+        search_ms.append((time.perf_counter() - start) * 1000)
+    return {
+        'benchmark': 'search',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {k: v for k, v in vars(args).items() if k != 'func'},
+        'rebuild_ms': rebuild_ms,
+        'top_k_ms': stats(top_k_ms),
+        'search_ms': stats(search_ms),
+        'peak_rss': peak_rss_bytes(),
+    }
+
+
+def csv_list(cast):
+    return lambda value: [cast(v) for v in value.split(',') if v.strip()]
+
+
+def main_(argv=None):
+    parser = argparse.ArgumentParser(description='ChatGPT local 基准测试')
+    parser.add_argument('-o', '--output', help='JSON 结果文件，默认输出到标准输出')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    stream = sub.add_parser('stream', help='端到端流式延迟')
+    stream.add_argument('--rounds', type=int, default=5)
+    stream.add_argument('--chunk-size', type=int, default=4)
+    stream.add_argument('--interval', type=float, default=0.01)
+    stream.add_argument('--reply-length', type=int, default=2000)
+    stream.add_argument('--first-token-delay', type=float, default=0.05)
+    stream.add_argument('--stall-ms', type=float, default=50)
+    stream.add_argument('--timeout', type=float, default=120)
+    stream.add_argument('--db-rows', type=int, default=500)
+    stream.set_defaults(func=run_stream)
+
+    render = sub.add_parser('render', help='ChatWidget/BubbleMessage 渲染规模')
+    render.add_argument('--sizes', type=csv_list(int), default=[100, 1000], help='消息条数, 例如 100,1000,10000')
+    render.add_argument('--kinds', type=csv_list(str), default=['short', 'long', 'code', 'cjk'])
+    render.add_argument('--chunks', type=int, default=200, help='模拟流式追加的分片数')
+    render.set_defaults(func=run_render)
+
+    search = sub.add_parser('search', help='向量检索耗时')
+    search.add_argument('--rows', type=int, default=100000)
+    search.add_argument('--dimensions', type=int, default=256)
+    search.add_argument('--queries', type=int, default=20)
+    search.add_argument('--k', type=int, default=10)
+    search.set_defaults(func=run_search)
+
+    args = parser.parse_args(argv)
+    output = args.output
+    del args.output
+    result = args.func(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main_()
@@ -1,17 +1,46 @@
 """
 https://github.com/LC044/pyqt_component_library
 """
-from PIL import Image
+import time
+
 from PySide6 import QtGui
-from PySide6.QtCore import QSize, Signal, Qt, QThread, QPoint
-from PySide6.QtGui import QPainter, QFont, QColor, QPixmap, QPolygon, QFontMetrics
+from PySide6.QtCore import QSize, Signal, Qt, QPoint, QUrl
+from PySide6.QtGui import QPainter, QFont, QColor, QPixmap, QPolygon, QFontMetrics, QTextCursor, QTextBlockFormat, \
+    QTextCharFormat, QTextDocumentFragment, QDesktopServices
 from PySide6.QtWidgets import QWidget, QLabel, QHBoxLayout, QSizePolicy, QVBoxLayout, QSpacerItem, \
-    QScrollArea, QScrollBar
+    QScrollArea, QScrollBar, QTextBrowser, QFrame
+
+import image_loader
+from markdown_render import split_blocks, renderer
 
 
 class MessageType:
     Text = 1
     Image = 2
+    Markdown = 3
+
+
+TEXT_TYPES = (MessageType.Text, MessageType.Markdown)
+
+
+SEND_COLOR = QColor('#b2e281')
+RECEIVE_COLOR = QColor('white')
+STATUS_COLOR = QColor('gray')
+
+# 缩放后的头像, 键为 (路径, 尺寸, devicePixelRatio)
+_pixmap_cache = {}
+
+
+def scaled_pixmap(path, size, device_pixel_ratio=1.0) -> QPixmap:
+    key = (path, size, device_pixel_ratio)
+    pixmap = _pixmap_cache.get(key)
+    if pixmap is None:
+        pixel_size = round(size * device_pixel_ratio)
+        pixmap = QPixmap(path).scaled(pixel_size, pixel_size, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                      Qt.TransformationMode.SmoothTransformation)
+        pixmap.setDevicePixelRatio(device_pixel_ratio)
+        _pixmap_cache[key] = pixmap
+    return pixmap
 
 
 class TextMessage(QLabel):
@@ -27,35 +56,185 @@ class TextMessage(QLabel):
         self.setMinimumHeight(45)
         self.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
         self.setSizePolicy(QSizePolicy.Policy.Ignored, QSizePolicy.Policy.Ignored)
-        if is_send:
-            # self.setAlignment(Qt.AlignmentFlag.AlignCenter | Qt.AlignmentFlag.AlignRight)
-            self.setStyleSheet(
-                '''
-                background-color:#b2e281;
-                border-radius:10px;
-                padding:10px;
-                '''
-            )
-        else:
-            self.setStyleSheet(
-                '''
-                background-color:white;
-                border-radius:10px;
-                padding:10px;
-                '''
-            )
+        # 气泡背景在 paintEvent 中绘制, 不使用每个实例单独的样式表
+        self.is_send = is_send
+        self.setContentsMargins(10, 10, 10, 10)
         font_metrics = QFontMetrics(font)
         rect = font_metrics.boundingRect(text)
         self.setMaximumWidth(rect.width() + 30)
+        # 信号发出时间，下一次绘制时计算渲染延迟
+        self.pending_emit_time = None
+        self.render_lags = []
 
     def append_text(self, text):
-        new_text = self.text() + text
-        self.setText(new_text)
-        rect = QFontMetrics(self.font()).boundingRect(new_text)
+        self.set_text(self.text() + text)
+
+    def set_text(self, text):
+        self.setText(text)
+        rect = QFontMetrics(self.font()).boundingRect(text)
         self.setMaximumWidth(rect.width() + 30)
 
     def paintEvent(self, a0: QtGui.QPaintEvent) -> None:
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(SEND_COLOR if self.is_send else RECEIVE_COLOR)
+        painter.drawRoundedRect(self.rect(), 10, 10)
+        painter.end()
         super(TextMessage, self).paintEvent(a0)
+        if self.pending_emit_time is not None:
+            self.render_lags.append(time.perf_counter() - self.pending_emit_time)
+            self.pending_emit_time = None
+
+
+def utf16_len(text):
+    """
+    QTextDocument 的位置按 UTF-16 编码单元计算。
+    >>> utf16_len('a😀')
+    3
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+class RichTextMessage(QTextBrowser):
+    """
+    Markdown 消息。已完成的块由后台线程渲染成片段后按顺序拼接，末尾未完成的部分以纯文本显示。
+    """
+    fragment_ready = Signal(int, int, object)
+
+    def __init__(self, text, is_send=False, parent=None):
+        super(RichTextMessage, self).__init__(parent)
+        self.is_send = is_send
+        self.setFont(QFont('微软雅黑', 12))
+        self.setFrameShape(QFrame.Shape.NoFrame)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setOpenExternalLinks(True)
+        self.viewport().setAutoFillBackground(False)
+        self.document().setDocumentMargin(10)
+        self.setMinimumWidth(100)
+        self.setMinimumHeight(45)
+        self.setMaximumWidth(800)
+        self.setSizePolicy(QSizePolicy.Policy.Ignored, QSizePolicy.Policy.Fixed)
+        self.document().documentLayout().documentSizeChanged.connect(self.adjust_height)
+        self.fragment_ready.connect(self.insert_fragment)
+        self.generation = 0
+        self.pending_emit_time = None
+        self.render_lags = []
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.generation += 1
+        self.clear()
+        self.text_ = ''
+        # 已提交渲染 / 已拼接为片段 的字符数, 片段在文档中的结束位置
+        self.submitted = 0
+        self.rendered = 0
+        self.rendered_end = 0
+        self.block_ends = {}
+        self.results = {}
+        self.next_seq = 0
+        self.expect_seq = 0
+        self.open_block = True
+        self.finished = False
+        self.current_line = ''
+        self.line_width = 0
+        self.append_text(text)
+
+    def text(self):
+        return self.text_
+
+    def append_text(self, text):
+        if not text:
+            return
+        self.finished = False
+        self.text_ += text
+        self.append_plain(text)
+        self.update_width(text)
+        blocks, consumed = split_blocks(self.text_[self.submitted:])
+        offset = self.submitted
+        for block in blocks:
+            offset = self.text_.index(block, offset) + len(block)
+            self.submit(block, offset)
+        self.submitted += consumed
+
+    def finish(self):
+        """
+        内容已完整，尾部也作为一个块渲染。
+        """
+        self.finished = True
+        tail = self.text_[self.submitted:]
+        if tail.strip():
+            self.submit(tail, len(self.text_))
+        self.submitted = len(self.text_)
+
+    def submit(self, block, end):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.block_ends[seq] = end
+        renderer.submit(block, self.fragment_ready.emit, self.generation, seq)
+
+    def append_plain(self, text):
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        if not self.open_block:
+            cursor.insertBlock(QTextBlockFormat(), QTextCharFormat())
+            self.rendered_end = cursor.position()
+            self.open_block = True
+        cursor.insertText(text, QTextCharFormat())
+
+    def insert_fragment(self, generation, seq, document):
+        if generation != self.generation:
+            return
+        self.results[seq] = document
+        while self.expect_seq in self.results:
+            document = self.results.pop(self.expect_seq)
+            end = self.block_ends.pop(self.expect_seq)
+            self.expect_seq += 1
+            self.splice(document, end)
+
+    def splice(self, document, end):
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()
+        cursor.setPosition(self.rendered_end)
+        cursor.setPosition(self.rendered_end + utf16_len(self.text_[self.rendered:end]),
+                           QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        # 片段的第一个块会并入当前块, 需要沿用它的块格式(例如代码块背景)
+        cursor.setBlockFormat(document.firstBlock().blockFormat())
+        cursor.insertFragment(QTextDocumentFragment(document))
+        self.rendered = end
+        self.open_block = self.rendered < len(self.text_) or not self.finished
+        if self.open_block:
+            cursor.insertBlock(QTextBlockFormat(), QTextCharFormat())
+        cursor.endEditBlock()
+        self.rendered_end = cursor.position()
+
+    def update_width(self, text):
+        font_metrics = self.fontMetrics()
+        lines = (self.current_line + text).split('\n')
+        self.current_line = lines[-1]
+        self.line_width = max(self.line_width, *(font_metrics.horizontalAdvance(line) for line in lines))
+        self.setMaximumWidth(min(800, self.line_width + 30))
+
+    def adjust_height(self, size):
+        self.setFixedHeight(max(45, int(size.height()) + 2))
+
+    def wheelEvent(self, e: QtGui.QWheelEvent) -> None:
+        # 高度随内容变化, 不需要内部滚动, 交给外层滚动区域
+        e.ignore()
+
+    def paintEvent(self, a0: QtGui.QPaintEvent) -> None:
+        painter = QPainter(self.viewport())
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(SEND_COLOR if self.is_send else RECEIVE_COLOR)
+        painter.drawRoundedRect(self.viewport().rect(), 10, 10)
+        painter.end()
+        super(RichTextMessage, self).paintEvent(a0)
+        if self.pending_emit_time is not None:
+            self.render_lags.append(time.perf_counter() - self.pending_emit_time)
+            self.pending_emit_time = None
 
 
 class Triangle(QLabel):
@@ -67,16 +246,16 @@ class Triangle(QLabel):
 
     def paintEvent(self, a0: QtGui.QPaintEvent) -> None:
         super(Triangle, self).paintEvent(a0)
-        if self.Type == MessageType.Text:
+        if self.Type in TEXT_TYPES:
             painter = QPainter(self)
             triangle = QPolygon()
             if self.is_send:
-                painter.setPen(QColor('#b2e281'))
-                painter.setBrush(QColor('#b2e281'))
+                painter.setPen(SEND_COLOR)
+                painter.setBrush(SEND_COLOR)
                 triangle.append([QPoint(0, 20), QPoint(0, 34), QPoint(6, 27)])
             else:
-                painter.setPen(QColor('white'))
-                painter.setBrush(QColor('white'))
+                painter.setPen(RECEIVE_COLOR)
+                painter.setBrush(RECEIVE_COLOR)
                 triangle.append([QPoint(0, 27), QPoint(6, 20), QPoint(6, 34)])
             painter.drawPolygon(triangle)
 
@@ -94,41 +273,84 @@ class Notice(QLabel):
 class Avatar(QLabel):
     def __init__(self, avatar, parent=None):
         super().__init__(parent)
+        self.avatar = None
+        self.set_avatar(avatar)
+        self.setFixedSize(QSize(45, 45))
+
+    def set_avatar(self, avatar):
+        if avatar is self.avatar or (isinstance(avatar, str) and avatar == self.avatar):
+            return
+        self.avatar = avatar
         if isinstance(avatar, str):
-            self.setPixmap(QPixmap(avatar).scaled(45, 45))
+            self.setPixmap(scaled_pixmap(avatar, 45, self.devicePixelRatioF()))
             self.image_path = avatar
         elif isinstance(avatar, QPixmap):
             self.setPixmap(avatar.scaled(45, 45))
-        self.setFixedSize(QSize(45, 45))
 
 
-class OpenImageThread(QThread):
-    def __init__(self, image_path):
-        super().__init__()
-        self.image_path = image_path
-
-    def run(self) -> None:
-        image = Image.open(self.image_path)
-        image.show()
+class ImageMessage(QLabel):
+    """
+    图片先显示占位，缩略图由 image_loader 在后台解码(并缓存到磁盘)后替换。
+    点击用系统默认程序打开原图。
+    """
+    image_ready = Signal(int, object)
 
+    MAX_WIDTH = 480
+    MAX_HEIGHT = 720
+    PLACEHOLDER_SIZE = QSize(240, 160)
 
-class ImageMessage(QLabel):
     def __init__(self, avatar, parent=None):
         super().__init__(parent)
-        self.image = QLabel(self)
+        self.setMaximumWidth(self.MAX_WIDTH)
+        self.setMaximumHeight(self.MAX_HEIGHT)
+        self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.image_ready.connect(self.image_update)
+        self.generation = 0
+        self.image_path = None
+        self.set_image(avatar)
+
+    def set_image(self, avatar):
+        self.generation += 1
         if isinstance(avatar, str):
-            self.setPixmap(QPixmap(avatar))
             self.image_path = avatar
+            self.show_placeholder("加载中...")
+            ratio = self.devicePixelRatioF()
+            image_loader.loader.submit(avatar, round(self.MAX_WIDTH * ratio), round(self.MAX_HEIGHT * ratio),
+                                       self.image_ready.emit, self.generation)
         elif isinstance(avatar, QPixmap):
+            self.image_path = None
             self.setPixmap(avatar)
-        self.setMaximumWidth(480)
-        self.setMaximumHeight(720)
-        self.setScaledContents(True)
+            self.setFixedSize(avatar.deviceIndependentSize().toSize())
+
+    def show_placeholder(self, text):
+        self.setPixmap(QPixmap())
+        self.setText(text)
+        self.setFixedSize(self.PLACEHOLDER_SIZE)
+
+    def image_update(self, generation, image):
+        if generation != self.generation:
+            return
+        if image.isNull():
+            self.show_placeholder("图片加载失败")
+            return
+        pixmap = QPixmap.fromImage(image)
+        pixmap.setDevicePixelRatio(self.devicePixelRatioF())
+        self.setText('')
+        self.setPixmap(pixmap)
+        self.setFixedSize(pixmap.deviceIndependentSize().toSize())
+
+    def paintEvent(self, a0: QtGui.QPaintEvent) -> None:
+        if self.pixmap().isNull():
+            painter = QPainter(self)
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor('#e0e0e0'))
+            painter.drawRoundedRect(self.rect(), 10, 10)
+            painter.end()
+        super().paintEvent(a0)
 
     def mousePressEvent(self, event):
-        if event.buttons() == Qt.MouseButton.LeftButton:  # 左键按下
-            self.open_image_thread = OpenImageThread(self.image_path)
-            self.open_image_thread.start()
+        if event.buttons() == Qt.MouseButton.LeftButton and self.image_path:  # 左键按下
+            QDesktopServices.openUrl(QUrl.fromLocalFile(self.image_path))
 
     def append_text(self, text):
         pass
@@ -139,12 +361,6 @@ class BubbleMessage(QWidget):
         super().__init__(parent)
         self.isSend = is_send
         self.type = Type
-        # self.set
-        self.setStyleSheet(
-            '''
-            border:none;
-            '''
-        )
         layout = QHBoxLayout()
         layout.setSpacing(0)
         layout.setContentsMargins(0, 5, 5, 5)
@@ -154,28 +370,78 @@ class BubbleMessage(QWidget):
         if Type == MessageType.Text:
             self.message = TextMessage(str_content, is_send)
             # self.message.setMaximumWidth(int(self.width() * 0.6))
+        elif Type == MessageType.Markdown:
+            self.message = RichTextMessage(str_content, is_send)
         elif Type == MessageType.Image:
             self.message = ImageMessage(str_content)
         else:
             raise ValueError("未知的消息类型")
 
+        # 消息下方的状态行，例如请求耗时统计，按需创建
+        self.status = None
+        content_layout = QVBoxLayout()
+        content_layout.setSpacing(2)
+        content_layout.setContentsMargins(0, 0, 0, 0)
+        content_layout.addWidget(self.message, 1)
+        self.content_layout = content_layout
+
         self.spacerItem = QSpacerItem(45 + 6, 45, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
         if is_send:
             layout.addItem(self.spacerItem)
-            layout.addWidget(self.message, 1)
+            layout.addLayout(content_layout, 1)
             layout.addWidget(triangle, 0, Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
             layout.addWidget(self.avatar, 0, Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
         else:
             layout.addWidget(self.avatar, 0, Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignRight)
             layout.addWidget(triangle, 0, Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignRight)
-            layout.addWidget(self.message, 1)
+            layout.addLayout(content_layout, 1)
             layout.addItem(self.spacerItem)
         self.setLayout(layout)
 
     def append_text(self, text):
-        if self.type == MessageType.Text:
+        if self.type in TEXT_TYPES:
             self.message.append_text(text)
 
+    def finish(self):
+        if self.type == MessageType.Markdown:
+            self.message.finish()
+
+    def reset(self, str_content, avatar):
+        """
+        复用已有的气泡显示新内容，样式表和布局保持不变。
+        """
+        self.avatar.set_avatar(avatar)
+        if self.type in TEXT_TYPES:
+            self.message.set_text(str_content)
+            self.message.pending_emit_time = None
+            self.message.render_lags = []
+        else:
+            self.message.set_image(str_content)
+        self.set_status('')
+
+    def mark_emit_time(self, emit_time):
+        if self.type in TEXT_TYPES and self.message.pending_emit_time is None:
+            self.message.pending_emit_time = emit_time
+
+    def render_lags(self):
+        if self.type in TEXT_TYPES:
+            return self.message.render_lags
+        return []
+
+    def set_status(self, text):
+        if self.status is None:
+            if not text:
+                return
+            self.status = QLabel()
+            self.status.setFont(QFont('微软雅黑', 9))
+            palette = self.status.palette()
+            palette.setColor(self.status.foregroundRole(), STATUS_COLOR)
+            self.status.setPalette(palette)
+            self.status.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+            self.content_layout.addWidget(self.status)
+        self.status.setText(text)
+        self.status.setVisible(bool(text))
+
 
 class ScrollAreaContent(QWidget):
     def __init__(self, parent=None):
@@ -242,10 +508,40 @@ class ScrollBar(QScrollBar):
         )
 
 
+class BubblePool:
+    """
+    清空时回收的气泡, 按 (类型, 是否发送) 分组, 切换对话时复用。多个 ChatWidget 可以共用一个。
+    """
+
+    def __init__(self, max_size=2000):
+        self.items = {}
+        self.size = 0
+        self.max_size = max_size
+
+    def get(self, Type, is_send):
+        bubbles = self.items.get((Type, is_send))
+        if bubbles:
+            self.size -= 1
+            return bubbles.pop()
+        return None
+
+    def put(self, bubble_message) -> bool:
+        if self.size >= self.max_size:
+            return False
+        # 从原来的 ChatWidget 上摘下来，那个控件被删除时不会连带删除池中的气泡
+        bubble_message.setParent(None)
+        # 清除显式隐藏标记, 重新加入布局时由布局延迟显示, 避免逐个同步 show
+        bubble_message.setAttribute(Qt.WidgetAttribute.WA_WState_ExplicitShowHide, False)
+        self.items.setdefault((bubble_message.type, bubble_message.isSend), []).append(bubble_message)
+        self.size += 1
+        return True
+
+
 class ChatWidget(QWidget):
-    def __init__(self):
+    def __init__(self, pool=None):
         super().__init__()
         self.resize(500, 200)
+        self.pool = pool if pool is not None else BubblePool()
 
         layout = QVBoxLayout()
         layout.setSpacing(0)
@@ -267,6 +563,13 @@ class ChatWidget(QWidget):
         self.scrollAreaWidgetContents.setLayout(self.layout0)
         self.setLayout(layout)
 
+    def new_message(self, str_content, avatar, Type, is_send=False) -> BubbleMessage:
+        bubble_message = self.pool.get(Type, is_send)
+        if bubble_message is not None:
+            bubble_message.reset(str_content, avatar)
+            return bubble_message
+        return BubbleMessage(str_content, avatar, Type, is_send)
+
     def add_message_item(self, bubble_message, index=1):
         if index:
             self.layout0.addWidget(bubble_message)
@@ -293,8 +596,13 @@ class ChatWidget(QWidget):
         # self.verticalScrollBar().setMaximum(self.scrollAreaWidgetContents.height())
 
     def clear_message(self) -> None:
+        self.scrollAreaWidgetContents.setUpdatesEnabled(False)
         while (child := self.layout0.takeAt(0)) is not None:
-            if child.widget():
-                child.widget().deleteLater()
+            widget = child.widget()
+            if widget is None:
+                continue
+            if not (isinstance(widget, BubbleMessage) and self.pool.put(widget)):
+                widget.deleteLater()
         self.layout0.setSpacing(0)
         self.layout0.addStretch(1)
+        self.scrollAreaWidgetContents.setUpdatesEnabled(True)
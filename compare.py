@@ -0,0 +1,191 @@
+"""
+对比模式：同一组消息并发发送给多个 (配置, 模型)，回答并排流式显示，各自记录首字延迟、tok/s 和总耗时。
+选中的回答可以采用为当前对话的正式回复，只有采用的回答写入请求统计。
+"""
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
+
+from PySide6.QtCore import Signal, Qt
+from PySide6.QtWidgets import QDialog, QHBoxLayout, QVBoxLayout, QLabel, QPushButton, QListWidget, \
+    QListWidgetItem, QLineEdit, QWidget
+from loguru import logger
+
+import metrics
+from bubble_message import ChatWidget, MessageType, BubblePool
+
+
+class CompareTarget(NamedTuple):
+    name: str
+    gpt_config: dict
+    model: str
+
+
+def make_targets(configs, names, models):
+    """
+    选中的配置与模型两两组合。
+
+    >>> [(t.name, t.model) for t in make_targets({'a': {}, 'b': {}}, ['a', 'b'], ['m1', 'm2'])]
+    [('a', 'm1'), ('a', 'm2'), ('b', 'm1'), ('b', 'm2')]
+    """
+    return [CompareTarget(name, configs[name], model) for name in names for model in models]
+
+
+class TargetDialog(QDialog):
+    """
+    选择参与对比的配置和模型。
+    """
+
+    def __init__(self, configs, current_name=None, current_model='', parent=None):
+        super().__init__(parent)
+        self.configs = configs
+        self.setWindowTitle("对比")
+        self.resize(400, 300)
+        layout = QVBoxLayout(self)
+
+        layout.addWidget(QLabel("配置"))
+        self.list_widget = QListWidget()
+        for name in configs.keys():
+            item = QListWidgetItem(name)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Checked if name == current_name else Qt.CheckState.Unchecked)
+            self.list_widget.addItem(item)
+        layout.addWidget(self.list_widget)
+
+        layout.addWidget(QLabel("模型"))
+        self.models_field = QLineEdit(current_model)
+        self.models_field.setPlaceholderText("多个模型用逗号分隔，例如：gpt-4o,gpt-4o-mini")
+        layout.addWidget(self.models_field)
+
+        ok_button = QPushButton("开始对比")
+        ok_button.clicked.connect(self.accept)
+        layout.addWidget(ok_button)
+
+    def targets(self):
+        names = [self.list_widget.item(i).text() for i in range(self.list_widget.count())
+                 if self.list_widget.item(i).checkState() == Qt.CheckState.Checked]
+        models = [m.strip() for m in self.models_field.text().split(',') if m.strip()]
+        return make_targets(self.configs, names, models)
+
+
+class CompareWindow(QDialog):
+    chunk_signal = Signal(int, str, float)
+    done_signal = Signal(int, object, object)
+    # 采用某个回答: (RequestMetrics, 回答全文)
+    adopt_signal = Signal(object, str)
+
+    def __init__(self, cid, messages, targets, client_factory, parent=None):
+        super().__init__(parent)
+        self.cid = cid
+        self.messages = messages
+        self.targets = targets
+        self.client_factory = client_factory
+        self.closed = False
+        self.texts = [''] * len(targets)
+        self.results = [None] * len(targets)
+
+        self.setWindowTitle(f"对比 ({len(targets)})")
+        self.resize(420 * min(len(targets), 4), 700)
+        layout = QHBoxLayout(self)
+        self.bubbles = []
+        self.status_labels = []
+        self.adopt_buttons = []
+        for i, target in enumerate(targets):
+            column = QWidget()
+            column_layout = QVBoxLayout(column)
+            column_layout.setContentsMargins(0, 0, 0, 0)
+            header = QLabel(f'{target.name} / {target.model}')
+            header.setToolTip(target.gpt_config.get('endpoint', ''))
+            column_layout.addWidget(header)
+            chat_widget = ChatWidget(pool=BubblePool(max_size=0))
+            bubble = chat_widget.new_message('', ':ui/icon.png', MessageType.Markdown, False)
+            chat_widget.add_message_item(bubble)
+            column_layout.addWidget(chat_widget, 1)
+            status = QLabel("等待响应...")
+            status.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+            column_layout.addWidget(status)
+            adopt_button = QPushButton("采用此回答")
+            adopt_button.setEnabled(False)
+            adopt_button.clicked.connect(partial(self.adopt, i))
+            column_layout.addWidget(adopt_button)
+            layout.addWidget(column, 1)
+            self.bubbles.append(bubble)
+            self.status_labels.append(status)
+            self.adopt_buttons.append(adopt_button)
+
+        self.chunk_signal.connect(self.chunk_update)
+        self.done_signal.connect(self.done_update)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(targets)), thread_name_prefix='compare')
+
+    def start(self):
+        for i, target in enumerate(self.targets):
+            self.executor.submit(self.stream, i, target)
+
+    def stream(self, column, target: CompareTarget):
+        request_metrics = metrics.RequestMetrics(self.cid, target.model, target.gpt_config.get('endpoint'))
+        error = None
+        try:
+            with logger.contextualize(cid=self.cid, model=target.model, compare=target.name):
+                client = self.client_factory(target.gpt_config)
+                completion = client.chat.completions.create(
+                    model=target.model,
+                    messages=self.messages,
+                    stream=True,
+                    stream_options=metrics.STREAM_OPTIONS
+                )
+                request_metrics.connected()
+                for chunk in completion:
+                    if self.closed:
+                        completion.close()
+                        break
+                    if len(chunk.choices) > 0:
+                        chunk_text = chunk.choices[0].delta.content
+                        if chunk_text is None:
+                            chunk_text = ''
+                        request_metrics.chunk(chunk_text)
+                        if request_metrics.mid is None:
+                            request_metrics.mid = chunk.id
+                        self.chunk_signal.emit(column, chunk_text, time.perf_counter())
+                    request_metrics.usage(chunk.usage)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            error = str(e)
+        request_metrics.finish()
+        try:
+            self.done_signal.emit(column, request_metrics, error)
+        except RuntimeError:
+            # 窗口已关闭
+            pass
+
+    def chunk_update(self, column, text, emit_time):
+        self.texts[column] += text
+        bubble = self.bubbles[column]
+        bubble.append_text(text)
+        bubble.mark_emit_time(emit_time)
+
+    def done_update(self, column, request_metrics: metrics.RequestMetrics, error):
+        bubble = self.bubbles[column]
+        bubble.finish()
+        request_metrics.render_lags = list(bubble.render_lags())
+        self.results[column] = request_metrics
+        if error is not None:
+            self.status_labels[column].setText(f'失败: {error[0: 200]}')
+            return
+        self.status_labels[column].setText(request_metrics.summary())
+        logger.opt(lazy=True).info('compare {}/{}: {}', lambda: self.targets[column].name,
+                                   lambda: request_metrics.model, request_metrics.summary)
+        if self.texts[column] and request_metrics.mid is not None:
+            self.adopt_buttons[column].setEnabled(True)
+
+    def adopt(self, column):
+        for button in self.adopt_buttons:
+            button.setEnabled(False)
+        self.adopt_buttons[column].setText("已采用")
+        self.adopt_signal.emit(self.results[column], self.texts[column])
+
+    def closeEvent(self, event):
+        self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
@@ -0,0 +1,178 @@
+"""
+旧对话正文压缩。
+
+超过 COMPRESS_DAYS 天没有新消息的对话，CONTENT 用 zlib + 共享字典压缩后以 BLOB 存回原列，
+格式为 MAGIC + 字典 ID(4 字节) + zlib 数据；未压缩的行仍是 TEXT。读取时用 decode() 还原，
+调用方看到的始终是明文。字典从已有消息中按行频率训练，存放在 compression_dict 表。
+"""
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+COMPRESSION_DICT_SQL = """
+create table if not exists compression_dict (
+    ID INTEGER PRIMARY KEY NOT NULL,
+    DATA BLOB NOT NULL,
+    CREATETIME DATETIME NOT NULL
+)
+"""
+
+MAGIC = b'Z1'
+HEADER = struct.Struct('>2sI')
+# zlib 只使用字典末尾的 32 KB
+DICT_SIZE = 32 * 1024
+DICT_SAMPLES = 2000
+# 太短的消息压缩收益不抵头部开销
+MIN_LENGTH = 256
+COMPRESS_DAYS = int(os.environ.get('CHATGPT_LOCAL_COMPRESS_DAYS', '30'))
+
+
+def train_dictionary(samples, size=DICT_SIZE):
+    """
+    出现不止一次的行按频率升序拼接，最常见的放在末尾(离压缩数据最近，引用代价最低)。
+
+    >>> train_dictionary(['import os\\nx = 1', 'import os\\ny = 2', 'import os\\nx = 1'])
+    b'x = 1\\nimport os\\n'
+    """
+    counter = Counter()
+    for sample in samples:
+        counter.update(line for line in sample.split('\n') if line.strip())
+    common = [line for line, count in counter.most_common() if count > 1]
+    parts = []
+    total = 0
+    for line in common:
+        data = (line + '\n').encode('utf-8')
+        if total + len(data) > size:
+            break
+        parts.append(data)
+        total += len(data)
+    parts.reverse()
+    return b''.join(parts)
+
+
+def encode(text, dict_id, zdict):
+    """
+    >>> text = 'hello world ' * 40
+    >>> data = encode(text, 1, b'hello world ')
+    >>> data[:2], len(data) < len(text)
+    (b'Z1', True)
+    >>> zlib.decompressobj(zdict=b'hello world ').decompress(data[HEADER.size:]).decode() == text
+    True
+    """
+    compressor = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+    return HEADER.pack(MAGIC, dict_id) + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+class Codec:
+    """
+    按数据库文件缓存字典，供各个读取 CONTENT 的地方解压。
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.dicts = {}
+        self.lock = threading.Lock()
+
+    def zdict(self, dict_id):
+        with self.lock:
+            value = self.dicts.get(dict_id)
+            if value is None:
+                conn = sqlite3.connect(self.db_file)
+                try:
+                    row = conn.execute("select DATA from compression_dict where ID = ?", (dict_id,)).fetchone()
+                finally:
+                    conn.close()
+                if row is None:
+                    raise ValueError(f'compression dictionary {dict_id} not found')
+                value = bytes(row[0])
+                self.dicts[dict_id] = value
+            return value
+
+    def decode(self, content):
+        if not isinstance(content, bytes):
+            return content
+        magic, dict_id = HEADER.unpack_from(content)
+        if magic != MAGIC:
+            raise ValueError('unknown content encoding')
+        zdict = self.zdict(dict_id) if dict_id else None
+        decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+        return decompressor.decompress(content[HEADER.size:]).decode('utf-8')
+
+
+_codecs = {}
+
+
+def codec(db_file):
+    value = _codecs.get(db_file)
+    if value is None:
+        value = _codecs.setdefault(db_file, Codec(db_file))
+    return value
+
+
+def decode(db_file, content):
+    return codec(db_file).decode(content)
+
+
+def current_dictionary(conn):
+    """
+    返回最新的 (dict_id, zdict)，还没有时用现有消息训练一个。
+    """
+    conn.execute(COMPRESSION_DICT_SQL)
+    row = conn.execute("select ID, DATA from compression_dict order by ID desc limit 1").fetchone()
+    if row is not None:
+        return row[0], bytes(row[1])
+    samples = [r[0] for r in conn.execute(
+        "select CONTENT from chat_message where typeof(CONTENT) = 'text' order by ID desc limit ?", (DICT_SAMPLES,))]
+    zdict = train_dictionary(samples)
+    cursor = conn.execute("insert into compression_dict(DATA, CREATETIME) values (?, ?)",
+                          (zdict, datetime.now().isoformat()))
+    conn.commit()
+    logger.info(f'compression dictionary trained: {len(zdict)} bytes from {len(samples)} messages')
+    return cursor.lastrowid, zdict
+
+
+def compress_old(db_file, days=COMPRESS_DAYS, batch_size=500, should_stop=None):
+    """
+    压缩 days 天内没有新消息的对话，每批一个短事务。返回 (压缩行数, 节省字节数)。
+    """
+    start = time.perf_counter()
+    cutoff = datetime.now() - timedelta(days=days)
+    conn = sqlite3.connect(db_file)
+    compressed = 0
+    saved = 0
+    try:
+        dict_id, zdict = current_dictionary(conn)
+        last_id = -1
+        while should_stop is None or not should_stop():
+            rows = conn.execute("""
+            select ID, CONTENT from chat_message
+            where ID > ? and typeof(CONTENT) = 'text' and length(CONTENT) >= ?
+            and CID in (select CID from chat_message group by CID having max(CREATETIME) < ?)
+            order by ID asc limit ?
+            """, (last_id, MIN_LENGTH, cutoff.isoformat(), batch_size)).fetchall()
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for id_, content in rows:
+                data = encode(content, dict_id, zdict)
+                size = len(content.encode('utf-8'))
+                if len(data) < size:
+                    updates.append((data, id_))
+                    saved += size - len(data)
+            with conn:
+                conn.executemany("update chat_message set CONTENT = ? where ID = ?", updates)
+            compressed += len(updates)
+    finally:
+        conn.close()
+    if compressed > 0:
+        logger.info(f'compressed {compressed} messages, saved {saved} bytes in '
+                    f'{(time.perf_counter() - start) * 1000:.0f} ms')
+    return compressed, saved
@@ -0,0 +1,41 @@
+"""
+端点配置(~/chatgpt_local.config)的读写和客户端创建，界面和无界面入口共用。
+"""
+import json
+import os
+
+from openai import AzureOpenAI, OpenAI
+
+CONFIG_FILE = os.path.expanduser('~') + "/chatgpt_local.config"
+SYSTEM_PROMPT = "你是一个很有用的助理."
+
+
+def read_gpt_config():
+    json_data = {}
+    if not os.path.exists(CONFIG_FILE):
+        write_gpt_config({})
+        return json_data
+    with open(CONFIG_FILE, 'r+', encoding='utf-8') as f:
+        content = f.read()
+        if content.strip() == '':
+            content = '{}'
+        json_data = json.loads(content)
+    return json_data
+
+
+def write_gpt_config(config):
+    with open(CONFIG_FILE, 'w+', encoding='utf-8') as f:
+        f.write(json.dumps(config))
+
+
+def make_client(gpt_config):
+    if gpt_config['type'] == 0:
+        return AzureOpenAI(
+            api_key=gpt_config['key'],
+            azure_endpoint=gpt_config['endpoint'],
+            api_version='2024-10-21'
+        )
+    return OpenAI(
+        api_key=gpt_config['key'],
+        base_url=gpt_config['endpoint'],
+    )
@@ -0,0 +1,125 @@
+"""
+对话列表的数据模型。
+
+每次刷新只把差异(删除、插入、标题变化)通知给视图，视图保留选中项和滚动位置；
+行数很多时通过 canFetchMore/fetchMore 分批交给视图。
+"""
+from typing import NamedTuple
+
+from PySide6.QtCore import QAbstractListModel, QModelIndex, Qt
+
+CID_ROLE = Qt.ItemDataRole.UserRole
+FETCH_BATCH = 200
+
+
+class Conversation(NamedTuple):
+    cid: str
+    title: str
+
+
+class ConversationModel(QAbstractListModel):
+
+    def __init__(self, parent=None, fetch_batch=FETCH_BATCH):
+        super().__init__(parent)
+        self.fetch_batch = fetch_batch
+        # 全部对话(Conversation)，前 visible 行已交给视图
+        self.rows = []
+        self.visible = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.visible
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self.visible:
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return row.title
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return row.title
+        if role == CID_ROLE:
+            return row.cid
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.visible < len(self.rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.fetch_batch, len(self.rows) - self.visible)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.visible, self.visible + count - 1)
+        self.visible += count
+        self.endInsertRows()
+
+    def reset(self, rows):
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.visible = min(self.fetch_batch, len(self.rows))
+        self.endResetModel()
+
+    def set_rows(self, rows):
+        """
+        rows 按创建时间排序，与现有行比较后只发出差异。顺序发生变化时整体重置。
+        """
+        if len(self.rows) == 0:
+            self.reset(rows)
+            return
+        new_cids = {row.cid for row in rows}
+        i = len(self.rows) - 1
+        while i >= 0:
+            if self.rows[i].cid in new_cids:
+                i -= 1
+                continue
+            last = i
+            while i >= 0 and self.rows[i].cid not in new_cids:
+                i -= 1
+            self._remove(i + 1, last)
+
+        old_cids = {row.cid for row in self.rows}
+        if [row.cid for row in self.rows] != [row.cid for row in rows if row.cid in old_cids]:
+            self.reset(rows)
+            return
+
+        pos = 0
+        j = 0
+        while j < len(rows):
+            if pos < len(self.rows) and self.rows[pos].cid == rows[j].cid:
+                if self.rows[pos] != rows[j]:
+                    self.rows[pos] = rows[j]
+                    if pos < self.visible:
+                        index = self.index(pos)
+                        self.dataChanged.emit(index, index)
+                pos += 1
+                j += 1
+                continue
+            start = j
+            while j < len(rows) and (pos >= len(self.rows) or rows[j].cid != self.rows[pos].cid):
+                j += 1
+            self._insert(pos, rows[start:j])
+            pos += j - start
+
+    def _remove(self, first, last):
+        if first < self.visible:
+            visible_last = min(last, self.visible - 1)
+            self.beginRemoveRows(QModelIndex(), first, visible_last)
+            del self.rows[first:last + 1]
+            self.visible -= visible_last - first + 1
+            self.endRemoveRows()
+        else:
+            del self.rows[first:last + 1]
+
+    def _insert(self, pos, rows):
+        if pos < self.visible or self.visible == len(self.rows):
+            self.beginInsertRows(QModelIndex(), pos, pos + len(rows) - 1)
+            self.rows[pos:pos] = rows
+            self.visible += len(rows)
+            self.endInsertRows()
+        else:
+            self.rows[pos:pos] = rows
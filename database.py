@@ -0,0 +1,101 @@
+"""
+数据库表结构。界面和各个无界面入口(导入、批量任务等)共用。
+"""
+import sqlite3
+import traceback
+from datetime import datetime
+from typing import NamedTuple
+
+from loguru import logger
+
+import metrics
+import vision
+from tsid import TSID
+
+
+def adapt_datetime_iso(date_time: datetime) -> str:
+    """
+    Convert a Python datetime.datetime into a timezone-naive ISO 8601 date string.
+    >>> adapt_datetime_iso(datetime(2023, 4, 5, 6, 7, 8, 9))
+    '2023-04-05T06:07:08.000009'
+    """
+    return date_time.isoformat()
+
+
+def convert_timestamp(time_stamp: bytes) -> datetime:
+    """
+    Convert an ISO 8601 formatted bytestring to a datetime.datetime object.
+    >>> convert_timestamp(b'2023-04-05T06:07:08.000009')
+    datetime.datetime(2023, 4, 5, 6, 7, 8, 9)
+    """
+    return datetime.strptime(time_stamp.decode("utf-8"), "%Y-%m-%dT%H:%M:%S.%f")
+
+
+sqlite3.register_adapter(datetime, adapt_datetime_iso)
+sqlite3.register_converter("timestamp", convert_timestamp)
+
+CHAT_MESSAGE_SQL = """
+create table if not exists chat_message (
+    ID INTEGER PRIMARY KEY NOT NULL,
+    CID TEXT NOT NULL,
+    MID TEXT NOT NULL,
+    CONTENT TEXT NOT NULL,
+    SEND INTEGER NOT NULL,
+    CREATETIME DATETIME NOT NULL
+)
+"""
+
+CHAT_MESSAGE_INDEX_SQL = """
+create index if not exists idx_chat_message_cid on chat_message(CID, CREATETIME)
+"""
+
+
+class ChatMessage(NamedTuple):
+    mid: str
+    content: str
+    send: int
+
+
+class ChatHistory(NamedTuple):
+    """
+    fetch_chat 在后台线程构造，经 Signal(object) 原样交给 UI 线程。
+    """
+    cid: str
+    messages: list
+    # MID -> 耗时统计文本
+    summaries: dict
+    # MID -> [vision.Attachment, ...]
+    attachments: dict
+    # [输入, 缓存命中, 输出] token 累计
+    usage: list
+
+
+def init_database(db_file):
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    try:
+        # 只对新建的空库生效，已有数据库由 maintenance 在空闲时切换
+        cursor.execute("pragma auto_vacuum = incremental")
+        cursor.execute("pragma journal_mode = wal")
+        cursor.execute(CHAT_MESSAGE_SQL)
+        cursor.execute(CHAT_MESSAGE_INDEX_SQL)
+        cursor.execute(metrics.CREATE_TABLE_SQL)
+        metrics.migrate(cursor)
+        vision.init_tables(conn)
+    except Exception as e:
+        logger.error(f'{traceback.format_exc()}')
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def insert_message(db_file, cid, mid, content, send):
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    try:
+        sql = """insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)"""
+        c.execute(sql, (TSID.create().number, cid, mid, content, send, datetime.now()))
+        conn.commit()
+    finally:
+        c.close()
+        conn.close()
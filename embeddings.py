@@ -0,0 +1,333 @@
+"""
+历史消息的语义检索。
+
+消息向量(归一化后)以 float16 BLOB 存在 message_embedding 表，检索时使用按 ID 排序导出的
+float32 矩阵文件(np.load mmap_mode='r')，一次矩阵乘法得到全部余弦相似度再取 top-k。
+新写入的消息先进入内存中的增量部分，攒够 REBUILD_ROWS 行或空闲维护时重建矩阵文件。
+
+向量化方式可替换：配置中有 embedding_model 时调用该端点的 embeddings 接口，
+否则使用本地的 HashEmbedder(离线可用，也用于测试)。
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from loguru import logger
+
+import compression
+
+MESSAGE_EMBEDDING_SQL = """
+create table if not exists message_embedding (
+    ID INTEGER NOT NULL,
+    MODEL TEXT NOT NULL,
+    VECTOR BLOB NOT NULL,
+    CREATETIME DATETIME NOT NULL,
+    PRIMARY KEY (ID, MODEL)
+)
+"""
+
+DIMENSIONS = 256
+BATCH_SIZE = 64
+# 单条消息送去向量化的最大字符数
+MAX_CHARS = 8000
+REBUILD_ROWS = 10000
+
+TOKEN_RE = re.compile(r'[a-z0-9_]+|[一-鿿]')
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+class HashEmbedder:
+    """
+    词和相邻汉字对做特征哈希，不依赖模型和网络。
+
+    >>> embedder = HashEmbedder(dimensions=64)
+    >>> vectors = embedder.embed(['connection pool size', 'pool connection', '数据库连接池'])
+    >>> vectors.shape
+    (3, 64)
+    >>> bool(vectors[0] @ vectors[1] > vectors[0] @ vectors[2])
+    True
+    """
+
+    def __init__(self, dimensions=DIMENSIONS):
+        self.dimensions = dimensions
+        self.model = f'local-hash-{dimensions}'
+
+    def features(self, text):
+        tokens = TOKEN_RE.findall(text.lower())
+        features = list(tokens)
+        for a, b in zip(tokens, tokens[1:]):
+            if len(a) == 1 and len(b) == 1 and a >= '一' and b >= '一':
+                features.append(a + b)
+        return features
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for feature in self.features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[i, h % self.dimensions] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+
+class OpenAIEmbedder:
+    """
+    使用已配置客户端的 embeddings 接口，text-embedding-3 系列直接请求 DIMENSIONS 维。
+    """
+
+    def __init__(self, client, model, dimensions=DIMENSIONS):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+
+    def embed(self, texts):
+        kwargs = {'dimensions': self.dimensions} if self.model.startswith('text-embedding-3') else {}
+        response = self.client.embeddings.create(model=self.model, input=texts, **kwargs)
+        data = sorted(response.data, key=lambda item: item.index)
+        return normalize(np.array([item.embedding for item in data], dtype=np.float32))
+
+
+class SearchResult(NamedTuple):
+    score: float
+    id: int
+    cid: str
+    mid: str
+    content: str
+    send: int
+
+
+class VectorIndex:
+
+    def __init__(self, db_file, embedder, cache_dir=None):
+        self.db_file = db_file
+        self.embedder = embedder
+        self.model = embedder.model
+        cache_dir = cache_dir or os.path.dirname(db_file)
+        name = re.sub(r'[^\w.-]', '_', self.model)
+        self.matrix_file = os.path.join(cache_dir, f'chatgpt_local.vectors.{name}.npy')
+        self.ids_file = os.path.join(cache_dir, f'chatgpt_local.vectors.{name}.ids.npy')
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        # 重建共用同一个临时文件，同一时间只能有一个
+        self.rebuild_lock = threading.Lock()
+        self.matrix = None
+        self.ids = None
+        self.delta_vectors = []
+        self.delta_ids = []
+        # 正在 load/rebuild 的次数，期间新写入的向量也记入增量，换上新矩阵时再合并
+        self.loading = 0
+
+    def init_table(self, conn):
+        conn.execute(MESSAGE_EMBEDDING_SQL)
+
+    def index_pending(self, batch_size=BATCH_SIZE, should_stop=None):
+        """
+        向量化还没有向量的消息，返回新增的条数。已有其他线程在索引时直接返回 0。
+        """
+        if not self.index_lock.acquire(blocking=False):
+            return 0
+        indexed = 0
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.init_table(conn)
+            last_id = -1
+            while should_stop is None or not should_stop():
+                rows = conn.execute("""
+                select m.ID, m.CONTENT from chat_message m
+                left join message_embedding e on e.ID = m.ID and e.MODEL = ?
+                where e.ID is null and m.ID > ? order by m.ID asc limit ?
+                """, (self.model, last_id, batch_size)).fetchall()
+                if len(rows) == 0:
+                    break
+                last_id = rows[-1][0]
+                ids = [row[0] for row in rows]
+                texts = [compression.decode(self.db_file, row[1])[:MAX_CHARS] or ' ' for row in rows]
+                vectors = self.embedder.embed(texts)
+                now = datetime.now().isoformat()
+                with conn:
+                    conn.executemany(
+                        "insert or replace into message_embedding(ID, MODEL, VECTOR, CREATETIME) values (?,?,?,?)",
+                        [(id_, self.model, vector.astype(np.float16).tobytes(), now)
+                         for id_, vector in zip(ids, vectors)])
+                with self.lock:
+                    if self.matrix is not None or self.loading > 0:
+                        self.delta_ids.extend(ids)
+                        self.delta_vectors.extend(vectors)
+                indexed += len(rows)
+        finally:
+            conn.close()
+            self.index_lock.release()
+        if indexed > 0:
+            logger.info(f'embedded {indexed} messages with {self.model} in '
+                        f'{(time.perf_counter() - start) * 1000:.0f} ms')
+        with self.lock:
+            pending = len(self.delta_ids)
+        if pending >= REBUILD_ROWS:
+            self.rebuild()
+        return indexed
+
+    def rebuild(self):
+        """
+        把全部向量按 ID 顺序写成 float32 矩阵文件并重新映射，同时清理已删除消息的向量。
+        """
+        with self.lock:
+            self.loading += 1
+        try:
+            with self.rebuild_lock:
+                self._rebuild()
+        finally:
+            with self.lock:
+                self.loading -= 1
+
+    def _rebuild(self):
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.init_table(conn)
+            with conn:
+                conn.execute("""
+                delete from message_embedding where MODEL = ? and ID not in (select ID from chat_message)
+                """, (self.model,))
+            count = conn.execute("select count(*) from message_embedding where MODEL = ?",
+                                 (self.model,)).fetchone()[0]
+            dimensions = self.embedder.dimensions
+            tmp_matrix = self.matrix_file + '.tmp.npy'
+            matrix = np.lib.format.open_memmap(tmp_matrix, mode='w+', dtype=np.float32,
+                                               shape=(count, dimensions))
+            ids = np.empty(count, dtype=np.int64)
+            cursor = conn.execute("select ID, VECTOR from message_embedding where MODEL = ? order by ID asc",
+                                  (self.model,))
+            i = 0
+            while rows := cursor.fetchmany(4096):
+                rows = rows[:count - i]
+                ids[i:i + len(rows)] = [row[0] for row in rows]
+                matrix[i:i + len(rows)] = np.frombuffer(b''.join(row[1] for row in rows),
+                                                        dtype=np.float16).reshape(len(rows), dimensions)
+                i += len(rows)
+            matrix.flush()
+            del matrix
+        finally:
+            conn.close()
+        with self.lock:
+            self.matrix = None
+            os.replace(tmp_matrix, self.matrix_file)
+            np.save(self.ids_file, ids[:i])
+            self._swap(np.load(self.matrix_file, mmap_mode='r'), np.load(self.ids_file), [], [])
+        logger.info(f'vector index rebuilt: {i} vectors in {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    def load(self):
+        """
+        映射已有的矩阵文件，文件之后新增的向量从数据库读入增量部分；没有文件时重建。
+        """
+        with self.lock:
+            self.loading += 1
+        try:
+            self._load()
+        finally:
+            with self.lock:
+                self.loading -= 1
+
+    def _load(self):
+        if not (os.path.exists(self.matrix_file) and os.path.exists(self.ids_file)):
+            self.rebuild()
+            return
+        matrix = np.load(self.matrix_file, mmap_mode='r')
+        ids = np.load(self.ids_file)
+        if matrix.shape[0] != ids.shape[0] or matrix.shape[1] != self.embedder.dimensions:
+            self.rebuild()
+            return
+        max_id = int(ids[-1]) if len(ids) > 0 else -1
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.init_table(conn)
+            rows = conn.execute("select ID, VECTOR from message_embedding where MODEL = ? and ID > ? order by ID asc",
+                                (self.model, max_id)).fetchall()
+        finally:
+            conn.close()
+        with self.lock:
+            self._swap(matrix, ids, [row[0] for row in rows],
+                       [np.frombuffer(row[1], dtype=np.float16).astype(np.float32) for row in rows])
+        if len(rows) >= REBUILD_ROWS:
+            self.rebuild()
+
+    def _swap(self, matrix, ids, delta_ids, delta_vectors):
+        """
+        持有 self.lock 时调用。读取数据库之后 index_pending 写入的向量不在新的矩阵和增量中，从旧的增量里补上。
+        """
+        loaded = set(delta_ids)
+        for id_, vector in zip(self.delta_ids, self.delta_vectors):
+            if id_ not in loaded:
+                delta_ids.append(id_)
+                delta_vectors.append(vector)
+                loaded.add(id_)
+        if len(delta_ids) > 0 and len(ids) > 0:
+            keep = ~np.isin(np.array(delta_ids, dtype=np.int64), ids)
+            delta_ids = [id_ for id_, k in zip(delta_ids, keep) if k]
+            delta_vectors = [vector for vector, k in zip(delta_vectors, keep) if k]
+        self.matrix = matrix
+        self.ids = ids
+        self.delta_ids = delta_ids
+        self.delta_vectors = delta_vectors
+
+    def top_k(self, vector, k=10):
+        """
+        返回 [(score, id), ...]，按相似度降序。
+        """
+        if self.matrix is None:
+            self.load()
+        with self.lock:
+            matrix, ids = self.matrix, self.ids
+            delta_ids, delta_vectors = list(self.delta_ids), list(self.delta_vectors)
+        scores = np.asarray(matrix @ vector)
+        if len(delta_ids) > 0:
+            scores = np.concatenate([scores, np.stack(delta_vectors) @ vector])
+            ids = np.concatenate([ids, np.array(delta_ids, dtype=np.int64)])
+        if len(scores) == 0:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(ids[i])) for i in top]
+
+    def search(self, text, k=10):
+        vector = self.embedder.embed([text])[0]
+        # 多取一些，已删除的消息在这里被过滤掉
+        hits = self.top_k(vector, k * 2)
+        if len(hits) == 0:
+            return []
+        conn = sqlite3.connect(self.db_file)
+        try:
+            rows = conn.execute(f"""
+            select ID, CID, MID, CONTENT, SEND from chat_message where ID in ({','.join('?' * len(hits))})
+            """, [id_ for _, id_ in hits]).fetchall()
+        finally:
+            conn.close()
+        by_id = {row[0]: row for row in rows}
+        results = []
+        for score, id_ in hits:
+            row = by_id.get(id_)
+            if row is None:
+                continue
+            results.append(SearchResult(score, id_, row[1], row[2], compression.decode(self.db_file, row[3]), row[4]))
+            if len(results) >= k:
+                break
+        return results
+
+
+def make_embedder(client=None, gpt_config=None):
+    model = (gpt_config or {}).get('embedding_model')
+    if client is not None and model:
+        return OpenAIEmbedder(client, model)
+    return HashEmbedder()
+
@@ -0,0 +1,212 @@
+"""
+流式导出对话为 JSONL / Markdown / HTML，逐批读取、逐条写出，内存占用与历史大小无关。
+
+python export.py -f md -o history.md.gz
+python export.py -f jsonl -o chat.jsonl --cid 0ABCDEF123456
+"""
+import argparse
+import gzip
+import html
+import json
+import os
+import sqlite3
+
+import compression
+
+FORMATS = {
+    'jsonl': '.jsonl',
+    'md': '.md',
+    'html': '.html',
+}
+
+COLUMNS = ['ID', 'CID', 'MID', 'CONTENT', 'SEND', 'CREATETIME']
+
+
+def iter_rows(db_file, cid=None, batch_size=500):
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    try:
+        if cid is None:
+            sql = """
+            select ID, CID, MID, CONTENT, SEND, CREATETIME from chat_message order by CID asc, CREATETIME asc
+            """
+            c.execute(sql)
+        else:
+            sql = """
+            select ID, CID, MID, CONTENT, SEND, CREATETIME from chat_message where CID = ? order by CREATETIME asc
+            """
+            c.execute(sql, (cid,))
+        while rows := c.fetchmany(batch_size):
+            for row in rows:
+                row = dict(zip(COLUMNS, row))
+                row['CONTENT'] = compression.decode(db_file, row['CONTENT'])
+                yield row
+    finally:
+        c.close()
+        conn.close()
+
+
+def count_rows(db_file, cid=None):
+    conn = sqlite3.connect(db_file)
+    try:
+        if cid is None:
+            return conn.execute("select count(*) from chat_message").fetchone()[0]
+        return conn.execute("select count(*) from chat_message where CID = ?", (cid,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def role(row):
+    return 'user' if row['SEND'] == 1 else 'assistant'
+
+
+def title(content):
+    return content.strip().split('\n')[0][0:20]
+
+
+def jsonl_lines(rows):
+    """
+    >>> list(jsonl_lines([{'CID': 'c', 'MID': 'm', 'CONTENT': '你好', 'SEND': 1, 'CREATETIME': 't'}]))
+    ['{"cid": "c", "mid": "m", "role": "user", "content": "你好", "createtime": "t"}\\n']
+    """
+    for row in rows:
+        yield json.dumps({
+            'cid': row['CID'],
+            'mid': row['MID'],
+            'role': role(row),
+            'content': row['CONTENT'],
+            'createtime': row['CREATETIME'],
+        }, ensure_ascii=False) + '\n'
+
+
+def markdown_lines(rows):
+    """
+    >>> rows = [{'CID': 'c', 'CONTENT': 'hi', 'SEND': 1, 'CREATETIME': 't1'},
+    ...         {'CID': 'c', 'CONTENT': 'hello', 'SEND': 0, 'CREATETIME': 't2'}]
+    >>> print(''.join(markdown_lines(rows)), end='')
+    # hi
+    <BLANKLINE>
+    **user** · t1
+    <BLANKLINE>
+    hi
+    <BLANKLINE>
+    **assistant** · t2
+    <BLANKLINE>
+    hello
+    <BLANKLINE>
+    """
+    cid = None
+    for row in rows:
+        if row['CID'] != cid:
+            cid = row['CID']
+            yield f'# {title(row["CONTENT"])}\n\n'
+        yield f'**{role(row)}** · {row["CREATETIME"]}\n\n{row["CONTENT"]}\n\n'
+
+
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>ChatGPT local</title>
+<style>
+body { font-family: sans-serif; max-width: 900px; margin: 0 auto; background: #f5f5f5; }
+.msg { border-radius: 10px; padding: 10px; margin: 8px 0; white-space: pre-wrap; }
+.user { background: #b2e281; margin-left: 20%; }
+.assistant { background: white; margin-right: 20%; }
+.time { color: gray; font-size: 12px; }
+</style>
+</head>
+<body>
+"""
+
+HTML_TAIL = """</body>
+</html>
+"""
+
+
+def html_lines(rows):
+    yield HTML_HEAD
+    cid = None
+    for row in rows:
+        if row['CID'] != cid:
+            cid = row['CID']
+            yield f'<h2>{html.escape(title(row["CONTENT"]))}</h2>\n'
+        yield (f'<div class="time">{html.escape(str(row["CREATETIME"]))}</div>'
+               f'<div class="msg {role(row)}">{html.escape(row["CONTENT"])}</div>\n')
+    yield HTML_TAIL
+
+
+FORMATTERS = {
+    'jsonl': jsonl_lines,
+    'md': markdown_lines,
+    'html': html_lines,
+}
+
+
+def counted(rows, progress, total, every=500):
+    count = 0
+    for row in rows:
+        yield row
+        count += 1
+        if progress is not None and count % every == 0:
+            progress(count, total)
+    if progress is not None:
+        progress(count, total)
+
+
+def open_output(path, compress=None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def export(db_file, path, fmt='jsonl', cid=None, compress=None, progress=None, batch_size=500):
+    """
+    progress(done, total) 每处理一批行调用一次。返回导出的行数。
+    """
+    total = count_rows(db_file, cid) if progress is not None else None
+    done = 0
+
+    def on_progress(count, total_):
+        nonlocal done
+        done = count
+        if progress is not None:
+            progress(count, total_)
+
+    rows = counted(iter_rows(db_file, cid, batch_size), on_progress, total, batch_size)
+    with open_output(path, compress) as f:
+        for piece in FORMATTERS[fmt](rows):
+            f.write(piece)
+    return done
+
+
+def guess_format(path):
+    """
+    >>> guess_format('a/b.md.gz')
+    'md'
+    >>> guess_format('x.htm') is None
+    True
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    ext = os.path.splitext(name)[1]
+    for fmt, fmt_ext in FORMATS.items():
+        if ext == fmt_ext:
+            return fmt
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='导出对话')
+    parser.add_argument('-o', '--output', required=True, help='输出文件, 以 .gz 结尾时压缩')
+    parser.add_argument('-f', '--format', choices=list(FORMATS.keys()), help='默认按扩展名判断')
+    parser.add_argument('--cid', help='只导出指定对话')
+    parser.add_argument('--db', default=os.path.expanduser('~') + '/chatgpt_local.db')
+    parser.add_argument('--gzip', action='store_true', default=None, help='压缩输出')
+    args = parser.parse_args()
+
+    fmt = args.format or guess_format(args.output) or 'jsonl'
+    count = export(args.db, args.output, fmt, args.cid, args.gzip,
+                   progress=lambda done, total: print(f'\r{done}/{total}', end='', flush=True))
+    print(f'\nexported {count} rows to {args.output}')
@@ -0,0 +1,129 @@
+"""
+图片消息的缩略图。
+
+后台线程用 QImageReader 按目标尺寸解码(JPEG 等格式解码时直接降采样，不会先得到全尺寸图片)，
+结果以 PNG 缓存在磁盘上，文件名由图片内容哈希和尺寸组成；内存中再保留最近用过的一批。
+UI 线程只把 QImage 转成 QPixmap。
+"""
+import hashlib
+import os
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QSize, Qt
+from PySide6.QtGui import QImage, QImageReader, QImageIOHandler
+from loguru import logger
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), 'chatgpt_local_cache', 'thumbnails')
+MEMORY_ITEMS = 128
+
+
+def fit_size(width, height, max_width, max_height):
+    """
+    等比缩小到不超过最大尺寸，不放大。
+
+    >>> fit_size(4000, 3000, 480, 720)
+    (480, 360)
+    >>> fit_size(100, 2000, 480, 720)
+    (36, 720)
+    >>> fit_size(200, 100, 480, 720)
+    (200, 100)
+    """
+    scale = min(max_width / width, max_height / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImageLoader:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_workers=None):
+        self.cache_dir = cache_dir
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1),
+                                           thread_name_prefix='image')
+        self.lock = threading.Lock()
+        # (路径, 修改时间, 大小) -> 内容哈希
+        self.hashes = {}
+        # (内容哈希, 宽, 高) -> QImage
+        self.images = OrderedDict()
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            value = self.hashes.get(key)
+        if value is None:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                while data := f.read(1024 * 1024):
+                    digest.update(data)
+            value = digest.hexdigest()
+            with self.lock:
+                self.hashes[key] = value
+        return value
+
+    def thumbnail(self, path, max_width, max_height) -> QImage:
+        """
+        在后台线程调用。返回不超过给定像素尺寸的 QImage，解码失败时返回空 QImage。
+        """
+        key = (self.content_hash(path), max_width, max_height)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+        cache_file = os.path.join(self.cache_dir, key[0][0:2], f'{key[0]}_{max_width}x{max_height}.png')
+        image = QImage(cache_file) if os.path.exists(cache_file) else QImage()
+        if image.isNull():
+            image = self.decode(path, max_width, max_height)
+            if not image.isNull():
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp_file = cache_file + '.tmp'
+                if image.save(tmp_file, 'PNG'):
+                    os.replace(tmp_file, cache_file)
+        if not image.isNull():
+            with self.lock:
+                self.images[key] = image
+                while len(self.images) > MEMORY_ITEMS:
+                    self.images.popitem(last=False)
+        return image
+
+    @staticmethod
+    def decode(path, max_width, max_height) -> QImage:
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        # 缩放发生在 EXIF 旋转之前，旋转 90 度的图片按互换后的宽高限制缩放
+        rotated = bool(reader.transformation() & QImageIOHandler.Transformation.TransformationRotate90)
+        bound_width, bound_height = (max_height, max_width) if rotated else (max_width, max_height)
+        size = reader.size()
+        if size.isValid():
+            width, height = fit_size(size.width(), size.height(), bound_width, bound_height)
+            if (width, height) != (size.width(), size.height()):
+                reader.setScaledSize(QSize(width, height))
+        image = reader.read()
+        if image.isNull():
+            logger.warning(f'decode image failed: {path}: {reader.errorString()}')
+            return image
+        if image.width() > max_width or image.height() > max_height:
+            # 读不到尺寸的格式
+            image = image.scaled(max_width, max_height, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        return image
+
+    def submit(self, path, max_width, max_height, callback, *args):
+        self.executor.submit(self._load, path, max_width, max_height, callback, args)
+
+    def _load(self, path, max_width, max_height, callback, args):
+        try:
+            image = self.thumbnail(path, max_width, max_height)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            image = QImage()
+        try:
+            callback(*args, image)
+        except RuntimeError:
+            # 接收方控件已被销毁
+            pass
+
+
+loader = ImageLoader()
@@ -0,0 +1,48 @@
+"""
+图片附件的缩放和压缩，在 vision.Preprocessor 的子进程中运行。
+
+spawn 子进程只需要导入这个模块，它只依赖 PIL，不要在这里引入 Qt、openai 或项目中的其他模块。
+"""
+import io
+
+from PIL import Image, ImageOps
+
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+JPEG_QUALITY = 85
+
+
+def target_size(width, height, max_side=MAX_SIDE, short_side=SHORT_SIDE):
+    """
+    >>> target_size(4032, 3024)
+    (1024, 768)
+    >>> target_size(1000, 8000)
+    (256, 2048)
+    >>> target_size(640, 480)
+    (640, 480)
+    """
+    scale = min(1.0, max_side / max(width, height), short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_image(path):
+    """
+    解码、按 EXIF 旋转、缩放并压缩为 JPEG，返回 (数据, 宽, 高)。
+    """
+    with Image.open(path) as image:
+        # JPEG 解码时直接按 1/2、1/4... 降采样
+        image.draft('RGB', target_size(*image.size))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        size = target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        return buffer.getvalue(), image.width, image.height
@@ -0,0 +1,260 @@
+"""
+导入 ChatGPT 官方数据导出(conversations.json 或导出的 zip)。
+
+文件按顺序流式解析，不整体读入内存；每个对话只保留当前分支(current_node 到根节点)。
+已导入的对话记录在 import_source 表中，重复运行会跳过未变化的对话，中断后可直接重跑续导。
+
+python importer.py ~/Downloads/chatgpt-export.zip
+"""
+import argparse
+import io
+import json
+import os
+import sqlite3
+import zipfile
+from datetime import datetime
+
+from loguru import logger
+
+import database
+from tsid import TSID
+
+IMPORT_SOURCE_SQL = """
+create table if not exists import_source (
+    SOURCE_ID TEXT PRIMARY KEY NOT NULL,
+    CID TEXT NOT NULL,
+    UPDATETIME REAL,
+    MESSAGES INTEGER NOT NULL,
+    IMPORTTIME DATETIME NOT NULL
+)
+"""
+
+WHITESPACE = ' \t\r\n'
+
+
+def iter_json_array(f, chunk_size=1 << 20):
+    """
+    逐个产出顶层 JSON 数组中的元素，只缓存当前元素。
+    元素不完整时至少再读入与已缓存部分同样多的数据，大元素只需重新解析 O(log n) 次。
+
+    >>> list(iter_json_array(io.StringIO('[{"a": 1}, {"b": [2, 3]} ,\\n 4]'), chunk_size=3))
+    [{'a': 1}, {'b': [2, 3]}, 4]
+    >>> list(iter_json_array(io.StringIO(' [] ')))
+    []
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def fill(size=chunk_size):
+        nonlocal buffer, pos, eof
+        data = f.read(size)
+        if not data:
+            eof = True
+        buffer = buffer[pos:] + data
+        pos = 0
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError('unexpected end of JSON array')
+            fill()
+            continue
+        ch = buffer[pos]
+        if not started:
+            if ch != '[':
+                raise ValueError('expected a JSON array')
+            started = True
+            pos += 1
+            continue
+        if ch == ']':
+            return
+        if ch == ',':
+            pos += 1
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # 元素不完整，缓存加倍后从元素开头重新解析
+            fill(max(chunk_size, len(buffer) - pos))
+            continue
+        if end == len(buffer) and not eof:
+            # 数字等标量可能被截断，读到分隔符后再确认
+            fill(max(chunk_size, len(buffer) - pos))
+            continue
+        pos = end
+        yield value
+
+
+def open_export(path):
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        name = next((n for n in archive.namelist() if n.endswith('conversations.json')), None)
+        if name is None:
+            raise ValueError(f'conversations.json not found in {path}')
+        return io.TextIOWrapper(archive.open(name), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def message_text(message):
+    """
+    >>> message_text({'content': {'content_type': 'text', 'parts': ['a', {'x': 1}, 'b']}})
+    'a\\nb'
+    >>> message_text({'content': {'content_type': 'code', 'text': 'print(1)'}}) is None
+    True
+    """
+    content = message.get('content') or {}
+    if content.get('content_type') not in ('text', 'multimodal_text'):
+        return None
+    parts = [p for p in content.get('parts') or [] if isinstance(p, str)]
+    text = '\n'.join(parts)
+    return text if text.strip() else None
+
+
+def active_branch(conversation):
+    """
+    当前分支上的 (role, text, create_time, message_id)，按时间顺序。
+
+    >>> conversation = {'current_node': 'c', 'mapping': {
+    ...     'r': {'message': None, 'parent': None},
+    ...     'a': {'message': {'id': 'a', 'author': {'role': 'user'},
+    ...                       'content': {'content_type': 'text', 'parts': ['hi']}}, 'parent': 'r'},
+    ...     'x': {'message': {'id': 'x', 'author': {'role': 'assistant'},
+    ...                       'content': {'content_type': 'text', 'parts': ['old']}}, 'parent': 'a'},
+    ...     'c': {'message': {'id': 'c', 'author': {'role': 'assistant'}, 'create_time': 1.0,
+    ...                       'content': {'content_type': 'text', 'parts': ['new']}}, 'parent': 'a'}}}
+    >>> active_branch(conversation)
+    [('user', 'hi', None, 'a'), ('assistant', 'new', 1.0, 'c')]
+    """
+    mapping = conversation.get('mapping') or {}
+    node_id = conversation.get('current_node')
+    branch = []
+    seen = set()
+    while node_id is not None and node_id in mapping and node_id not in seen:
+        seen.add(node_id)
+        node = mapping[node_id]
+        message = node.get('message')
+        if message is not None:
+            role = (message.get('author') or {}).get('role')
+            text = message_text(message)
+            if role in ('user', 'assistant') and text is not None:
+                branch.append((role, text, message.get('create_time'), message.get('id') or node_id))
+        node_id = node.get('parent')
+    branch.reverse()
+    return branch
+
+
+def to_datetime(timestamp, fallback):
+    if timestamp is None:
+        return fallback
+    return datetime.fromtimestamp(timestamp)
+
+
+class Importer:
+
+    def __init__(self, db_file, batch_rows=5000, progress=None, progress_every=100):
+        self.db_file = db_file
+        self.batch_rows = batch_rows
+        self.progress = progress
+        self.progress_every = progress_every
+        self.imported = 0
+        self.skipped = 0
+        self.messages = 0
+
+    def run(self, path):
+        database.init_database(self.db_file)
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.execute(IMPORT_SOURCE_SQL)
+            known = {row[0]: (row[1], row[2]) for row in
+                     conn.execute("select SOURCE_ID, CID, UPDATETIME from import_source")}
+            # 批量写入期间不维护索引，结束后重建
+            conn.execute("drop index if exists idx_chat_message_cid")
+            conn.commit()
+            rows = []
+            sources = []
+            deletes = []
+            with open_export(path) as f:
+                for conversation in iter_json_array(f):
+                    self.add_conversation(conversation, known, rows, sources, deletes)
+                    if len(rows) >= self.batch_rows:
+                        self.flush(conn, rows, sources, deletes)
+            self.flush(conn, rows, sources, deletes)
+            if self.progress is not None:
+                self.progress(self.imported, self.skipped)
+        finally:
+            conn.execute(database.CHAT_MESSAGE_INDEX_SQL)
+            conn.execute("analyze chat_message")
+            conn.commit()
+            conn.close()
+        logger.info(f'import finished: {self.imported} conversations, {self.messages} messages, '
+                    f'{self.skipped} skipped')
+        return self.imported
+
+    def add_conversation(self, conversation, known, rows, sources, deletes):
+        source_id = conversation.get('conversation_id') or conversation.get('id')
+        update_time = conversation.get('update_time')
+        if source_id is None:
+            self.skipped += 1
+            self.report()
+            return
+        previous = known.get(source_id)
+        if previous is not None and previous[1] == update_time:
+            self.skipped += 1
+            self.report()
+            return
+        branch = active_branch(conversation)
+        if len(branch) == 0:
+            self.skipped += 1
+            self.report()
+            return
+        if previous is not None:
+            # 对话在导出后有更新，整段替换
+            cid = previous[0]
+            deletes.append((cid,))
+        else:
+            cid = TSID.create().to_string()
+        created = to_datetime(conversation.get('create_time'), datetime.now())
+        ids = [TSID.create().number for _ in branch]
+        for id_, (role, text, create_time, mid) in zip(ids, branch):
+            rows.append((id_, cid, mid, text, 1 if role == 'user' else 0, to_datetime(create_time, created)))
+        sources.append((source_id, cid, update_time, len(branch), datetime.now()))
+        known[source_id] = (cid, update_time)
+        self.imported += 1
+        self.messages += len(branch)
+        self.report()
+
+    def flush(self, conn, rows, sources, deletes):
+        with conn:
+            conn.executemany("delete from chat_message where CID = ?", deletes)
+            conn.executemany("""insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME)
+                values (?,?,?,?,?,?)""", rows)
+            conn.executemany("""insert or replace into import_source(SOURCE_ID, CID, UPDATETIME, MESSAGES, IMPORTTIME)
+                values (?,?,?,?,?)""", sources)
+        rows.clear()
+        sources.clear()
+        deletes.clear()
+
+    def report(self):
+        if self.progress is not None and (self.imported + self.skipped) % self.progress_every == 0:
+            self.progress(self.imported, self.skipped)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='导入 ChatGPT 数据导出')
+    parser.add_argument('path', help='conversations.json 或导出的 zip 文件')
+    parser.add_argument('--db', default=os.path.expanduser('~') + '/chatgpt_local.db')
+    parser.add_argument('--batch-rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    importer = Importer(args.db, args.batch_rows,
+                        progress=lambda imported, skipped: print(f'\r{imported} imported, {skipped} skipped',
+                                                                 end='', flush=True))
+    importer.run(args.path)
+    print()
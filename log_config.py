@@ -0,0 +1,127 @@
+"""
+日志配置：后台队列写入、JSON 结构化记录、压缩归档、运行时调整级别。
+
+handler 的级别就是当前级别，低于它的调用在 loguru 中直接返回，不会格式化消息。
+热点路径用 logger.debug('... {}', value) 或 logger.opt(lazy=True) 传参，关闭时不拼接字符串、不截断正文。
+"""
+import json
+import os
+import sys
+import traceback
+
+from loguru import logger
+
+LOG_FILE = 'chatgpt.log'
+LEVEL_ENV = 'CHATGPT_LOCAL_LOG_LEVEL'
+DEFAULT_LEVEL = 'INFO'
+LEVELS = ['TRACE', 'DEBUG', 'INFO', 'WARNING', 'ERROR']
+# 问题/回答等正文默认只记录前 CONTENT_LIMIT 个字符, TRACE 级别记录全文
+CONTENT_LIMIT = 200
+
+
+def parse_level(name):
+    """
+    返回大写的级别名，loguru 不认识时返回 None。
+
+    >>> parse_level(' debug ')
+    'DEBUG'
+    >>> parse_level('verbose') is None
+    True
+    """
+    name = (name or '').strip().upper()
+    try:
+        logger.level(name)
+    except ValueError:
+        return None
+    return name
+
+
+class Level:
+    """
+    当前级别。loguru 中 handler 的级别不可修改，改变级别时重新添加 handler。
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.no = logger.level(level).no
+
+    def set_level(self, level):
+        self.no = logger.level(level).no
+        self.level = level
+
+
+current_level = Level(parse_level(os.environ.get(LEVEL_ENV, DEFAULT_LEVEL)) or DEFAULT_LEVEL)
+# setup_logging 的参数和添加的 handler，改变级别时据此重新添加
+_setup = None
+_handler_ids = []
+
+
+def json_format(record):
+    data = {
+        'time': record['time'].isoformat(timespec='milliseconds'),
+        'level': record['level'].name,
+        'message': record['message'],
+        'location': f"{record['module']}:{record['function']}:{record['line']}",
+        'thread': record['thread'].name,
+    }
+    data.update(record['extra'])
+    if record['exception'] is not None:
+        data['exception'] = ''.join(traceback.format_exception(*record['exception']))
+    record['extra']['_json'] = json.dumps(data, ensure_ascii=False, default=str)
+    return '{extra[_json]}\n'
+
+
+def setup_logging(log_dir, level=None, retention=10):
+    """
+    在启动时调用一次。文件按 50 MB 轮转，旧文件压缩为 gz，最多保留 retention 个。
+    """
+    global _setup
+    if level is not None:
+        current_level.set_level(level)
+    logger.remove()
+    _handler_ids.clear()
+    _setup = (log_dir, retention)
+    add_handlers()
+    env_level = os.environ.get(LEVEL_ENV)
+    if env_level is not None and parse_level(env_level) is None:
+        logger.warning(f'{LEVEL_ENV}={env_level!r} 不是有效的日志级别，使用 {DEFAULT_LEVEL}')
+
+
+def add_handlers():
+    for handler_id in _handler_ids:
+        # 等待队列中的记录写完
+        logger.remove(handler_id)
+    _handler_ids.clear()
+    log_dir, retention = _setup
+    _handler_ids.append(logger.add(sys.stderr, level=current_level.no, enqueue=True,
+                                   format='{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {message}'))
+    _handler_ids.append(logger.add(os.path.join(log_dir, LOG_FILE),
+                                   level=current_level.no,
+                                   format=json_format,
+                                   rotation='50 MB',
+                                   retention=retention,
+                                   compression='gz',
+                                   enqueue=True,
+                                   encoding='utf-8'))
+
+
+def set_level(level):
+    current_level.set_level(level)
+    if _setup is not None:
+        add_handlers()
+    logger.info('log level: {}', level)
+
+
+def content(text, limit=CONTENT_LIMIT):
+    """
+    截断正文用于日志，TRACE 级别时返回全文。
+    >>> content('a' * 10, limit=4)
+    'aaaa...(10 chars)'
+    >>> content('abc', limit=4)
+    'abc'
+    """
+    if text is None:
+        return ''
+    if len(text) <= limit or current_level.no <= logger.level('TRACE').no:
+        return text
+    return f'{text[:limit]}...({len(text)} chars)'
@@ -1,20 +1,40 @@
-import json
+import multiprocessing
 import os
 import platform
 import sqlite3
 import sys
+import time
 import traceback
 from datetime import datetime
 from functools import partial
 
 import qdarktheme
-from PySide6.QtCore import QTimer, QThread, Signal, Qt
-from PySide6.QtGui import QIcon
+from PySide6.QtCore import QTimer, QThread, Signal, Qt, QUrl
+from PySide6.QtGui import QIcon, QCursor, QDesktopServices
 from PySide6.QtWidgets import QMainWindow, QApplication, QHBoxLayout, QWidget, QVBoxLayout, QSplitter, QPushButton, \
-    QListWidget, QTextEdit, QDialog, QLineEdit, QListWidgetItem, QMessageBox, QComboBox, QStyle
-from openai import AzureOpenAI, OpenAI
-
-from bubble_message import ChatWidget, BubbleMessage, MessageType
+    QListWidget, QTextEdit, QDialog, QLineEdit, QListWidgetItem, QMessageBox, QComboBox, QStyle, QTableWidget, \
+    QTableWidgetItem, QListView, QAbstractItemView, QHeaderView, QFileDialog, QLabel, QStackedWidget, QMenu
+
+import batch
+import batch_job
+import compare
+import compression
+import config
+import database
+import embeddings
+import export
+import importer
+import log_config
+import maintenance
+import metrics
+import prefetch
+import profiling
+import proxy
+import session_cache
+import streaming
+import vision
+from conversation_model import ConversationModel, Conversation, CID_ROLE
+from bubble_message import ChatWidget, MessageType, BubblePool
 from toast import Toast
 from tsid import TSID
 from ui import main_ui, main_rc
@@ -22,36 +42,10 @@ from ui import main_ui, main_rc
 ___not_use = main_rc.qt_resource_name
 
 
-def adapt_datetime_iso(date_time: datetime) -> str:
-    """
-    Convert a Python datetime.datetime into a timezone-naive ISO 8601 date string.
-    >>> adapt_datetime_iso(datetime(2023, 4, 5, 6, 7, 8, 9))
-    '2023-04-05T06:07:08.000009'
-    """
-    return date_time.isoformat()
-
-
-def convert_timestamp(time_stamp: bytes) -> datetime:
-    """
-    Convert an ISO 8601 formatted bytestring to a datetime.datetime object.
-    >>> convert_timestamp(b'2023-04-05T06:07:08.000009')
-    datetime.datetime(2023, 4, 5, 6, 7, 8, 9)
-    """
-    return datetime.strptime(time_stamp.decode("utf-8"), "%Y-%m-%dT%H:%M:%S.%f")
-
-
-sqlite3.register_adapter(datetime, adapt_datetime_iso)
-sqlite3.register_converter("timestamp", convert_timestamp)
-
 from loguru import logger
 
 home_dir = os.path.expanduser('~')
 
-logger.add(home_dir + "/chatgpt.log",
-           rotation="50 MB",
-           format="{time:YYYY-MM-DD HH:mm:ss.SSSZZ} | {level} | {message}",
-           level="DEBUG")
-
 os_name = platform.system().lower()
 logger.debug(f"os: {os_name}")
 if os_name == 'linux':
@@ -63,14 +57,27 @@ if os_name == 'linux':
     # os.environ['QT_DEBUG_PLUGINS'] = '1'
     pass
 
+# 鼠标在对话列表上停留超过该毫秒数才预取，划过的行不预取
+PREFETCH_HOVER_MS = 150
+# 无操作超过 IDLE_SECONDS 且没有后台任务时才做数据库维护
+IDLE_SECONDS = 60
+MAINTENANCE_INTERVAL_MS = 10 * 60 * 1000
+
 
 class WorkerThread(QThread):
+    # 持有运行中线程的引用, fix: QThread: Destroyed while thread is still running
+    running = set()
 
     def __init__(self, parent=None, target=None, args=(), kwargs=None):
         QThread.__init__(self, parent)
         self._target = target
         self._args = args
         self._kwargs = {} if kwargs is None else kwargs
+        WorkerThread.running.add(self)
+        self.finished.connect(self.release)
+
+    def release(self):
+        WorkerThread.running.discard(self)
 
     def run(self) -> None:
         if self._target:
@@ -82,11 +89,32 @@ class WorkerThread(QThread):
 
 
 class MainWindow(QMainWindow):
-    bubble_message_signal = Signal(dict)
+    # object 而不是 dict：dict 会被转换成副本，messages_comp 要按对象比较
+    bubble_message_signal = Signal(object)
+
+    c_list_signal = Signal(object)
+
+    chat_signal = Signal(object)
 
-    c_list_signal = Signal(str)
+    metrics_signal = Signal(object)
 
-    chat_signal = Signal(str)
+    export_signal = Signal(int, int)
+    import_signal = Signal(int, int)
+
+    maintenance_signal = Signal(object)
+
+    search_signal = Signal(object)
+    # 批处理任务列表: list[batch_job.BatchJob]
+    jobs_signal = Signal(object)
+    error_signal = Signal(str)
+    # 状态栏临时消息: (文本, 显示毫秒数)
+    status_signal = Signal(str, int)
+    # 对话在后台被写入: cid, None 表示全部
+    chat_invalidated_signal = Signal(object)
+    # 对话已删除: cid
+    chat_deleted_signal = Signal(object)
+    # 在工作线程中请求刷新对话列表
+    c_list_refresh_signal = Signal()
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -101,9 +129,23 @@ class MainWindow(QMainWindow):
         self.messages_array = []
         self.client = None
         self.db_file = home_dir + '/chatgpt_local.db'
+        self.vector_index = None
 
         self.messages_comp = {}
 
+        self.last_activity = time.monotonic()
+        self.maintenance_wt = None
+        self.jobs_table = None
+        self.preprocessor = vision.Preprocessor(self.db_file)
+        # 待发送的图片: [(路径, Preprocessor.submit 的返回值), ...]
+        self.attachments = []
+        self.prefetcher = prefetch.Prefetcher(self.load_chat, self.chat_chars)
+        # 切换走的对话连同界面一起保留
+        self.sessions = session_cache.SessionCache()
+        self.spare_chat_widgets = []
+        self.bubble_pool = BubblePool()
+        self.hovered_cid = None
+
         tool_bar = self.addToolBar("toolBar")
         tool_bar.setMovable(False)
         tool_bar.setFloatable(False)
@@ -112,6 +154,40 @@ class MainWindow(QMainWindow):
         push_button_config.clicked.connect(self.do_config)
         tool_bar.addWidget(push_button_config)
 
+        push_button_metrics = QPushButton("统计")
+        push_button_metrics.clicked.connect(self.show_metrics)
+        tool_bar.addWidget(push_button_metrics)
+
+        push_button_compare = QPushButton("对比")
+        push_button_compare.setToolTip("把输入框中的问题同时发给多个配置/模型")
+        push_button_compare.clicked.connect(self.do_compare)
+        tool_bar.addWidget(push_button_compare)
+
+        push_button_jobs = QPushButton("批处理")
+        push_button_jobs.setToolTip("通过 Batch API 离线处理选中的对话或提示词文件")
+        push_button_jobs.clicked.connect(self.show_jobs)
+        tool_bar.addWidget(push_button_jobs)
+
+        push_button_export = QPushButton("导出")
+        push_button_export.clicked.connect(self.do_export)
+        tool_bar.addWidget(push_button_export)
+
+        push_button_import = QPushButton("导入")
+        push_button_import.clicked.connect(self.do_import)
+        tool_bar.addWidget(push_button_import)
+
+        push_button_diagnostics = QPushButton("诊断")
+        push_button_diagnostics.setToolTip("性能分析(cProfile)和内存快照，报告写在日志旁边")
+        push_button_diagnostics.setMenu(self.diagnostics_menu(push_button_diagnostics))
+        tool_bar.addWidget(push_button_diagnostics)
+
+        log_level_combo = QComboBox()
+        log_level_combo.addItems(log_config.LEVELS)
+        log_level_combo.setCurrentText(log_config.current_level.level)
+        log_level_combo.setToolTip("日志级别")
+        log_level_combo.currentTextChanged.connect(log_config.set_level)
+        tool_bar.addWidget(log_level_combo)
+
         # 创建主部件和主布局
         main_widget = QWidget()
         main_layout = QHBoxLayout(main_widget)
@@ -124,8 +200,26 @@ class MainWindow(QMainWindow):
         new_chat_button.clicked.connect(partial(self.init_new_chat, None))
         left_layout.addWidget(new_chat_button)
 
-        self.c_list = QListWidget()
+        self.search_field = QLineEdit()
+        self.search_field.setPlaceholderText("搜索历史消息(语义)")
+        self.search_field.returnPressed.connect(self.do_search)
+        left_layout.addWidget(self.search_field)
+
+        self.c_list_model = ConversationModel(self)
+        self.c_list = QListView()
+        self.c_list.setModel(self.c_list_model)
+        self.c_list.setUniformItemSizes(True)
+        self.c_list.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        # 多选用于提交批处理
+        self.c_list.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
         self.c_list.doubleClicked.connect(self.c_list_double_clicked)
+        # 悬停或键盘选中时预取对话
+        self.c_list.setMouseTracking(True)
+        self.c_list.entered.connect(self.c_list_entered)
+        self.c_list.selectionModel().currentChanged.connect(self.c_list_current_changed)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch_hovered)
         left_layout.addWidget(self.c_list)
 
         c_list_tool = QWidget()
@@ -149,8 +243,11 @@ class MainWindow(QMainWindow):
         self.model_field.setPlaceholderText("请填写模型名称。例如：gpt-4o")
         right_layout.addWidget(self.model_field)
 
-        self.chat_content_widget = ChatWidget()
-        right_layout.addWidget(self.chat_content_widget)
+        # 每个缓存的对话一个 ChatWidget
+        self.chat_stack = QStackedWidget()
+        self.chat_content_widget = ChatWidget(pool=self.bubble_pool)
+        self.chat_stack.addWidget(self.chat_content_widget)
+        right_layout.addWidget(self.chat_stack)
 
         input_layout = QHBoxLayout()
 
@@ -159,11 +256,22 @@ class MainWindow(QMainWindow):
         self.input_field.setStyleSheet(""" 
         QTextEdit { border: 1px solid gray; padding: 3px; background: white; font: 14px; } 
         """)
+        attach_button = QPushButton("图片")
+        attach_button.setFixedHeight(self.input_field.height())
+        attach_button.setToolTip("添加图片(需要支持视觉输入的模型)")
+        attach_button.clicked.connect(self.do_attach)
+        self.attachment_button = QPushButton()
+        self.attachment_button.setFlat(True)
+        self.attachment_button.setToolTip("点击清除已添加的图片")
+        self.attachment_button.clicked.connect(self.clear_attachments)
+        self.attachment_button.setVisible(False)
         send_button = QPushButton("发送")
         send_button.setFixedHeight(self.input_field.height())
         send_button.clicked.connect(self.send_message)
 
         input_layout.addWidget(self.input_field)
+        input_layout.addWidget(self.attachment_button)
+        input_layout.addWidget(attach_button)
         input_layout.addWidget(send_button)
 
         right_layout.addLayout(input_layout)
@@ -182,6 +290,31 @@ class MainWindow(QMainWindow):
         self.bubble_message_signal.connect(self.bubble_message_update)
         self.c_list_signal.connect(self.c_list_update)
         self.chat_signal.connect(self.chat_update)
+        self.metrics_signal.connect(self.metrics_update)
+        self.export_signal.connect(self.export_update)
+        self.import_signal.connect(self.import_update)
+        self.maintenance_signal.connect(self.maintenance_update)
+        self.search_signal.connect(self.search_update)
+        self.jobs_signal.connect(self.jobs_update)
+        self.error_signal.connect(lambda message: Toast(message=message, parent=self).show())
+        self.status_signal.connect(self.ui.statusbar.showMessage)
+        self.chat_invalidated_signal.connect(self.drop_sessions)
+        self.chat_deleted_signal.connect(self.chat_deleted)
+        self.c_list_refresh_signal.connect(self.init_c_list)
+
+        # 当前对话累计的 token 用量和提示词缓存命中率
+        self.conversation_usage = [0, 0, 0]
+        self.usage_label = QLabel()
+        self.ui.statusbar.addPermanentWidget(self.usage_label)
+        self.db_status_label = QLabel()
+        self.ui.statusbar.addPermanentWidget(self.db_status_label)
+        self.maintenance_timer = QTimer(self)
+        self.maintenance_timer.timeout.connect(self.maintain_database)
+        self.maintenance_timer.start(MAINTENANCE_INTERVAL_MS)
+        QTimer.singleShot(IDLE_SECONDS * 1000, self.maintain_database)
+        self.jobs_timer = QTimer(self)
+        self.jobs_timer.timeout.connect(self.poll_jobs)
+        self.jobs_timer.start(batch_job.POLL_INTERVAL_MS)
 
         self.init()
 
@@ -191,6 +324,20 @@ class MainWindow(QMainWindow):
 
         self.init_database()
         self.init_c_list()
+        self.init_proxy()
+
+    def init_proxy(self):
+        # 设置 CHATGPT_LOCAL_PROXY_PORT 时随界面启动本地代理，也可以无界面运行 proxy.py
+        port = os.environ.get('CHATGPT_LOCAL_PROXY_PORT')
+        if not port:
+            return
+        try:
+            self.proxy_server = proxy.ProxyServer(self.db_file, self.read_gpt_config(),
+                                                  (self.gpt_config or {}).get('name'), port=int(port),
+                                                  on_record=self.invalidate_chat).start()
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            Toast(message='本地代理启动失败', parent=self).show()
 
     def init_c_list(self):
         # fix: QThread: Destroyed while thread is still running
@@ -208,26 +355,31 @@ class MainWindow(QMainWindow):
                         delete from chat_message where CID = ?
                         """
                 c.execute(sql, (cid,))
+                c.execute("delete from message_attachment where CID = ?", (cid,))
                 conn.commit()
+                self.invalidate_chat(cid)
                 self.fetch_c_list()
-                self.init_new_chat()
+                self.chat_deleted_signal.emit(cid)
             except Exception as e:
                 logger.error(f'{traceback.format_exc()}')
             finally:
                 c.close()
                 conn.close()
 
+    @profiling.profiled('fetch_c_list')
     def fetch_c_list(self):
         conn = sqlite3.connect(self.db_file)
         c = conn.cursor()
         try:
+            # min() 使 CONTENT 取自每个对话的第一条消息
             sql = """
-            select * from chat_message group by cid order by CREATETIME asc 
+            select CID, CONTENT, min(CREATETIME) as CREATETIME from chat_message group by CID order by CREATETIME asc
             """
             c.execute(sql)
-            columns = [col[0] for col in c.description]
-            data_ = [dict(zip(columns, row)) for row in c.fetchall()]
-            self.c_list_signal.emit(json.dumps(data_))
+            # 只发送了图片的对话没有文字标题
+            data_ = [Conversation(cid, compression.decode(self.db_file, content)[0: 20] or '[图片]')
+                     for cid, content, _ in c.fetchall()]
+            self.c_list_signal.emit(data_)
         except Exception as e:
             logger.error(f'{traceback.format_exc()}')
         finally:
@@ -235,51 +387,52 @@ class MainWindow(QMainWindow):
             conn.close()
 
     def fetch_chat(self, cid):
+        try:
+            self.chat_signal.emit(self.load_chat(cid))
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+
+    def load_chat(self, cid):
         conn = sqlite3.connect(self.db_file)
         c = conn.cursor()
         try:
             sql = """
-                    select * from chat_message where CID = ? order by CREATETIME asc 
+                    select MID, CONTENT, SEND from chat_message where CID = ? order by CREATETIME asc 
                     """
             c.execute(sql, (cid,))
-            columns = [col[0] for col in c.description]
-            data_ = [dict(zip(columns, row)) for row in c.fetchall()]
-            self.chat_signal.emit(json.dumps({
-                'cid': cid,
-                'data': data_
-            }))
-        except Exception as e:
-            logger.error(f'{traceback.format_exc()}')
+            messages = [database.ChatMessage(mid, compression.decode(self.db_file, content), send)
+                        for mid, content, send in c.fetchall()]
+            attachments = vision.fetch_attachments(c, cid)
+            # 在工作线程中预先编码，界面线程组装请求消息时直接命中缓存
+            for attachment in (a for items in attachments.values() for a in items):
+                vision.encodings.data_url(self.db_file, attachment.hash)
+            return database.ChatHistory(cid, messages, metrics.fetch_summaries(c, cid), attachments,
+                                        metrics.conversation_usage(c, cid))
         finally:
             c.close()
             conn.close()
 
-    def init_database(self):
+    def chat_chars(self, cid):
+        # 按存储的长度估算，压缩过的消息会偏小，读出后 Prefetcher 再按实际字符数检查一次
         conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
         try:
-            sql = """
-            create table if not exists chat_message (
-                ID INTEGER PRIMARY KEY NOT NULL,
-                CID TEXT NOT NULL,
-                MID TEXT NOT NULL,
-                CONTENT TEXT NOT NULL,
-                SEND INTEGER NOT NULL,
-                CREATETIME DATETIME NOT NULL
-            )
-            """
-            cursor.execute(sql)
-        except Exception as e:
-            logger.error(f'{traceback.format_exc()}')
+            return conn.execute("select coalesce(sum(length(CONTENT)), 0) from chat_message where CID = ?",
+                                (cid,)).fetchone()[0]
         finally:
-            cursor.close()
             conn.close()
 
+    def init_database(self):
+        database.init_database(self.db_file)
+        self.maintenance_update(maintenance.db_stats(self.db_file))
+
     def closeEvent(self, event):
         logger.info('close event')
         ret = QMessageBox.warning(self, '提示', '确认退出?',
                                   buttons=QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if ret == QMessageBox.StandardButton.Yes:
+            self.preprocessor.shutdown()
+            self.prefetcher.shutdown()
+            profiling.profiler.dump()
             QApplication.quit()
         else:
             event.ignore()
@@ -292,36 +445,107 @@ class MainWindow(QMainWindow):
                 self.gpt_config = next(iter(json_data.values()))
         if self.gpt_config is not None:
             try:
-                if self.gpt_config['type'] == 0:
-                    self.client = AzureOpenAI(
-                        api_key=self.gpt_config['key'],
-                        azure_endpoint=self.gpt_config['endpoint'],
-                        api_version='2024-02-01'
-                    )
-                else:
-                    self.client = OpenAI(
-                        api_key=self.gpt_config['key'],
-                        base_url=self.gpt_config['endpoint'],
-                    )
+                self.client = config.make_client(self.gpt_config)
             except Exception as e:
                 logger.error(f'{traceback.format_exc()}')
                 Toast(message='配置错误', parent=self).show()
+        self.vector_index = embeddings.VectorIndex(self.db_file,
+                                                   embeddings.make_embedder(self.client, self.gpt_config))
 
     def init_new_chat(self, conversation_id=None):
         logger.info('do new chat...')
-        self.messages_array.clear()
-        self.messages_array.append({"role": "system", "content": "你是一个很有用的助理."})
-        self.messages_comp.clear()
-        self.chat_content_widget.clear_message()
+        if conversation_id != self.conversation_id:
+            self.stash_session()
+        if self.chat_content_widget is not None:
+            self.chat_content_widget.clear_message()
+        else:
+            self.show_chat_widget(self.spare_chat_widgets.pop() if self.spare_chat_widgets
+                                  else ChatWidget(pool=self.bubble_pool))
+        self.messages_array = [{"role": "system", "content": config.SYSTEM_PROMPT}]
+        self.messages_comp = {}
+        self.set_conversation_usage([0, 0, 0])
 
         if conversation_id is None:
             self.conversation_id = TSID.create().to_string()
-            logger.info(f'new conversation id: {self.conversation_id}')
+            logger.info('new conversation id: {}', self.conversation_id)
         else:
             self.conversation_id = conversation_id
-            logger.info(f'choose conversation id: {self.conversation_id}')
+            logger.info('choose conversation id: {}', self.conversation_id)
         pass
 
+    def show_chat_widget(self, widget: ChatWidget):
+        if self.chat_stack.indexOf(widget) < 0:
+            self.chat_stack.addWidget(widget)
+        self.chat_stack.setCurrentWidget(widget)
+        self.chat_content_widget = widget
+
+    def stash_session(self):
+        """
+        把当前对话(控件、请求消息、气泡索引、滚动位置)放入缓存，当前控件置空。
+        """
+        if self.conversation_id is None or len(self.messages_comp) == 0:
+            return
+        session = session_cache.Session(self.conversation_id, self.chat_content_widget, self.messages_array,
+                                        self.messages_comp, self.conversation_usage,
+                                        self.chat_content_widget.verticalScrollBar().value())
+        self.recycle_sessions(self.sessions.put(session))
+        self.chat_content_widget = None
+
+    def restore_session(self, session: session_cache.Session):
+        logger.info('restore session : {}', session.cid)
+        self.stash_session()
+        if self.chat_content_widget is not None:
+            # 空的新对话不缓存，控件留作备用
+            self.chat_content_widget.clear_message()
+            self.spare_chat_widgets.append(self.chat_content_widget)
+        self.show_chat_widget(session.widget)
+        self.messages_array = session.messages_array
+        self.messages_comp = session.messages_comp
+        self.conversation_id = session.cid
+        self.set_conversation_usage(session.usage)
+        QTimer.singleShot(0, partial(session.widget.verticalScrollBar().setValue, session.scroll))
+        profiling.profiler.snapshot_later(f'restore {session.cid}')
+
+    def recycle_sessions(self, sessions):
+        for session in sessions:
+            # 气泡回收到共用的池中，控件本身留一个备用
+            session.widget.clear_message()
+            if len(self.spare_chat_widgets) == 0:
+                self.spare_chat_widgets.append(session.widget)
+            else:
+                self.chat_stack.removeWidget(session.widget)
+                session.widget.deleteLater()
+
+    def invalidate_chat(self, cid=None):
+        # 可在任意线程调用; cid 为 None 时全部失效
+        if cid is None:
+            self.prefetcher.clear()
+        else:
+            self.prefetcher.invalidate(cid)
+        self.chat_invalidated_signal.emit(cid)
+
+    def drop_sessions(self, cid):
+        self.recycle_sessions(self.sessions.clear() if cid is None else self.sessions.invalidate(cid))
+
+    def chat_deleted(self, cid):
+        # 删除的是当前对话时先清空 conversation_id，新建对话时不会把它暂存起来
+        self.drop_sessions(cid)
+        if cid == self.conversation_id:
+            self.conversation_id = None
+        self.init_new_chat()
+
+    def open_chat(self, cid):
+        session = self.sessions.take(cid)
+        if session is not None:
+            self.restore_session(session)
+            return
+        history = self.prefetcher.take(cid)
+        if history is not None:
+            self.chat_update(history)
+            return
+        self.wt = WorkerThread(target=self.fetch_chat, args=(cid,))
+        self.wt.start()
+
     def do_config(self):
         logger.info('do config...')
         dialog = QDialog(self)
@@ -473,20 +697,85 @@ class MainWindow(QMainWindow):
             self.refresh_config(parent, list_widget)
         pass
 
+    def do_compare(self):
+        message_text = self.input_field.toPlainText()
+        if not message_text:
+            Toast(message="请输入问题", parent=self).show()
+            return
+        configs = self.read_gpt_config()
+        if len(configs) == 0:
+            Toast(message='请先添加配置', parent=self).show()
+            return
+        current_name = next((name for name, value in configs.items() if value == self.gpt_config), None)
+        dialog = compare.TargetDialog(configs, current_name, self.get_model(), self)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+        targets = dialog.targets()
+        if len(targets) == 0:
+            Toast(message="请选择配置和模型", parent=self).show()
+            return
+
+        self.last_activity = time.monotonic()
+        input_mid = TSID.create().to_string()
+        self.add_message(message_text, is_send=True, mid=input_mid)
+        self.input_field.clear()
+        self.insert_message_to_db(input_mid, message_text, 1)
+        logger.opt(lazy=True).debug('问题: {}', lambda: log_config.content(message_text))
+        self.messages_array.append({"role": "user", "content": message_text})
+        if len(self.messages_array) < 3:
+            self.init_c_list()
+
+        logger.info(f'compare: {[(t.name, t.model) for t in targets]}')
+        window = compare.CompareWindow(self.conversation_id, list(self.messages_array), targets, config.make_client,
+                                       self)
+        window.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        window.adopt_signal.connect(partial(self.adopt_reply, self.conversation_id))
+        window.show()
+        window.start()
+
+    def adopt_reply(self, cid, request_metrics: metrics.RequestMetrics, text):
+        if cid != self.conversation_id:
+            Toast(message="对话已切换", parent=self).show()
+            return
+        mid = request_metrics.mid
+        logger.info('adopt reply: {} {}', request_metrics.model, mid)
+        self.add_message(text, is_send=False, mid=mid)
+        self.messages_comp[mid].finish()
+        self.messages_comp[mid].set_status(f'{request_metrics.model} · {request_metrics.summary()}')
+        self.messages_array.append({"role": "assistant", "content": text})
+        self.insert_message_to_db(mid, text, 0)
+        # 只有采用的回答计入对话的请求统计和用量，其余对比结果不入库
+        request_metrics.insert_to_db(self.db_file)
+        self.add_conversation_usage(request_metrics)
+        self.index_wt = WorkerThread(target=self.index_history)
+        self.index_wt.start()
+
     def send_message(self):
         model = self.get_model()
         if model is None or model.strip() == '':
             Toast(message="请填写模型名称", parent=self).show()
             return
         message_text = self.input_field.toPlainText()
-        if message_text:
+        self.last_activity = time.monotonic()
+        if message_text or self.attachments:
             input_mid = TSID.create().to_string()
-            self.add_message(message_text, is_send=True, mid=input_mid)
+            attachments = self.attachments
+            self.clear_attachments()
+            if message_text:
+                self.add_message(message_text, is_send=True, mid=input_mid)
+            self.add_images([path for path, _ in attachments])
             self.input_field.clear()
 
             self.insert_message_to_db(input_mid, message_text, 1)
 
-            logger.debug(f'问题:{message_text}')
+            logger.opt(lazy=True).debug('问题: {}', lambda: log_config.content(message_text))
+            if len(attachments) > 0:
+                # 图片处理完成后再加入 messages_array
+                self.wt = WorkerThread(target=self.send_attachments,
+                                       args=(model, input_mid, message_text, attachments, self.conversation_id,
+                                             self.messages_array, self.messages_comp))
+                self.wt.start()
+                return
             self.messages_array.append({"role": "user", "content": message_text})
             if self.client is None:
                 Toast(message='请选择配置', parent=self).show()
@@ -495,62 +784,145 @@ class MainWindow(QMainWindow):
             if len(self.messages_array) < 3:
                 self.init_c_list()
 
-            self.wt = WorkerThread(target=self.chat_completions, args=(model,))
+            # 回答写回发出请求的对话，期间切换对话也不会写错
+            self.wt = WorkerThread(target=self.chat_completions,
+                                   args=(model, self.conversation_id, self.messages_array, self.messages_comp))
             self.wt.start()
 
-    def add_message(self, message, is_send=True, mid=''):
+    def send_attachments(self, model, input_mid, message_text, pending, cid, messages_array, messages_comp):
+        try:
+            attachments = [self.preprocessor.result(path, p) for path, p in pending]
+            vision.insert_attachments(self.db_file, cid, input_mid, attachments)
+            self.invalidate_chat(cid)
+            content = vision.user_content(self.db_file, message_text, attachments)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            self.error_signal.emit('图片处理失败')
+            content = message_text
+        messages_array.append({"role": "user", "content": content})
+        if self.client is None:
+            self.error_signal.emit('请选择配置')
+            return
+        if len(messages_array) < 3:
+            self.c_list_refresh_signal.emit()
+        self.chat_completions(model, cid, messages_array, messages_comp)
+
+    def do_attach(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "添加图片", home_dir, vision.IMAGE_FILTER)
+        for path in paths:
+            try:
+                self.attachments.append((path, self.preprocessor.submit(path)))
+            except Exception as e:
+                logger.error(f'{traceback.format_exc()}')
+                Toast(message=f'无法读取图片: {os.path.basename(path)}', parent=self).show()
+        self.update_attachment_button()
+
+    def clear_attachments(self):
+        self.attachments = []
+        self.update_attachment_button()
+
+    def update_attachment_button(self):
+        self.attachment_button.setText(f'{len(self.attachments)} 张图片 ×')
+        self.attachment_button.setVisible(len(self.attachments) > 0)
+
+    def add_images(self, paths):
+        for path in paths:
+            bubble = self.chat_content_widget.new_message(path, ':ui/avatar.png', MessageType.Image, True)
+            self.chat_content_widget.add_message_item(bubble)
+        if len(paths) > 0:
+            QTimer.singleShot(100, self.scroll_to_bottom)
+
+    def add_message(self, message, is_send=True, mid='', emit_time=None, widget=None, messages_comp=None):
+        """
+        widget 和 messages_comp 默认是当前对话，流式回答可能落在已经切走、暂存着的对话上。
+        """
         avatar = ':ui/avatar.png' if is_send else ':ui/icon.png'
+        current = widget is None or widget is self.chat_content_widget
+        widget = self.chat_content_widget if widget is None else widget
+        messages_comp = self.messages_comp if messages_comp is None else messages_comp
 
         if message is None:
             message = ''
 
-        message_comp = self.messages_comp.get(mid, None)
+        message_comp = messages_comp.get(mid, None)
         if message_comp is None:
-            message_comp = BubbleMessage(message, avatar, Type=MessageType.Text, is_send=is_send)
-            self.chat_content_widget.add_message_item(message_comp)
-            self.messages_comp[mid] = message_comp
+            message_type = MessageType.Text if is_send else MessageType.Markdown
+            message_comp = widget.new_message(message, avatar, message_type, is_send)
+            widget.add_message_item(message_comp)
+            messages_comp[mid] = message_comp
         else:
             message_comp.append_text(message)
+        if emit_time is not None:
+            message_comp.mark_emit_time(emit_time)
 
-        QTimer.singleShot(100, self.scroll_to_bottom)
+        if current:
+            QTimer.singleShot(100, self.scroll_to_bottom)
 
     def get_model(self):
         return self.model_field.text()
 
-    def chat_completions(self, model):
-        completion = self.client.chat.completions.create(
-            model=model,
-            messages=self.messages_array,
-            stream=True
-        )
-        generated_text = ''
-        mid = None
-        for chunk in completion:
-            if len(chunk.choices) > 0:
-                chunk_text = chunk.choices[0].delta.content
-                if chunk_text is None:
-                    chunk_text = ''
-                generated_text += chunk_text
-                self.bubble_message_signal.emit({
-                    'text': chunk_text,
-                    'is_send': False,
-                    'mid': chunk.id,
-                })
-                if mid is None:
-                    mid = chunk.id
-        if mid is not None:
-            self.messages_array.append({"role": "assistant", "content": generated_text})
-            logger.debug(f'回答：{generated_text}')
-
-        self.insert_message_to_db(mid, generated_text, 0)
-
-    def insert_message_to_db(self, mid, content, send):
+    @profiling.profiled('chat_completions')
+    def chat_completions(self, model, cid, messages_array, messages_comp):
+        """
+        cid、messages_array、messages_comp 是发出请求时的对话，不读取可能已经切换的 self.conversation_id。
+        """
+        with logger.contextualize(request_id=TSID.create().to_string(), cid=cid, model=model):
+            self.stream_completion(model, cid, messages_array, messages_comp)
+
+    def stream_completion(self, model, cid, messages_array, messages_comp):
+        request_metrics = metrics.RequestMetrics(cid, model, self.gpt_config.get('endpoint'))
+        on_text = partial(self.emit_chunk, cid, messages_comp)
+        mid, generated_text = None, ''
+        # messages_array 只在末尾追加，系统提示词和历史消息保持不变，服务端的提示词缓存才能命中
+        try:
+            mid, generated_text = streaming.stream_chat(self.client, model, messages_array, on_text,
+                                                        request_metrics, on_retry=self.emit_retry)
+        except streaming.StreamInterrupted as e:
+            # 重试用尽，保留已经收到的部分回答
+            logger.error(f'{traceback.format_exc()}')
+            mid, generated_text = e.mid, e.text
+            request_metrics.error = str(e)
+            self.error_signal.emit('网络中断，已保存收到的部分回答')
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            request_metrics.error = str(e)
+            self.error_signal.emit(f'请求失败: {str(e)[0: 200]}')
+        finally:
+            # 失败的请求也记入统计
+            request_metrics.finish()
+            if mid is not None:
+                messages_array.append({"role": "assistant", "content": generated_text})
+                logger.opt(lazy=True).debug('回答: {}', lambda: log_config.content(generated_text))
+
+            # 写入时让这个对话暂存的会话失效，下次打开从数据库读取
+            self.insert_message_to_db(mid, generated_text, 0, cid)
+            # 没有收到回答时没有 mid，统计仍需要一个
+            request_metrics.mid = mid if mid is not None else TSID.create().to_string()
+            self.metrics_signal.emit(request_metrics)
+
+    def emit_chunk(self, cid, messages_comp, mid, text):
+        self.bubble_message_signal.emit({
+            'text': text,
+            'is_send': False,
+            'mid': mid,
+            'emit_time': time.perf_counter(),
+            'cid': cid,
+            'messages_comp': messages_comp,
+        })
+
+    def emit_retry(self, attempt, delay, error):
+        self.status_signal.emit(f'连接中断，{delay:.0f} 秒后重试({attempt}/{streaming.MAX_RETRIES})...',
+                                int((delay + streaming.STALL_TIMEOUT) * 1000))
+
+    def insert_message_to_db(self, mid, content, send, cid=None):
+        cid = self.conversation_id if cid is None else cid
         if mid is not None:
+            self.invalidate_chat(cid)
             conn = sqlite3.connect(self.db_file)
             c = conn.cursor()
             try:
                 sql = """insert into chat_message(ID, CID, MID, CONTENT, SEND, CREATETIME) values (?,?,?,?,?,?)"""
-                c.execute(sql, (TSID.create().number, self.conversation_id, mid, content, send, datetime.now()))
+                c.execute(sql, (TSID.create().number, cid, mid, content, send, datetime.now()))
                 conn.commit()
             except Exception as e:
                 logger.error(f'{traceback.format_exc()}')
@@ -559,83 +931,439 @@ class MainWindow(QMainWindow):
                 conn.close()
 
     def delete_clist_button_clicked(self):
-        item = self.c_list.currentItem()
-        if item is None:
+        index = self.c_list.currentIndex()
+        if not index.isValid():
             Toast(message="请选择要删除的对话", parent=self).show()
             return
-        ret = QMessageBox.warning(self, '提示', f'确认删除对话【{item.text()}】?',
+        ret = QMessageBox.warning(self, '提示', f'确认删除对话【{index.data()}】?',
                                   buttons=QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if ret == QMessageBox.StandardButton.Yes:
-            cid = item.data(QListWidgetItem.ItemType.UserType)
+            cid = index.data(CID_ROLE)
             self.wt = WorkerThread(target=self.delete_c_list, args=(cid,))
             self.wt.start()
 
     def c_list_double_clicked(self, qModelIndex):
-        item = self.c_list.item(qModelIndex.row())
-        cid = item.data(QListWidgetItem.ItemType.UserType)
-        logger.info(f'c_list double clicked : {cid}')
-        self.wt = WorkerThread(target=self.fetch_chat, args=(cid,))
-        self.wt.start()
-        pass
-
-    def chat_update(self, data: str):
-        result = json.loads(data)
-        cid = result['cid']
-        data_ = result['data']
-        logger.info(f'chat update : {cid}')
+        cid = qModelIndex.data(CID_ROLE)
+        logger.info('c_list double clicked : {}', cid)
+        self.open_chat(cid)
+
+    def c_list_entered(self, index):
+        self.hovered_cid = index.data(CID_ROLE)
+        self.prefetch_timer.start(PREFETCH_HOVER_MS)
+
+    def c_list_current_changed(self, current, previous):
+        if current.isValid():
+            self.prefetch_chat(current.data(CID_ROLE))
+
+    def prefetch_hovered(self):
+        # 指针已经离开列表时 entered 不会再触发，这里再确认一次
+        index = self.c_list.indexAt(self.c_list.viewport().mapFromGlobal(QCursor.pos()))
+        if index.isValid() and index.data(CID_ROLE) == self.hovered_cid:
+            self.prefetch_chat(self.hovered_cid)
+
+    def prefetch_chat(self, cid):
+        if cid is not None and cid != self.conversation_id and cid not in self.sessions:
+            self.prefetcher.request(cid)
+
+    @profiling.profiled('chat_update')
+    def chat_update(self, history: database.ChatHistory):
+        cid = history.cid
+        summaries = history.summaries
+        logger.info('chat update : {}', cid)
+        self.last_activity = time.monotonic()
         self.init_new_chat(cid)
-        for row in data_:
-            send = row['SEND']
-            content = row['CONTENT']
-            mid = row['MID']
-            self.add_message(content, is_send=True if send == 1 else False, mid=mid)
+        self.set_conversation_usage(history.usage)
+        for mid, content, send in history.messages:
+            attachments = history.attachments.get(mid, [])
+            if content or not attachments:
+                self.add_message(content, is_send=True if send == 1 else False, mid=mid)
+                self.messages_comp[mid].finish()
+                if mid in summaries:
+                    self.messages_comp[mid].set_status(summaries[mid])
+            self.add_images([vision.blob_path(self.db_file, a.hash) for a in attachments])
             if send == 1:
-                self.messages_array.append({"role": "user", "content": content})
+                self.messages_array.append({"role": "user",
+                                            "content": vision.user_content(self.db_file, content, attachments)})
             else:
                 self.messages_array.append({"role": "assistant", "content": content})
-        pass
+        profiling.profiler.snapshot_later(f'open {cid}')
 
-    def c_list_update(self, data: str):
-        result = json.loads(data)
-        self.c_list.clear()
-        for row in result:
-            cid = row['CID']
-            content = row['CONTENT'][0: 20]
-            item = QListWidgetItem()
-            item.setText(content)
-            item.setData(QListWidgetItem.ItemType.UserType, cid)
-            self.c_list.addItem(item)
-        pass
+    def c_list_update(self, conversations: list):
+        self.c_list_model.set_rows(conversations)
 
     def bubble_message_update(self, data: dict):
         text = data['text']
         is_send = data['is_send']
         mid = data['mid']
-        self.add_message(text, is_send, mid)
+        self.last_activity = time.monotonic()
+        if 'cid' not in data:
+            self.add_message(text, is_send, mid, data.get('emit_time'))
+            return
+        widget = self.chat_widget_of(data['cid'], data['messages_comp'])
+        if widget is not None:
+            self.add_message(text, is_send, mid, data.get('emit_time'), widget, data['messages_comp'])
+
+    def chat_widget_of(self, cid, messages_comp):
+        """
+        返回 messages_comp 所在的 ChatWidget：当前对话或暂存的会话。会话已被回收时返回 None，
+        回答只写入数据库，下次打开时读取。
+        """
+        if cid == self.conversation_id and messages_comp is self.messages_comp:
+            return self.chat_content_widget
+        session = self.sessions.items.get(cid)
+        if session is not None and session.messages_comp is messages_comp:
+            return session.widget
+        return None
+
+    def metrics_update(self, request_metrics: metrics.RequestMetrics):
+        message_comp = self.messages_comp.get(request_metrics.mid, None)
+        if message_comp is not None:
+            message_comp.finish()
+            request_metrics.render_lags = list(message_comp.render_lags())
+            message_comp.set_status(request_metrics.summary())
+        logger.opt(lazy=True).info('request metrics : {}', request_metrics.summary)
+        request_metrics.insert_to_db(self.db_file)
+        self.invalidate_chat(request_metrics.cid)
+        if request_metrics.cid == self.conversation_id:
+            self.add_conversation_usage(request_metrics)
+        self.index_wt = WorkerThread(target=self.index_history)
+        self.index_wt.start()
+
+    def add_conversation_usage(self, request_metrics: metrics.RequestMetrics):
+        if request_metrics.prompt_tokens is not None:
+            self.set_conversation_usage([total + (value or 0) for total, value in zip(
+                self.conversation_usage, (request_metrics.prompt_tokens, request_metrics.cached_tokens,
+                                          request_metrics.completion_tokens))])
+
+    def set_conversation_usage(self, usage):
+        self.conversation_usage = list(usage)
+        self.usage_label.setText(metrics.format_usage(self.conversation_usage))
+
+    def show_metrics(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("请求统计")
+        dialog.setMinimumSize(900, 300)
+        layout = QVBoxLayout(dialog)
+
+        headers = ["模型", "端点", "次数", "失败", "首字 p50(ms)", "首字 p95(ms)", "tok/s p50", "tok/s p95",
+                   "总耗时 p50(ms)", "总耗时 p95(ms)", "缓存命中(%)"]
+        keys = ['model', 'endpoint', 'count', 'errors', 'ttft_p50', 'ttft_p95', 'tps_p50', 'tps_p95', 'total_p50', 'total_p95',
+                'cache_ratio']
+        rows = metrics.aggregate(self.db_file)
+        table = QTableWidget(len(rows), len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        for i, row in enumerate(rows):
+            for j, key in enumerate(keys):
+                value = row[key]
+                text = '-' if value is None else (f'{value:.1f}' if isinstance(value, float) else str(value))
+                table.setItem(i, j, QTableWidgetItem(text))
+        layout.addWidget(table)
+
+        dialog.exec()
 
     def scroll_to_bottom(self):
         self.chat_content_widget.set_scroll_bar_last()
 
+    def do_export(self):
+        path, selected = QFileDialog.getSaveFileName(
+            self, "导出对话", home_dir + "/chatgpt_export.jsonl",
+            "JSONL (*.jsonl *.jsonl.gz);;Markdown (*.md *.md.gz);;HTML (*.html *.html.gz)")
+        if not path:
+            return
+        fmt = export.guess_format(path) or {'J': 'jsonl', 'M': 'md', 'H': 'html'}[selected[0]]
+        logger.info(f'export: {path} ({fmt})')
+        self.export_wt = WorkerThread(target=self.export_chat, args=(path, fmt))
+        self.export_wt.start()
+
+    def export_chat(self, path, fmt):
+        try:
+            export.export(self.db_file, path, fmt, progress=self.export_signal.emit)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            self.export_signal.emit(-1, -1)
+
+    def export_update(self, done, total):
+        if done < 0:
+            self.ui.statusbar.showMessage("导出失败", 5000)
+        elif done >= total:
+            self.ui.statusbar.showMessage(f"导出完成: {done} 条", 5000)
+        else:
+            self.ui.statusbar.showMessage(f"正在导出: {done}/{total}")
+
+    def do_import(self):
+        path, _ = QFileDialog.getOpenFileName(self, "导入 ChatGPT 数据导出", home_dir,
+                                              "ChatGPT export (*.zip conversations.json *.json)")
+        if not path:
+            return
+        logger.info(f'import: {path}')
+        self.import_wt = WorkerThread(target=self.import_chat, args=(path,))
+        self.import_wt.start()
+
+    def import_chat(self, path):
+        try:
+            imported = importer.Importer(self.db_file, progress=self.import_signal.emit).run(path)
+            self.import_signal.emit(imported, -1)
+            self.invalidate_chat()
+            self.fetch_c_list()
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            self.import_signal.emit(-1, -1)
+
+    def import_update(self, imported, skipped):
+        if imported < 0:
+            self.ui.statusbar.showMessage("导入失败", 5000)
+        elif skipped < 0:
+            self.ui.statusbar.showMessage(f"导入完成: {imported} 个对话", 5000)
+        else:
+            self.ui.statusbar.showMessage(f"正在导入: {imported} 个对话, 跳过 {skipped} 个")
+
+    def is_idle(self):
+        if time.monotonic() - self.last_activity < IDLE_SECONDS:
+            return False
+        return all(t is self.maintenance_wt for t in list(WorkerThread.running))
+
+    def maintain_database(self):
+        if not self.is_idle():
+            return
+        self.maintenance_wt = WorkerThread(target=self.run_maintenance)
+        self.maintenance_wt.start()
+
+    def run_maintenance(self):
+        try:
+            stats = maintenance.run(self.db_file, should_stop=lambda: not self.is_idle())
+            self.maintenance_signal.emit(stats)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+        self.index_history(should_stop=lambda: not self.is_idle())
+
+    def maintenance_update(self, stats):
+        self.db_status_label.setText(maintenance.format_stats(stats))
+
+    def index_history(self, should_stop=None):
+        try:
+            self.vector_index.index_pending(should_stop=should_stop)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+
+    def do_search(self):
+        text = self.search_field.text().strip()
+        if text == '':
+            return
+        self.ui.statusbar.showMessage("正在搜索...")
+        self.search_wt = WorkerThread(target=self.search_history, args=(text,))
+        self.search_wt.start()
+
+    def search_history(self, text):
+        try:
+            # 只搜索已有的向量：新回答写入后即索引，积压的历史消息由空闲时的维护任务补上
+            start = time.perf_counter()
+            results = self.vector_index.search(text, k=20)
+            logger.info('search: {} results in {:.0f} ms', len(results), (time.perf_counter() - start) * 1000)
+            self.search_signal.emit(results)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            self.search_signal.emit(None)
+
+    def search_update(self, results):
+        if results is None:
+            self.ui.statusbar.showMessage("搜索失败", 5000)
+            return
+        self.ui.statusbar.clearMessage()
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f'搜索: {self.search_field.text()}')
+        dialog.resize(600, 400)
+        layout = QVBoxLayout(dialog)
+        list_widget = QListWidget()
+        for result in results:
+            snippet = ' '.join(result.content.split())[0: 80]
+            item = QListWidgetItem(f'{result.score:.2f}  {"问" if result.send == 1 else "答"}: {snippet}')
+            item.setData(Qt.ItemDataRole.UserRole, result.cid)
+            item.setToolTip(result.content[0: 500])
+            list_widget.addItem(item)
+        list_widget.itemDoubleClicked.connect(partial(self.open_search_result, dialog))
+        layout.addWidget(list_widget)
+        dialog.show()
+
+    def open_search_result(self, dialog: QDialog, item: QListWidgetItem):
+        cid = item.data(Qt.ItemDataRole.UserRole)
+        logger.info(f'open search result : {cid}')
+        self.open_chat(cid)
+        dialog.close()
+
+    def show_jobs(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("批处理任务")
+        dialog.setMinimumSize(900, 300)
+        layout = QVBoxLayout(dialog)
+
+        buttons = QHBoxLayout()
+        submit_conversations = QPushButton("提交选中对话")
+        submit_conversations.setToolTip("选中对话的完整上下文各作为一个请求，回答追加到原对话")
+        submit_conversations.clicked.connect(self.do_batch_conversations)
+        buttons.addWidget(submit_conversations)
+        submit_prompts = QPushButton("提交提示词文件")
+        submit_prompts.setToolTip("JSONL 每行一个提示词(与 batch.py 相同的格式)，每条一个新对话")
+        submit_prompts.clicked.connect(self.do_batch_prompts)
+        buttons.addWidget(submit_prompts)
+        refresh_button = QPushButton("刷新")
+        refresh_button.clicked.connect(self.poll_jobs)
+        buttons.addWidget(refresh_button)
+        cancel_button = QPushButton("取消任务")
+        cancel_button.clicked.connect(self.cancel_job)
+        buttons.addWidget(cancel_button)
+        buttons.addStretch()
+        layout.addLayout(buttons)
+
+        self.jobs_table = QTableWidget(0, 6)
+        self.jobs_table.setHorizontalHeaderLabels(["任务", "配置", "模型", "状态", "进度(完成/失败/总数)", "创建时间"])
+        self.jobs_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.jobs_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.jobs_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        layout.addWidget(self.jobs_table)
+        dialog.finished.connect(lambda _: setattr(self, 'jobs_table', None))
+
+        self.jobs_update(batch_job.list_jobs(self.db_file))
+        dialog.show()
+        self.poll_jobs()
+
+    def do_batch_conversations(self):
+        cids = [index.data(CID_ROLE) for index in self.c_list.selectionModel().selectedRows()]
+        if len(cids) == 0:
+            Toast(message="请先在左侧列表中选择对话(可多选)", parent=self).show()
+            return
+        self.submit_batch(batch_job.conversation_items, self.db_file, cids)
+
+    def do_batch_prompts(self):
+        path, _ = QFileDialog.getOpenFileName(self, "选择提示词文件", home_dir, "JSONL (*.jsonl)")
+        if not path:
+            return
+        self.submit_batch(lambda p: batch_job.prompt_items(item for _, item in batch.read_prompts(p)), path)
+
+    def submit_batch(self, build_items, *args):
+        if self.client is None:
+            Toast(message='请先添加配置', parent=self).show()
+            return
+        self.ui.statusbar.showMessage("批处理任务提交中...")
+        self.jobs_wt = WorkerThread(target=self.run_submit_batch,
+                                    args=(self.client, dict(self.gpt_config), self.get_model(), build_items, args))
+        self.jobs_wt.start()
+
+    def run_submit_batch(self, client, gpt_config, model, build_items, args):
+        try:
+            items = build_items(*args)
+            if len(items) == 0:
+                self.jobs_signal.emit(None)
+                return
+            batch_job.submit(client, self.db_file, gpt_config.get('name'), gpt_config, model, items)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            self.jobs_signal.emit(None)
+            return
+        self.refresh_jobs()
+
+    def cancel_job(self):
+        if self.jobs_table is None or self.jobs_table.currentRow() < 0:
+            return
+        job_id = self.jobs_table.item(self.jobs_table.currentRow(), 0).text()
+        logger.info(f'cancel batch job : {job_id}')
+        self.jobs_wt = WorkerThread(target=self.run_cancel_job, args=(job_id,))
+        self.jobs_wt.start()
+
+    def run_cancel_job(self, job_id):
+        try:
+            job = next(job for job in batch_job.list_jobs(self.db_file) if job.id == job_id)
+            batch_job.cancel(config.make_client(self.read_gpt_config()[job.config]), self.db_file, job_id)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+        self.refresh_jobs()
+
+    def poll_jobs(self):
+        self.poll_wt = WorkerThread(target=self.refresh_jobs)
+        self.poll_wt.start()
+
+    def refresh_jobs(self):
+        imported = 0
+        try:
+            configs = self.read_gpt_config()
+            for job in batch_job.list_jobs(self.db_file, pending_only=True):
+                gpt_config = configs.get(job.config)
+                if gpt_config is None:
+                    logger.warning(f'batch job {job.id}: config {job.config} not found')
+                    continue
+                with logger.contextualize(batch_job=job.id):
+                    imported += batch_job.refresh(config.make_client(gpt_config), self.db_file, job.id)
+            self.jobs_signal.emit(batch_job.list_jobs(self.db_file))
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+        if imported > 0:
+            self.invalidate_chat()
+            self.fetch_c_list()
+
+    def jobs_update(self, jobs):
+        if jobs is None:
+            self.ui.statusbar.showMessage("提交批处理任务失败", 5000)
+            return
+        pending = [job for job in jobs if job.status not in batch_job.FINAL_STATUSES]
+        if len(pending) > 0:
+            self.ui.statusbar.showMessage(f"批处理任务进行中: {len(pending)} 个")
+        elif self.ui.statusbar.currentMessage().startswith("批处理"):
+            self.ui.statusbar.clearMessage()
+        if self.jobs_table is None:
+            return
+        self.jobs_table.setRowCount(len(jobs))
+        for i, job in enumerate(jobs):
+            values = [job.id, job.config, job.model, job.status + ('' if job.imported == 0 else ' (已导入)'),
+                      f'{job.completed}/{job.failed}/{job.total}', str(job.createtime)[0: 19]]
+            for j, value in enumerate(values):
+                self.jobs_table.setItem(i, j, QTableWidgetItem(value))
+
+    def diagnostics_menu(self, parent):
+        menu = QMenu(parent)
+        for name in profiling.OPERATIONS:
+            action = menu.addAction(f'分析 {name}')
+            action.setCheckable(True)
+            action.setChecked(name in profiling.profiler.active)
+            action.toggled.connect(partial(profiling.profiler.enable, name))
+        menu.addSeparator()
+        action = menu.addAction('跟踪内存(切换对话时快照)')
+        action.setCheckable(True)
+        action.setChecked(profiling.tracemalloc.is_tracing())
+        action.toggled.connect(lambda on: profiling.profiler.start_memory() if on else profiling.profiler.stop_memory())
+        menu.addAction('内存快照').triggered.connect(self.memory_snapshot)
+        menu.addSeparator()
+        menu.addAction('写出分析报告').triggered.connect(self.dump_profile)
+        menu.addAction('打开日志目录').triggered.connect(
+            lambda: QDesktopServices.openUrl(QUrl.fromLocalFile(profiling.profiler.log_dir)))
+        return menu
+
+    def memory_snapshot(self):
+        if not profiling.tracemalloc.is_tracing():
+            Toast(message='请先开启内存跟踪', parent=self).show()
+            return
+        profiling.profiler.snapshot_later('manual')
+        self.ui.statusbar.showMessage(f'正在写出内存快照到 {profiling.profiler.log_dir}', 5000)
+
+    def dump_profile(self):
+        paths = profiling.profiler.dump()
+        if len(paths) == 0:
+            Toast(message='还没有分析数据，请先在菜单中开启要分析的操作', parent=self).show()
+            return
+        self.ui.statusbar.showMessage(f'已写出 {len(paths)} 个报告到 {profiling.profiler.log_dir}', 5000)
+
     def read_gpt_config(self):
-        json_data = {}
-        config_path = home_dir + "/chatgpt_local.config"
-        if not os.path.exists(config_path):
-            self.write_gpt_config({})
-            return json_data
-        with open(config_path, 'r+', encoding='utf-8') as f:
-            content = f.read()
-            if content.strip() == '':
-                content = '{}'
-            json_data = json.loads(content)
-        return json_data
-
-    def write_gpt_config(self, config):
-        config_path = home_dir + "/chatgpt_local.config"
-        with open(config_path, 'w+', encoding='utf-8') as f:
-            f.write(json.dumps(config))
+        return config.read_gpt_config()
+
+    def write_gpt_config(self, config_):
+        config.write_gpt_config(config_)
 
 
 if __name__ == '__main__':
+    # 打包后图片预处理的子进程也从这个入口启动，在这里转去运行子进程的任务
+    multiprocessing.freeze_support()
+    log_config.setup_logging(home_dir)
+    profiling.profiler.setup(home_dir, os.environ.get(profiling.ENV))
     app = QApplication(sys.argv)
     qdarktheme.setup_theme(theme="light")
     window = MainWindow()
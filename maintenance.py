@@ -0,0 +1,137 @@
+"""
+数据库维护：压缩旧对话、统计信息更新、增量回收空闲页、WAL 检查点。
+
+界面在空闲时定期调用 run()，也可以手动执行：
+python maintenance.py
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from loguru import logger
+
+import compression
+import vision
+
+AUTO_VACUUM_INCREMENTAL = 2
+# 每次 incremental_vacuum 回收的页数，单个事务保持很短，不阻塞界面写入
+VACUUM_PAGES = 512
+VACUUM_STEPS = 64
+# 压缩节省的字节超过文件大小的这个比例时执行一次完整 VACUUM
+REBUILD_RATIO = 0.25
+
+
+def db_stats(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        page_size = conn.execute("pragma page_size").fetchone()[0]
+        page_count = conn.execute("pragma page_count").fetchone()[0]
+        freelist_count = conn.execute("pragma freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("pragma auto_vacuum").fetchone()[0]
+    finally:
+        conn.close()
+    wal_file = db_file + '-wal'
+    return {
+        'size': os.path.getsize(db_file),
+        'wal_size': os.path.getsize(wal_file) if os.path.exists(wal_file) else 0,
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist_count,
+        'auto_vacuum': auto_vacuum,
+    }
+
+
+def format_size(size):
+    """
+    >>> format_size(512)
+    '512 B'
+    >>> format_size(3 * 1024 * 1024 + 100)
+    '3.0 MB'
+    """
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f'{size} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+def format_stats(stats):
+    """
+    >>> format_stats({'size': 4096 * 100, 'wal_size': 0, 'page_size': 4096, 'page_count': 100, 'freelist_count': 25})
+    '数据库 400.0 KB · 空闲页 25 (25.0%)'
+    """
+    free = stats['freelist_count'] / stats['page_count'] if stats['page_count'] > 0 else 0
+    text = f"数据库 {format_size(stats['size'])} · 空闲页 {stats['freelist_count']} ({free:.1%})"
+    if stats['wal_size'] > 0:
+        text += f" · WAL {format_size(stats['wal_size'])}"
+    return text
+
+
+def enable_incremental_vacuum(conn):
+    """
+    已有数据库切换 auto_vacuum 需要整库 VACUUM 一次，之后只需增量回收。
+    """
+    if conn.execute("pragma auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        return False
+    start = time.perf_counter()
+    conn.execute("pragma auto_vacuum = incremental")
+    conn.execute("vacuum")
+    logger.info(f'auto_vacuum switched to incremental in {(time.perf_counter() - start) * 1000:.0f} ms')
+    return True
+
+
+def analyze(conn):
+    has_stat = conn.execute("select 1 from sqlite_master where name = 'sqlite_stat1'").fetchone()
+    if has_stat is None:
+        conn.execute("analyze")
+    else:
+        conn.execute("pragma optimize")
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES, steps=VACUUM_STEPS, should_stop=None):
+    freed = 0
+    for _ in range(steps):
+        before = conn.execute("pragma freelist_count").fetchone()[0]
+        if before == 0 or (should_stop is not None and should_stop()):
+            break
+        # execute() 只 step 一次(每次释放一页)，executescript 会执行到结束
+        conn.executescript(f"pragma incremental_vacuum({int(pages)});")
+        freed += before - conn.execute("pragma freelist_count").fetchone()[0]
+    return freed
+
+
+def run(db_file, pages=VACUUM_PAGES, steps=VACUUM_STEPS, should_stop=None):
+    """
+    执行一轮维护并返回维护后的 db_stats()。should_stop() 返回 True 时尽快结束。
+    """
+    start = time.perf_counter()
+    # 先压缩旧对话，腾出的溢出页随后由增量 VACUUM 回收
+    _, saved = compression.compress_old(db_file, should_stop=should_stop)
+    vision.purge_orphans(db_file)
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        if not enable_incremental_vacuum(conn) and saved > os.path.getsize(db_file) * REBUILD_RATIO:
+            # 页内的空隙不会进入空闲列表，压缩节省较多时整库重建一次
+            rebuild_start = time.perf_counter()
+            conn.execute("vacuum")
+            logger.info(f'vacuum after compression in {(time.perf_counter() - rebuild_start) * 1000:.0f} ms')
+        analyze(conn)
+        freed = incremental_vacuum(conn, pages, steps, should_stop)
+        conn.execute("pragma wal_checkpoint(truncate)").fetchall()
+    finally:
+        conn.close()
+    stats = db_stats(db_file)
+    logger.info(f'db maintenance: freed {freed} pages in {(time.perf_counter() - start) * 1000:.0f} ms, '
+                f'{format_stats(stats)}')
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='数据库维护')
+    parser.add_argument('--db', default=os.path.expanduser('~') + '/chatgpt_local.db')
+    parser.add_argument('--steps', type=int, default=VACUUM_STEPS)
+    args = parser.parse_args()
+
+    print(format_stats(db_stats(args.db)))
+    print(format_stats(run(args.db, steps=args.steps)))
@@ -0,0 +1,213 @@
+"""
+Markdown 增量渲染。
+
+流式输出时只有末尾未完成的块会变化，已完成的块交给后台线程解析成 QTextDocument，
+UI 线程只负责把完成的片段拼接到文档中。代码块的高亮结果按内容哈希缓存。
+"""
+import hashlib
+import html
+import re
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QCoreApplication
+from PySide6.QtGui import QTextDocument
+from loguru import logger
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)')
+
+
+def split_blocks(text):
+    """
+    把文本切分为已完成的 Markdown 块，返回 (blocks, consumed)，text[consumed:] 为未完成的尾部。
+    空行结束普通块，闭合的围栏结束代码块。
+
+    >>> split_blocks('a\\nb\\n\\nc')
+    (['a\\nb\\n\\n'], 5)
+    >>> split_blocks('```py\\nx = 1\\n\\ny = 2\\n```\\nrest')
+    (['```py\\nx = 1\\n\\ny = 2\\n```\\n'], 23)
+    >>> split_blocks('```py\\nx = 1\\n')
+    ([], 0)
+    >>> split_blocks('para\\n```\\ncode\\n```\\n')
+    (['para\\n', '```\\ncode\\n```\\n'], 18)
+    """
+    blocks = []
+    consumed = 0
+    start = 0
+    fence = None
+    pos = 0
+    while True:
+        end = text.find('\n', pos)
+        if end < 0:
+            break
+        line = text[pos:end]
+        next_pos = end + 1
+        if fence is not None:
+            if line.strip().startswith(fence) and line.strip().strip(fence[0]) == '':
+                fence = None
+                blocks.append(text[start:next_pos])
+                consumed = start = next_pos
+        else:
+            match = FENCE_RE.match(line)
+            if match:
+                if start < pos:
+                    blocks.append(text[start:pos])
+                    consumed = pos
+                start = pos
+                fence = match.group(1)
+            elif line.strip() == '':
+                if start < pos:
+                    blocks.append(text[start:next_pos])
+                consumed = start = next_pos
+        pos = next_pos
+    return blocks, consumed
+
+
+KEYWORDS = {
+    'False', 'None', 'True', 'and', 'as', 'assert', 'async', 'await', 'break', 'case', 'catch', 'class', 'const',
+    'continue', 'def', 'default', 'defer', 'del', 'do', 'elif', 'else', 'enum', 'export', 'extends', 'final',
+    'finally', 'fn', 'for', 'from', 'func', 'function', 'global', 'go', 'if', 'impl', 'implements', 'import', 'in',
+    'interface', 'is', 'lambda', 'let', 'match', 'mut', 'new', 'nil', 'nonlocal', 'not', 'null', 'or', 'package',
+    'pass', 'private', 'protected', 'pub', 'public', 'raise', 'return', 'self', 'static', 'struct', 'super', 'switch',
+    'this', 'throw', 'throws', 'trait', 'try', 'type', 'typeof', 'undefined', 'use', 'var', 'void', 'while', 'with',
+    'yield', 'true', 'false', 'int', 'str', 'bool', 'float', 'string', 'select', 'from', 'where',
+}
+
+TOKEN_RE = re.compile(r'''
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/|--[^\n]*)
+  | (?P<string>"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`[^`]*`)
+  | (?P<number>\b\d+(?:\.\d+)?\b)
+  | (?P<word>\b[A-Za-z_][A-Za-z0-9_]*\b)
+''', re.VERBOSE | re.DOTALL)
+
+TOKEN_COLORS = {
+    'comment': '#6a737d',
+    'string': '#032f62',
+    'number': '#005cc5',
+    'keyword': '#d73a49',
+}
+
+CODE_BACKGROUND = '#f6f8fa'
+
+
+def highlight_code(code, lang=''):
+    """
+    简单的正则高亮, 不区分语言, 输出 HTML。
+
+    >>> highlight_code('x = 1  # one').count('<span')
+    2
+    >>> highlight_code('if a < b: pass')
+    '<pre style="background-color:#f6f8fa;"><span style="color:#d73a49;">if</span> a &lt; b: \
+<span style="color:#d73a49;">pass</span></pre>'
+    """
+    parts = []
+    pos = 0
+    for match in TOKEN_RE.finditer(code):
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'word':
+            if value not in KEYWORDS:
+                continue
+            kind = 'keyword'
+        parts.append(html.escape(code[pos:match.start()]))
+        parts.append(f'<span style="color:{TOKEN_COLORS[kind]};">{html.escape(value)}</span>')
+        pos = match.end()
+    parts.append(html.escape(code[pos:]))
+    return f'<pre style="background-color:{CODE_BACKGROUND};">{"".join(parts)}</pre>'
+
+
+def parse_fence(block):
+    """
+    >>> parse_fence('```python\\nprint(1)\\n```\\n')
+    ('python', 'print(1)')
+    >>> parse_fence('text') is None
+    True
+    """
+    lines = block.rstrip('\n').split('\n')
+    match = FENCE_RE.match(lines[0])
+    if match is None:
+        return None
+    body = lines[1:]
+    if len(body) > 0 and body[-1].strip().startswith(match.group(1)[0] * 3):
+        body = body[:-1]
+    return match.group(2), '\n'.join(body)
+
+
+class HighlightCache:
+    """
+    代码块高亮结果(HTML)的 LRU 缓存, 键为代码内容的哈希。
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+code_cache = HighlightCache()
+
+
+def highlight_block(lang, code):
+    key = hashlib.sha1(f'{lang}\0{code}'.encode('utf-8')).hexdigest()
+    value = code_cache.get(key)
+    if value is None:
+        value = highlight_code(code, lang)
+        code_cache.put(key, value)
+    return value
+
+
+def render_block(block) -> QTextDocument:
+    document = QTextDocument()
+    fence = parse_fence(block)
+    if fence is None:
+        document.setMarkdown(block)
+    else:
+        document.setHtml(highlight_block(*fence))
+    return document
+
+
+class MarkdownRenderer:
+    """
+    单个后台线程按提交顺序渲染块, 结果通过回调(通常是跨线程的 Signal.emit)送回 UI 线程。
+    渲染好的 QTextDocument 在交出前移到 UI 线程, UI 线程只需拷贝片段。
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='markdown')
+
+    def submit(self, block, callback, *args):
+        self.executor.submit(self._render, block, callback, args)
+
+    @staticmethod
+    def _render(block, callback, args):
+        try:
+            document = render_block(block)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            document = QTextDocument()
+            document.setPlainText(block)
+        document.moveToThread(QCoreApplication.instance().thread())
+        try:
+            callback(*args, document)
+        except RuntimeError:
+            # 接收方控件已被销毁
+            pass
+
+
+renderer = MarkdownRenderer()
@@ -0,0 +1,298 @@
+import math
+import sqlite3
+import time
+import traceback
+from datetime import datetime
+
+from loguru import logger
+
+from tsid import TSID
+
+CREATE_TABLE_SQL = """
+create table if not exists request_metrics (
+    ID INTEGER PRIMARY KEY NOT NULL,
+    CID TEXT NOT NULL,
+    MID TEXT NOT NULL,
+    MODEL TEXT NOT NULL,
+    ENDPOINT TEXT NOT NULL,
+    CONNECT_MS REAL,
+    TTFT_MS REAL,
+    GAP_AVG_MS REAL,
+    GAP_MAX_MS REAL,
+    TOTAL_MS REAL,
+    TOKENS INTEGER NOT NULL,
+    TPS REAL,
+    RENDER_LAG_MS REAL,
+    CREATETIME DATETIME NOT NULL
+)
+"""
+
+# 后加的列，旧数据库在 init_database 时补上
+USAGE_COLUMNS = ['PROMPT_TOKENS', 'COMPLETION_TOKENS', 'CACHED_TOKENS']
+# 请求失败时的错误信息，成功为 NULL
+ERROR_COLUMN = 'ERROR'
+# 流式请求带上它，最后一个分片(choices 为空)中返回 usage
+STREAM_OPTIONS = {"include_usage": True}
+
+
+def migrate(cursor):
+    columns = {row[1] for row in cursor.execute("pragma table_info(request_metrics)").fetchall()}
+    for column in USAGE_COLUMNS:
+        if column not in columns:
+            cursor.execute(f"alter table request_metrics add column {column} INTEGER")
+    if ERROR_COLUMN not in columns:
+        cursor.execute(f"alter table request_metrics add column {ERROR_COLUMN} TEXT")
+
+
+def percentile(values, p):
+    """
+    Linear interpolated percentile of a list of numbers, None if empty.
+    >>> percentile([1, 2, 3, 4], 50)
+    2.5
+    >>> percentile([10], 95)
+    10
+    >>> percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = math.floor(k)
+    c = math.ceil(k)
+    if f == c:
+        return values[int(k)]
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class RequestMetrics:
+    """
+    单次流式请求的耗时统计，在工作线程中记录，渲染延迟由 UI 线程补充。
+    输出 token 数取服务端 usage 中的 completion_tokens，不返回 usage 的服务按一个流式分片一个 token 估算。
+    """
+
+    def __init__(self, cid, model, endpoint):
+        self.cid = cid
+        self.mid = None
+        self.model = model
+        self.endpoint = endpoint or ''
+        self.start = time.perf_counter()
+        self.connect_time = None
+        self.first_token_time = None
+        self.end_time = None
+        self.last_chunk_time = None
+        self.gaps = []
+        self.chunks = 0
+        self.render_lags = []
+        # 服务端返回的 usage，不支持 stream_options 的服务为 None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cached_tokens = None
+        # 请求失败或中断时的错误信息
+        self.error = None
+
+    def connected(self):
+        self.connect_time = time.perf_counter() - self.start
+
+    def chunk(self, text):
+        now = time.perf_counter()
+        if not text:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = now - self.start
+        else:
+            self.gaps.append(now - self.last_chunk_time)
+        self.last_chunk_time = now
+        self.chunks += 1
+
+    def usage(self, usage):
+        # 断线续写时一个回答对应多次请求，用量累加
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        self.prompt_tokens = (self.prompt_tokens or 0) + usage.prompt_tokens
+        self.completion_tokens = (self.completion_tokens or 0) + usage.completion_tokens
+        self.cached_tokens = (self.cached_tokens or 0) + cached_tokens
+
+    def finish(self):
+        self.end_time = time.perf_counter() - self.start
+
+    @property
+    def tokens(self):
+        return self.completion_tokens if self.completion_tokens is not None else self.chunks
+
+    @property
+    def tokens_per_sec(self):
+        if self.first_token_time is None or self.end_time is None or self.chunks < 2:
+            return None
+        duration = self.end_time - self.first_token_time
+        return self.tokens / duration if duration > 0 else None
+
+    @property
+    def render_lag(self):
+        return percentile(self.render_lags, 95)
+
+    def to_dict(self):
+        return {
+            'connect_ms': _ms(self.connect_time),
+            'ttft_ms': _ms(self.first_token_time),
+            'gap_max_ms': _ms(max(self.gaps)) if self.gaps else None,
+            'total_ms': _ms(self.end_time),
+            'tokens': self.tokens,
+            'tps': self.tokens_per_sec,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'error': self.error,
+        }
+
+    def summary(self):
+        return format_summary(_ms(self.first_token_time), self.tokens_per_sec, self.tokens,
+                              _ms(self.end_time), _ms(self.render_lag), self.prompt_tokens, self.cached_tokens)
+
+    def insert_to_db(self, db_file):
+        if self.mid is None:
+            return
+        conn = sqlite3.connect(db_file)
+        c = conn.cursor()
+        try:
+            sql = """
+            insert into request_metrics(ID, CID, MID, MODEL, ENDPOINT, CONNECT_MS, TTFT_MS, GAP_AVG_MS, GAP_MAX_MS,
+                TOTAL_MS, TOKENS, TPS, RENDER_LAG_MS, PROMPT_TOKENS, COMPLETION_TOKENS, CACHED_TOKENS, ERROR, CREATETIME)
+                values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """
+            gap_avg = sum(self.gaps) / len(self.gaps) if self.gaps else None
+            gap_max = max(self.gaps) if self.gaps else None
+            c.execute(sql, (TSID.create().number, self.cid, self.mid, self.model, self.endpoint,
+                            _ms(self.connect_time), _ms(self.first_token_time), _ms(gap_avg), _ms(gap_max),
+                            _ms(self.end_time), self.tokens, self.tokens_per_sec, _ms(self.render_lag),
+                            self.prompt_tokens, self.completion_tokens, self.cached_tokens, self.error,
+                            datetime.now()))
+            conn.commit()
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+        finally:
+            c.close()
+            conn.close()
+
+
+def format_summary(ttft_ms, tps, tokens, total_ms, render_lag_ms, prompt_tokens=None, cached_tokens=None):
+    """
+    >>> format_summary(320.4, 45.21, 512, 11300, 4.2)
+    '首字 320ms · 45.2 tok/s · 512 tokens · 共 11.3s · 渲染 4ms'
+    >>> format_summary(None, None, 0, 120, None)
+    '0 tokens · 共 0.1s'
+    >>> format_summary(None, None, 10, None, None, 4096, 3072)
+    '10 tokens · 输入 4096 (缓存 75%)'
+    """
+    parts = []
+    if ttft_ms is not None:
+        parts.append(f'首字 {ttft_ms:.0f}ms')
+    if tps is not None:
+        parts.append(f'{tps:.1f} tok/s')
+    parts.append(f'{tokens} tokens')
+    if total_ms is not None:
+        parts.append(f'共 {total_ms / 1000:.1f}s')
+    if render_lag_ms is not None:
+        parts.append(f'渲染 {render_lag_ms:.0f}ms')
+    if prompt_tokens:
+        parts.append(f'输入 {prompt_tokens} (缓存 {cache_ratio(prompt_tokens, cached_tokens)})')
+    return ' · '.join(parts)
+
+
+def cache_ratio(prompt_tokens, cached_tokens):
+    """
+    >>> cache_ratio(2000, 1536)
+    '77%'
+    >>> cache_ratio(0, 0)
+    '-'
+    """
+    if not prompt_tokens:
+        return '-'
+    return f'{(cached_tokens or 0) * 100 / prompt_tokens:.0f}%'
+
+
+def fetch_summaries(cursor, cid):
+    sql = """
+    select MID, TTFT_MS, TPS, TOKENS, TOTAL_MS, RENDER_LAG_MS, PROMPT_TOKENS, CACHED_TOKENS from request_metrics
+    where CID = ?
+    """
+    cursor.execute(sql, (cid,))
+    return {row[0]: format_summary(*row[1:]) for row in cursor.fetchall()}
+
+
+def conversation_usage(cursor, cid):
+    """
+    返回对话累计的 [输入, 缓存命中, 输出] token 数。
+    """
+    cursor.execute("""
+    select sum(PROMPT_TOKENS), sum(CACHED_TOKENS), sum(COMPLETION_TOKENS) from request_metrics where CID = ?
+    """, (cid,))
+    return [value or 0 for value in cursor.fetchone()]
+
+
+def format_usage(usage):
+    """
+    >>> format_usage([12000, 9000, 800])
+    '本对话 输入 12000 tokens · 缓存命中 75% · 输出 800 tokens'
+    >>> format_usage([0, 0, 0])
+    ''
+    """
+    prompt_tokens, cached_tokens, completion_tokens = usage
+    if not prompt_tokens:
+        return ''
+    return (f'本对话 输入 {prompt_tokens} tokens · 缓存命中 {cache_ratio(prompt_tokens, cached_tokens)} · '
+            f'输出 {completion_tokens} tokens')
+
+
+def aggregate(db_file):
+    """
+    按 模型/端点 汇总 p50/p95，失败的请求只计入次数和失败数。
+    """
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    groups = {}
+    counts = {}
+    errors = {}
+    # (模型, 端点) -> [输入 token, 缓存命中 token]
+    usage = {}
+    try:
+        sql = """
+        select MODEL, ENDPOINT, TTFT_MS, TPS, TOTAL_MS, PROMPT_TOKENS, CACHED_TOKENS, ERROR from request_metrics
+        order by CREATETIME asc
+        """
+        c.execute(sql)
+        for model, endpoint, ttft, tps, total, prompt_tokens, cached_tokens, error in c.fetchall():
+            group = groups.setdefault((model, endpoint), {'ttft': [], 'tps': [], 'total': []})
+            counts[(model, endpoint)] = counts.get((model, endpoint), 0) + 1
+            if prompt_tokens:
+                totals = usage.setdefault((model, endpoint), [0, 0])
+                totals[0] += prompt_tokens
+                totals[1] += cached_tokens or 0
+            if error is not None:
+                errors[(model, endpoint)] = errors.get((model, endpoint), 0) + 1
+                continue
+            for key, value in (('ttft', ttft), ('tps', tps), ('total', total)):
+                if value is not None:
+                    group[key].append(value)
+    except Exception as e:
+        logger.error(f'{traceback.format_exc()}')
+    finally:
+        c.close()
+        conn.close()
+    result = []
+    for (model, endpoint), group in groups.items():
+        row = {'model': model, 'endpoint': endpoint, 'count': counts[(model, endpoint)],
+               'errors': errors.get((model, endpoint), 0)}
+        for key, values in group.items():
+            row[f'{key}_p50'] = percentile(values, 50)
+            row[f'{key}_p95'] = percentile(values, 95)
+        prompt_tokens, cached_tokens = usage.get((model, endpoint), (0, 0))
+        row['cache_ratio'] = cached_tokens * 100 / prompt_tokens if prompt_tokens else None
+        result.append(row)
+    return result
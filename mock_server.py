@@ -0,0 +1,381 @@
+"""
+进程内的 OpenAI 兼容模拟服务，用于基准测试和离线调试。
+只依赖标准库，流式接口按 SSE 格式分片返回。
+也模拟了 Batch API 需要的 files / batches 接口：批处理在被查询 batch_polls 次后完成。
+drop_after 不为 None 时，接下来 drops 个流式请求在发送 drop_after 个字符后断开连接(stall 为 True 时改为停止发送)；
+最后两条消息是 assistant 的部分回答和一条续写指令时，只返回剩下的部分。
+usage 按 4 个字符一个 token 估算；和之前请求相同的消息前缀(至少 1024 token，按 128 取整)计为缓存命中。
+"""
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LOREM = ("The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。"
+         "```python\nprint('hello world')\n```\n")
+
+
+def estimate_tokens(text):
+    """
+    >>> estimate_tokens('a' * 4096)
+    1024
+    """
+    return len(text) // 4
+
+
+def cached_tokens(tokens):
+    """
+    >>> cached_tokens(1000)
+    0
+    >>> cached_tokens(1300)
+    1280
+    """
+    return tokens // 128 * 128 if tokens >= 1024 else 0
+
+
+def make_reply(length):
+    """
+    >>> len(make_reply(1000))
+    1000
+    >>> make_reply(9)
+    'The quick'
+    """
+    return ''.join(itertools.islice(itertools.cycle(LOREM), length))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self) -> 'MockOpenAIServer':
+        return self.server.mock
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b'{}'
+        return json.loads(body)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, data: bytes, content_type='application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_multipart(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        header = f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/chat/completions'):
+            self.chat_completions(self.read_json())
+        elif path.endswith('/embeddings'):
+            self.embeddings(self.read_json())
+        elif path.endswith('/files'):
+            self.upload_file(self.read_multipart())
+        elif path.endswith('/batches'):
+            self.create_batch(self.read_json())
+        elif path.endswith('/cancel') and '/batches/' in path:
+            self.send_batch(path.split('/')[-2], cancel=True)
+        else:
+            self.send_json({'error': {'message': f'not found: {self.path}'}}, 404)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        parts = path.split('/')
+        if '/files/' in path and parts[-1] == 'content':
+            data = self.mock.files.get(parts[-2])
+            if data is None:
+                self.send_json({'error': {'message': f'file not found: {parts[-2]}'}}, 404)
+            else:
+                self.send_bytes(data['content'])
+        elif '/files/' in path:
+            data = self.mock.files.get(parts[-1])
+            if data is None:
+                self.send_json({'error': {'message': f'file not found: {parts[-1]}'}}, 404)
+            else:
+                self.send_json(data['object'])
+        elif '/batches/' in path:
+            self.send_batch(parts[-1])
+        else:
+            self.send_json({'error': {'message': f'not found: {self.path}'}}, 404)
+
+    def upload_file(self, fields):
+        filename, content = fields.get('file', (None, b''))
+        purpose = fields.get('purpose', (None, b'batch'))[1].decode('utf-8')
+        file = self.mock.add_file(filename or 'upload.jsonl', purpose, content)
+        self.send_json(file)
+
+    def create_batch(self, request):
+        mock = self.mock
+        if request.get('input_file_id') not in mock.files:
+            self.send_json({'error': {'message': f'file not found: {request.get("input_file_id")}'}}, 400)
+            return
+        batch = {
+            'id': f'batch_mock{mock.next_id()}', 'object': 'batch', 'endpoint': request.get('endpoint'),
+            'input_file_id': request['input_file_id'], 'completion_window': request.get('completion_window'),
+            'status': 'validating', 'created_at': int(time.time()), 'output_file_id': None,
+            'error_file_id': None, 'metadata': request.get('metadata'),
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+        }
+        mock.batches[batch['id']] = {'batch': batch, 'polls': 0}
+        self.send_json(batch)
+
+    def send_batch(self, batch_id, cancel=False):
+        mock = self.mock
+        state = mock.batches.get(batch_id)
+        if state is None:
+            self.send_json({'error': {'message': f'batch not found: {batch_id}'}}, 404)
+            return
+        batch = state['batch']
+        with mock._lock:
+            if cancel and batch['status'] not in ('completed', 'failed', 'expired', 'cancelled'):
+                batch['status'] = 'cancelled'
+                batch['cancelled_at'] = int(time.time())
+            elif batch['status'] in ('validating', 'in_progress'):
+                state['polls'] += 1
+                batch['status'] = 'in_progress'
+                lines = mock.files[batch['input_file_id']]['content'].splitlines()
+                batch['request_counts']['total'] = len([line for line in lines if line.strip()])
+                if state['polls'] >= mock.batch_polls:
+                    mock.complete_batch(batch, lines)
+        self.send_json(batch)
+
+    def chat_completions(self, request):
+        mock = self.mock
+        mock.count_request()
+        mock.last_request = request
+        model = request.get('model', 'mock')
+        messages = request.get('messages') or []
+        reply = make_reply(mock.reply_length)
+        partial = messages[-2].get('content') or '' if len(messages) >= 2 and messages[-2].get('role') == 'assistant' \
+            else ''
+        if partial and len(partial) < len(reply) and reply.startswith(partial):
+            reply = reply[len(partial):]
+        cid = f'chatcmpl-mock{mock.next_id()}'
+        created = int(time.time())
+        usage = mock.usage(messages, reply)
+        if not request.get('stream', False):
+            self.send_json({
+                'id': cid, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': reply}}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(mock.first_token_delay)
+
+        def event(delta, finish_reason=None):
+            data = {
+                'id': cid, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+            self.write_chunk(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+
+        event({'role': 'assistant', 'content': ''})
+        drop_after = mock.next_drop()
+        for i in range(0, len(reply), mock.chunk_size):
+            if drop_after is not None and i >= drop_after:
+                if mock.stall:
+                    time.sleep(3600)
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            event({'content': reply[i:i + mock.chunk_size]})
+            time.sleep(mock.interval)
+        event({}, 'stop')
+        if (request.get('stream_options') or {}).get('include_usage'):
+            data = {'id': cid, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [], 'usage': usage}
+            self.write_chunk(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def embeddings(self, request):
+        self.mock.count_request()
+        inputs = request.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dimensions = request.get('dimensions', 256)
+        data = []
+        for i, text in enumerate(inputs):
+            rnd = random.Random(zlib.crc32(text.encode('utf-8')))
+            data.append({'object': 'embedding', 'index': i,
+                         'embedding': [rnd.gauss(0, 1) for _ in range(dimensions)]})
+        self.send_json({'object': 'list', 'data': data, 'model': request.get('model', 'mock'),
+                        'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+
+class MockOpenAIServer:
+    """
+    chunk_size: 每个分片的字符数
+    interval: 分片间隔(秒)
+    reply_length: 回复总字符数
+    first_token_delay: 首个分片前的等待(秒)
+    """
+
+    def __init__(self, chunk_size=4, interval=0.01, reply_length=400, first_token_delay=0.05,
+                 host='127.0.0.1', port=0, batch_polls=1, drop_after=None, drops=0, stall=False):
+        self.chunk_size = max(1, chunk_size)
+        self.interval = interval
+        self.reply_length = reply_length
+        self.first_token_delay = first_token_delay
+        self.requests = 0
+        self.batch_polls = batch_polls
+        self.drop_after = drop_after
+        self.drops = drops
+        self.stall = stall
+        self.last_request = None
+        self.files = {}
+        self.batches = {}
+        # 见过的消息前缀 -> token 数
+        self.prefixes = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def next_id(self):
+        return next(self._ids)
+
+    def next_drop(self):
+        with self._lock:
+            if self.drop_after is None or self.drops <= 0:
+                return None
+            self.drops -= 1
+            return self.drop_after
+
+    def usage(self, messages, reply):
+        prompt = ''
+        cached = 0
+        with self._lock:
+            for i, message in enumerate(messages):
+                prompt += json.dumps(message, ensure_ascii=False)
+                key = zlib.crc32(prompt.encode('utf-8')) + (i << 32)
+                if key in self.prefixes:
+                    cached = self.prefixes[key]
+                else:
+                    self.prefixes[key] = estimate_tokens(prompt)
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(reply)
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens(cached)}}
+
+    def add_file(self, filename, purpose, content):
+        file = {'id': f'file-mock{self.next_id()}', 'object': 'file', 'bytes': len(content),
+                'created_at': int(time.time()), 'filename': filename, 'purpose': purpose, 'status': 'processed'}
+        self.files[file['id']] = {'object': file, 'content': content}
+        return file
+
+    def complete_batch(self, batch, lines):
+        """
+        模型名为 error 的请求返回 400，其余返回普通的 chat.completion。
+        """
+        output = []
+        errors = []
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            model = request['body'].get('model', 'mock')
+            self.requests += 1
+            if model == 'error':
+                errors.append({'id': f'batch_req_{self.next_id()}', 'custom_id': request['custom_id'],
+                               'response': {'status_code': 400, 'request_id': '',
+                                            'body': {'error': {'message': 'mock error'}}},
+                               'error': None})
+                continue
+            output.append({'id': f'batch_req_{self.next_id()}', 'custom_id': request['custom_id'], 'response': {
+                'status_code': 200, 'request_id': '',
+                'body': {'id': f'chatcmpl-mock{self.next_id()}', 'object': 'chat.completion',
+                         'created': int(time.time()), 'model': model,
+                         'choices': [{'index': 0, 'finish_reason': 'stop',
+                                      'message': {'role': 'assistant', 'content': make_reply(self.reply_length)}}],
+                         'usage': {'prompt_tokens': 10, 'completion_tokens': 20, 'total_tokens': 30}}},
+                'error': None})
+        if output:
+            batch['output_file_id'] = self.add_file('batch_output.jsonl', 'batch_output', ''.join(
+                json.dumps(item) + '\n' for item in output).encode('utf-8'))['id']
+        if errors:
+            batch['error_file_id'] = self.add_file('batch_errors.jsonl', 'batch_output', ''.join(
+                json.dumps(item) + '\n' for item in errors).encode('utf-8'))['id']
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+        batch['request_counts'] = {'total': len(output) + len(errors), 'completed': len(output),
+                                   'failed': len(errors)}
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='OpenAI 兼容模拟服务')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--chunk-size', type=int, default=4)
+    parser.add_argument('--interval', type=float, default=0.01)
+    parser.add_argument('--reply-length', type=int, default=400)
+    args = parser.parse_args()
+    server = MockOpenAIServer(args.chunk_size, args.interval, args.reply_length, port=args.port)
+    print(f'mock server: {server.url}')
+    server.httpd.serve_forever()
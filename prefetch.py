@@ -0,0 +1,119 @@
+"""
+对话预取。
+
+鼠标停在对话列表的某一项上或用键盘选中它时，在后台把这个对话读出来放进缓存，双击时直接显示，不再等数据库。
+同一时间只关心最近指向的对话：还没开始的预取会被取消。缓存按消息字符数和条数限制大小，
+单个对话超过 MAX_ITEM_CHARS 时不预取(鼠标划过一个很长的对话不应解码并留住它的全部消息)，双击时照常读取。
+对话有写入时对应的缓存失效，正在读取的结果也会被丢弃。
+"""
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+import database
+
+MAX_ITEMS = 16
+MAX_CHARS = 8 * 1024 * 1024
+MAX_ITEM_CHARS = 1024 * 1024
+
+
+def history_chars(history: database.ChatHistory):
+    """
+    估算一个对话占用的字符数。
+
+    >>> history_chars(database.ChatHistory('c', [database.ChatMessage('m', 'hello', 1)], {'m': 'x' * 10}, {}, []))
+    79
+    """
+    return sum(len(m.content) + 64 for m in history.messages) + sum(len(s) for s in history.summaries.values())
+
+
+class Prefetcher:
+
+    def __init__(self, load, size=None, max_items=MAX_ITEMS, max_chars=MAX_CHARS, max_item_chars=MAX_ITEM_CHARS):
+        """
+        load(cid) 返回 database.ChatHistory，size(cid) 返回读取前估算的字符数，都在后台线程调用。
+        """
+        self.load = load
+        self.size = size
+        self.max_item_chars = max_item_chars
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.chars = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        # cid -> ChatHistory
+        self.items = OrderedDict()
+        # cid -> Future
+        self.pending = {}
+        # cid -> 写入次数，读取前后不一致时丢弃结果
+        self.versions = {}
+
+    def request(self, cid):
+        with self.lock:
+            if cid in self.items:
+                self.items.move_to_end(cid)
+                return
+            for other, future in list(self.pending.items()):
+                if other != cid and future.cancel():
+                    del self.pending[other]
+            if cid in self.pending:
+                return
+            self.pending[cid] = self.executor.submit(self._load, cid, self.versions.get(cid, 0))
+
+    def _load(self, cid, version):
+        try:
+            if self.size is not None and self.size(cid) > self.max_item_chars:
+                logger.debug('prefetch skipped, conversation too large: {}', cid)
+                history = None
+            else:
+                history = self.load(cid)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            history = None
+        with self.lock:
+            self.pending.pop(cid, None)
+            if history is None or self.versions.get(cid, 0) != version:
+                return
+            if history_chars(history) > self.max_item_chars:
+                return
+            self._put(cid, history)
+
+    def _put(self, cid, history):
+        old = self.items.pop(cid, None)
+        if old is not None:
+            self.chars -= history_chars(old)
+        self.items[cid] = history
+        self.chars += history_chars(history)
+        while len(self.items) > 1 and (len(self.items) > self.max_items or self.chars > self.max_chars):
+            _, old = self.items.popitem(last=False)
+            self.chars -= history_chars(old)
+
+    def take(self, cid):
+        """
+        返回已经读好的对话并移出缓存，没有时返回 None。
+        """
+        with self.lock:
+            history = self.items.pop(cid, None)
+            if history is not None:
+                self.chars -= history_chars(history)
+            return history
+
+    def invalidate(self, cid):
+        with self.lock:
+            self.versions[cid] = self.versions.get(cid, 0) + 1
+            history = self.items.pop(cid, None)
+            if history is not None:
+                self.chars -= history_chars(history)
+
+    def clear(self):
+        with self.lock:
+            for cid in set(self.items) | set(self.pending):
+                self.versions[cid] = self.versions.get(cid, 0) + 1
+            self.items.clear()
+            self.chars = 0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
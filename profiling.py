@@ -0,0 +1,216 @@
+"""
+性能诊断：按操作开关的 cProfile 和 tracemalloc 内存快照，报告写在 chatgpt.log 旁边。
+
+启动时用环境变量开启，也可以在界面的"诊断"菜单中随时开关：
+
+CHATGPT_LOCAL_PROFILE=chat_update,fetch_c_list  只分析这两个操作
+CHATGPT_LOCAL_PROFILE=all                       分析全部操作并跟踪内存
+CHATGPT_LOCAL_PROFILE=memory                    只跟踪内存，每次切换对话写一份与上一次的差异
+
+每个操作的多次调用累计到一份统计中，写出 chatgpt_profile_<时间>_<操作>.prof(可用 snakeviz 等查看)
+和同名 .txt(调用次数、耗时分位数和按累计时间排序的函数)。没有开启的操作只多一次集合查找。
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import traceback
+from datetime import datetime
+
+from loguru import logger
+
+import metrics
+
+ENV = 'CHATGPT_LOCAL_PROFILE'
+OPERATIONS = ('chat_update', 'chat_completions', 'fetch_c_list')
+MEMORY = 'memory'
+FILE_PREFIX = 'chatgpt_profile'
+# 差异按代码行汇总，一层调用栈就够了，层数越多跟踪开销越大
+TRACE_FRAMES = 1
+REPORT_LINES = 40
+
+
+def parse_spec(spec):
+    """
+    返回 (要分析的操作, 是否跟踪内存)。
+
+    >>> parse_spec('chat_update, memory')
+    ({'chat_update'}, True)
+    >>> parse_spec('all') == (set(OPERATIONS), True)
+    True
+    >>> parse_spec('')
+    (set(), False)
+    """
+    names = {name.strip() for name in (spec or '').split(',') if name.strip()}
+    if names & {'1', 'all', 'true'}:
+        return set(OPERATIONS), True
+    return names & set(OPERATIONS), MEMORY in names
+
+
+class Profiler:
+
+    def __init__(self, log_dir=None):
+        self.log_dir = log_dir or os.path.expanduser('~')
+        # 正在分析的操作，装饰器只读取它
+        self.active = frozenset()
+        self.lock = threading.Lock()
+        # 操作 -> pstats.Stats
+        self.stats = {}
+        # 操作 -> [耗时秒数, ...]
+        self.durations = {}
+        self.local = threading.local()
+        # 上一次快照按代码行汇总的结果: traceback -> Statistic
+        self.last_statistics = None
+        self.snapshot_lock = threading.Lock()
+
+    def setup(self, log_dir, spec=None):
+        self.log_dir = log_dir
+        operations, memory = parse_spec(spec)
+        for name in operations:
+            self.enable(name, True)
+        if memory:
+            self.start_memory()
+
+    def enable(self, name, on):
+        with self.lock:
+            self.active = self.active | {name} if on else self.active - {name}
+        logger.info(f'profile {name}: {"on" if on else "off"}')
+
+    def run(self, name, func, args, kwargs):
+        # cProfile 只作用于当前线程，同一线程中嵌套的操作计入外层
+        if getattr(self.local, 'profiling', False):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 3.12 起同一时间只能有一个 profiler，另一个线程正在分析时不记录这一次
+            return func(*args, **kwargs)
+        self.local.profiling = True
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - start
+            self.local.profiling = False
+            with self.lock:
+                if name in self.stats:
+                    self.stats[name].add(profile)
+                else:
+                    self.stats[name] = pstats.Stats(profile)
+                self.durations.setdefault(name, []).append(duration)
+
+    def report_path(self, name, suffix):
+        return os.path.join(self.log_dir, f'{FILE_PREFIX}_{datetime.now():%Y%m%d_%H%M%S_%f}_{name}.{suffix}')
+
+    def dump(self):
+        """
+        写出并清空已收集的统计，返回写出的文件。
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            durations, self.durations = self.durations, {}
+        paths = []
+        for name, stat in stats.items():
+            values = durations.get(name, [])
+            prof_path = self.report_path(name, 'prof')
+            stat.dump_stats(prof_path)
+            text = io.StringIO()
+            text.write(f'{name}: {len(values)} calls, p50 {metrics.percentile(values, 50) * 1000:.1f} ms, '
+                       f'p95 {metrics.percentile(values, 95) * 1000:.1f} ms, max {max(values) * 1000:.1f} ms\n\n')
+            stat.stream = text
+            stat.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+            txt_path = prof_path[:-len('prof')] + 'txt'
+            with open(txt_path, 'w', encoding='utf-8') as f:
+                f.write(text.getvalue())
+            paths += [prof_path, txt_path]
+        if paths:
+            logger.info(f'profile reports: {", ".join(paths)}')
+        return paths
+
+    def start_memory(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self.last_statistics = None
+            logger.info('tracemalloc started')
+
+    def stop_memory(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.last_statistics = None
+            logger.info('tracemalloc stopped')
+
+    def snapshot_later(self, label):
+        """
+        汇总几十万条分配记录需要数秒，放在后台线程中进行。
+        """
+        if tracemalloc.is_tracing():
+            threading.Thread(target=self.snapshot, args=(label,), name='memory-snapshot', daemon=True).start()
+
+    def snapshot(self, label):
+        """
+        内存跟踪开启时拍一次快照，写出与上一次快照的差异，返回报告路径。
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        with self.snapshot_lock:
+            try:
+                return self._snapshot(label)
+            except Exception as e:
+                logger.error(f'{traceback.format_exc()}')
+                return None
+
+    def _snapshot(self, label):
+        start = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        # 不过滤 tracemalloc 自身的记录，过滤一遍比汇总还慢
+        statistics = {stat.traceback: stat for stat in tracemalloc.take_snapshot().statistics('lineno')}
+        previous, self.last_statistics = self.last_statistics, statistics
+        lines = [f'{label}: traced {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB', '']
+        if previous is None:
+            top = sorted(statistics.values(), key=lambda stat: stat.size, reverse=True)
+            lines += [str(stat) for stat in top[0:REPORT_LINES]]
+        else:
+            # 与 Snapshot.compare_to 相同，但上一次的汇总结果直接复用
+            diff = []
+            for key in statistics.keys() | previous.keys():
+                new = statistics.get(key)
+                old = previous.get(key)
+                diff.append(tracemalloc.StatisticDiff(key, new.size if new else 0,
+                                                      (new.size if new else 0) - (old.size if old else 0),
+                                                      new.count if new else 0,
+                                                      (new.count if new else 0) - (old.count if old else 0)))
+            diff.sort(key=lambda stat: (abs(stat.size_diff), stat.size), reverse=True)
+            growth = sum(stat.size_diff for stat in diff)
+            lines[0] += f', {growth / 1024:+.0f} KB since last snapshot'
+            lines += [str(stat) for stat in diff[0:REPORT_LINES]]
+        path = self.report_path(MEMORY, 'txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        logger.info(f'memory snapshot: {lines[0]} -> {path} in {(time.perf_counter() - start) * 1000:.0f} ms')
+        return path
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """
+    没有开启时直接调用原函数。
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if name not in profiler.active:
+                return func(*args, **kwargs)
+            return profiler.run(name, func, args, kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,365 @@
+"""
+本地 OpenAI 兼容代理。
+
+编辑器、脚本等本机工具把 base_url 指向这里，即可共用已保存的配置、同一组上游连接、耗时统计和对话历史：
+
+python proxy.py --port 8765 --concurrency 8
+curl http://127.0.0.1:8765/v1/chat/completions -H 'Content-Type: application/json' -d '{"model": "azure/gpt-4o", "stream": true, "messages": [...]}'
+
+模型名写成 "配置别名/模型" 时使用该配置，否则使用请求头 X-Config 或默认配置。
+每次请求的最后一条用户消息和回答写入 chat_message，请求头 X-Conversation-Id 可以续写同一个对话，
+响应头中返回实际使用的对话 ID。
+
+代理没有自己的账号体系。带 Origin 请求头(浏览器中的网页发起)或 POST 的 Content-Type 不是 application/json
+的请求一律拒绝，网页不能借用户的配置发请求。只监听本机地址时不做其他认证；--host 是其他地址时必须带
+Authorization: Bearer <token>(即 OpenAI 客户端的 api_key)，token 用 --token 指定或启动时随机生成并打印。
+
+同时转发的上游请求不超过 concurrency 个；等待中的请求超过 queue_size 或等待超过 queue_timeout 秒时
+返回 429，由调用方退避重试，而不是在本地无限堆积。
+"""
+import argparse
+import hmac
+import inspect
+import ipaddress
+import json
+import os
+import secrets
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import openai
+from loguru import logger
+from openai.resources.chat.completions import Completions
+
+import config
+import database
+import log_config
+import metrics
+from tsid import TSID
+
+# create() 不认识的参数放进 extra_body 原样转发
+CREATE_PARAMS = set(inspect.signature(Completions.create).parameters) - {'self', 'extra_body'}
+# 不处理的请求体不超过这个大小时读出丢弃，保持连接可用，否则关闭连接
+MAX_DISCARD = 1024 * 1024
+
+
+def split_model(model, configs, default_config):
+    """
+    >>> split_model('azure/gpt-4o', {'azure': {}}, 'openai')
+    ('azure', 'gpt-4o')
+    >>> split_model('meta-llama/llama-3', {'azure': {}}, 'openai')
+    ('openai', 'meta-llama/llama-3')
+    """
+    name, sep, rest = model.partition('/')
+    if sep and name in configs:
+        return name, rest
+    return default_config, model
+
+
+def is_loopback(host):
+    """
+    >>> is_loopback('127.0.0.1'), is_loopback('::1'), is_loopback('localhost')
+    (True, True, True)
+    >>> is_loopback('0.0.0.0'), is_loopback('192.168.1.2'), is_loopback('example.com')
+    (False, False, False)
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def last_user_message(messages):
+    """
+    >>> last_user_message([{'role': 'user', 'content': 'a'}, {'role': 'user', 'content': [{'type': 'text', 'text': 'b'}]}])
+    'b'
+    """
+    for message in reversed(messages):
+        if message.get('role') != 'user':
+            continue
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            content = '\n'.join(part.get('text', '') for part in content if part.get('type') == 'text')
+        return content
+    return ''
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def proxy(self) -> 'ProxyServer':
+        return self.server.proxy
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json({'error': {'message': message, 'type': 'proxy_error'}}, status, headers)
+
+    def discard_body(self):
+        # 没读完的请求体会被当成同一连接上的下一个请求
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if 'Transfer-Encoding' in self.headers or length < 0 or length > MAX_DISCARD:
+            self.close_connection = True
+            return
+        self.rfile.read(length)
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def authorized(self):
+        # 浏览器跨域请求总会带 Origin；text/plain 等"简单请求"不经过预检，只能按 Content-Type 拒绝
+        if self.headers.get('Origin') is not None:
+            self.send_error_json(403, 'browser requests are not allowed')
+            return False
+        content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if self.command == 'POST' and content_type != 'application/json':
+            self.send_error_json(415, 'Content-Type must be application/json')
+            return False
+        token = self.proxy.token
+        if token is None:
+            return True
+        scheme, _, value = (self.headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode('utf-8'), token.encode('utf-8')):
+            return True
+        self.send_error_json(401, 'invalid proxy token', {'WWW-Authenticate': 'Bearer'})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/models'):
+            self.send_json({'object': 'list', 'data': [{'id': f'{name}/', 'object': 'model', 'owned_by': name}
+                                                       for name in self.proxy.configs.keys()]})
+        else:
+            self.send_error_json(404, f'not found: {self.path}')
+
+    def do_POST(self):
+        if not self.authorized():
+            self.discard_body()
+            return
+        path = self.path.split('?')[0].rstrip('/')
+        if not path.endswith('/chat/completions'):
+            self.discard_body()
+            self.send_error_json(404, f'not found: {self.path}')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.send_error_json(400, f'invalid json: {e}')
+            return
+        if not self.proxy.acquire():
+            self.send_error_json(429, 'too many concurrent requests', {'Retry-After': '1'})
+            return
+        try:
+            self.chat_completions(request)
+        finally:
+            self.proxy.release()
+
+    def chat_completions(self, request):
+        proxy = self.proxy
+        name, model = split_model(request.get('model', ''), proxy.configs,
+                                  self.headers.get('X-Config') or proxy.default_config)
+        gpt_config = proxy.configs.get(name)
+        if gpt_config is None:
+            self.send_error_json(400, f'config not found: {name}')
+            return
+        cid = self.headers.get('X-Conversation-Id') or TSID.create().to_string()
+        stream = bool(request.get('stream', False))
+        kwargs = {key: value for key, value in request.items() if key in CREATE_PARAMS}
+        kwargs['model'] = model
+        extra_body = {key: value for key, value in request.items() if key not in CREATE_PARAMS}
+        if extra_body:
+            kwargs['extra_body'] = extra_body
+        # 调用方没有要求 usage 时也向上游要，只用于统计，不转发最后的 usage 分片
+        forward_usage = bool((request.get('stream_options') or {}).get('include_usage'))
+        if stream and not forward_usage:
+            kwargs['stream_options'] = {**(request.get('stream_options') or {}), **metrics.STREAM_OPTIONS}
+        request_metrics = metrics.RequestMetrics(cid, model, gpt_config.get('endpoint'))
+        with logger.contextualize(cid=cid, model=model, proxy=name):
+            try:
+                completion = proxy.client(name).chat.completions.create(**kwargs)
+                request_metrics.connected()
+            except openai.APIStatusError as e:
+                logger.warning(f'upstream error {e.status_code}: {e.message}')
+                self.send_json(e.body if isinstance(e.body, dict) and 'error' in e.body
+                               else {'error': {'message': e.message}}, e.status_code)
+                return
+            except Exception as e:
+                logger.error(f'{traceback.format_exc()}')
+                self.send_error_json(502, str(e))
+                return
+            if stream:
+                reply = self.forward_stream(completion, cid, request_metrics, forward_usage)
+            else:
+                reply = (completion.choices[0].message.content or '') if completion.choices else ''
+                request_metrics.chunk(reply)
+                request_metrics.mid = completion.id
+                request_metrics.usage(completion.usage)
+                self.send_json(completion.model_dump(exclude_unset=True), headers={'X-Conversation-Id': cid})
+            request_metrics.finish()
+            if reply is not None:
+                proxy.record(cid, last_user_message(request.get('messages') or []), reply, request_metrics)
+
+    def forward_stream(self, completion, cid, request_metrics, forward_usage=True):
+        """
+        逐个分片原样转发，返回拼接后的回答；调用方断开时返回 None。
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Conversation-Id', cid)
+        self.end_headers()
+        reply = ''
+        try:
+            for chunk in completion:
+                if len(chunk.choices) > 0:
+                    chunk_text = chunk.choices[0].delta.content or ''
+                    request_metrics.chunk(chunk_text)
+                    reply += chunk_text
+                if request_metrics.mid is None:
+                    request_metrics.mid = chunk.id
+                request_metrics.usage(chunk.usage)
+                if len(chunk.choices) == 0 and chunk.usage is not None and not forward_usage:
+                    continue
+                self.write_chunk(f'data: {chunk.model_dump_json(exclude_unset=True)}\n\n'.encode('utf-8'))
+            self.write_chunk(b'data: [DONE]\n\n')
+            self.write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info('client disconnected')
+            completion.close()
+            return None
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+            completion.close()
+            error = json.dumps({'error': {'message': str(e), 'type': 'proxy_error'}}, ensure_ascii=False)
+            try:
+                self.write_chunk(f'data: {error}\n\n'.encode('utf-8'))
+                self.write_chunk(b'')
+            except OSError:
+                pass
+            return None
+        return reply
+
+
+class ProxyServer:
+
+    def __init__(self, db_file, configs, default_config=None, host='127.0.0.1', port=8765,
+                 concurrency=8, queue_size=64, queue_timeout=30, on_record=None, token=None):
+        self.db_file = db_file
+        # 监听本机以外的地址时必须认证，没有指定 token 就生成一个
+        if token is None and not is_loopback(host):
+            token = secrets.token_urlsafe(24)
+        self.token = token
+        self.configs = configs
+        self.default_config = default_config or next(iter(configs.keys()), None)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # on_record(cid) 在对话写入后调用，界面据此丢弃缓存的对话
+        self.on_record = on_record
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.clients = {}
+        self.httpd = ThreadingHTTPServer((host, port), ProxyHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.proxy = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def client(self, name):
+        # 每个配置一个客户端，所有本地调用方共用它的连接池
+        with self.lock:
+            client = self.clients.get(name)
+            if client is None:
+                client = config.make_client(self.configs[name])
+                self.clients[name] = client
+            return client
+
+    def acquire(self):
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        self.slots.release()
+
+    def record(self, cid, prompt, reply, request_metrics):
+        try:
+            if request_metrics.mid is None:
+                request_metrics.mid = TSID.create().to_string()
+            database.insert_message(self.db_file, cid, TSID.create().to_string(), prompt, 1)
+            database.insert_message(self.db_file, cid, request_metrics.mid, reply, 0)
+            request_metrics.insert_to_db(self.db_file)
+            if self.on_record is not None:
+                self.on_record(cid)
+            logger.opt(lazy=True).info('proxy {}: {}', lambda: request_metrics.model, request_metrics.summary)
+        except Exception as e:
+            logger.error(f'{traceback.format_exc()}')
+
+    def start(self):
+        database.init_database(self.db_file)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='proxy', daemon=True)
+        self.thread.start()
+        logger.info(f'proxy listening on {self.url}')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容代理')
+    parser.add_argument('--host', default='127.0.0.1', help='本机以外的地址需要带 token 访问')
+    parser.add_argument('--token', help='Authorization: Bearer 的值, 默认只监听本机时不需要, 否则随机生成')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--config', help='默认配置别名, 默认取第一个')
+    parser.add_argument('--concurrency', type=int, default=8, help='同时转发的上游请求数')
+    parser.add_argument('--queue-size', type=int, default=64, help='最多等待的请求数, 超过返回 429')
+    parser.add_argument('--queue-timeout', type=float, default=30, help='等待超过该秒数返回 429')
+    parser.add_argument('--db', default=os.path.expanduser('~') + '/chatgpt_local.db')
+    args = parser.parse_args()
+
+    log_config.setup_logging(os.path.expanduser('~'))
+    server = ProxyServer(args.db, config.read_gpt_config(), args.config, args.host, args.port,
+                         args.concurrency, args.queue_size, args.queue_timeout, token=args.token)
+    print(f'proxy: {server.url}')
+    if server.token is not None:
+        print(f'token: {server.token}')
+    server.start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
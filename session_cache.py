@@ -0,0 +1,86 @@
+"""
+最近打开的对话。
+
+切换对话时不再清空气泡、从数据库重建，而是把当前对话的 ChatWidget、messages_array、气泡索引和滚动位置
+整体留下，切回来时直接显示。按对话数和估算的字符数做 LRU 淘汰，被淘汰的 ChatWidget 由调用方回收；
+对话在后台被写入(代理、批处理导入等)时失效，下次打开重新读取。
+"""
+from collections import OrderedDict
+
+MAX_SESSIONS = 8
+MAX_CHARS = 16 * 1024 * 1024
+# 每个气泡控件本身的开销，按字符折算
+BUBBLE_CHARS = 2048
+IMAGE_CHARS = 1024
+
+
+def session_chars(messages_array, bubbles):
+    """
+    估算一个对话占用的内存(字符数)。图片的 data URL 由 vision.encodings 共享，只按固定值计。
+
+    >>> session_chars([{'role': 'user', 'content': 'hello'},
+    ...                {'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}, {'type': 'image_url'}]}], 3)
+    7175
+    """
+    chars = bubbles * BUBBLE_CHARS
+    for message in messages_array:
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            chars += sum(len(part.get('text', '')) if part.get('type') == 'text' else IMAGE_CHARS for part in content)
+        else:
+            chars += len(content)
+    return chars
+
+
+class Session:
+
+    def __init__(self, cid, widget, messages_array, messages_comp, usage, scroll):
+        self.cid = cid
+        self.widget = widget
+        self.messages_array = messages_array
+        self.messages_comp = messages_comp
+        self.usage = usage
+        self.scroll = scroll
+        self.chars = session_chars(messages_array, len(messages_comp))
+
+
+class SessionCache:
+    """
+    只在 UI 线程中使用。put 和 invalidate 返回被移出的 Session，由调用方回收其中的控件。
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_chars=MAX_CHARS):
+        self.max_sessions = max_sessions
+        self.max_chars = max_chars
+        self.chars = 0
+        # cid -> Session
+        self.items = OrderedDict()
+
+    def __contains__(self, cid):
+        return cid in self.items
+
+    def put(self, session: Session):
+        evicted = self.invalidate(session.cid)
+        self.items[session.cid] = session
+        self.chars += session.chars
+        while len(self.items) > 0 and (len(self.items) > self.max_sessions or self.chars > self.max_chars):
+            _, old = self.items.popitem(last=False)
+            self.chars -= old.chars
+            evicted.append(old)
+        return evicted
+
+    def take(self, cid):
+        session = self.items.pop(cid, None)
+        if session is not None:
+            self.chars -= session.chars
+        return session
+
+    def invalidate(self, cid):
+        session = self.take(cid)
+        return [session] if session is not None else []
+
+    def clear(self):
+        evicted = list(self.items.values())
+        self.items.clear()
+        self.chars = 0
+        return evicted
@@ -0,0 +1,103 @@
+"""
+流式回答的断线重试和续写。
+
+两个分片之间超过 stall_timeout 秒没有收到数据(读超时)、连接被重置或服务端返回 5xx/429 时，
+按 1、2、4... 秒退避后重试。已经收到部分回答时，把它作为 assistant 消息连同一条"继续"指令发回去，
+让模型接着写；续写的内容用第一次请求的 MID 返回，界面上拼接到同一个气泡，入库也是同一行。
+"""
+import time
+
+import httpx
+import openai
+from loguru import logger
+
+import metrics
+
+STALL_TIMEOUT = 30
+CONNECT_TIMEOUT = 10
+MAX_RETRIES = 3
+CONTINUE_PROMPT = "你的上一条回答因为网络中断被截断了。请从中断处直接接着写，不要重复已经写过的内容，也不要加任何说明。"
+
+RETRYABLE_ERRORS = (httpx.TransportError, openai.APIConnectionError, openai.InternalServerError,
+                    openai.RateLimitError)
+
+
+class StreamInterrupted(Exception):
+    """
+    重试用尽，text 为已经收到的部分回答。
+    """
+
+    def __init__(self, mid, text, cause):
+        super().__init__(f'stream interrupted after {len(text)} chars: {cause}')
+        self.mid = mid
+        self.text = text
+
+
+def backoff(attempt, base=1.0, cap=16.0):
+    """
+    >>> [backoff(i) for i in range(6)]
+    [1.0, 2.0, 4.0, 8.0, 16.0, 16.0]
+    """
+    return min(cap, base * 2 ** attempt)
+
+
+def continuation_messages(messages, partial):
+    """
+    >>> continuation_messages([{'role': 'user', 'content': 'hi'}], 'Hel')[1:]
+    [{'role': 'assistant', 'content': 'Hel'}, {'role': 'user', 'content': '你的上一条回答因为网络中断被截断了。请从中断处直接接着写，不要重复已经写过的内容，也不要加任何说明。'}]
+    """
+    return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def stream_chat(client, model, messages, on_text, request_metrics: metrics.RequestMetrics = None, resume=True,
+                max_retries=MAX_RETRIES, stall_timeout=STALL_TIMEOUT, on_retry=None):
+    """
+    on_text(mid, text) 在收到每个分片时调用，on_retry(attempt, delay, error) 在每次重试前调用。
+    返回 (mid, 完整回答)。resume 为 False 时已经收到内容后不再重试。
+    """
+    # 客户端自带的重试只覆盖建立连接，流中断由这里处理
+    client = client.with_options(max_retries=0, timeout=httpx.Timeout(stall_timeout, connect=CONNECT_TIMEOUT))
+    mid = None
+    text = ''
+    attempt = 0
+    while True:
+        request_messages = continuation_messages(messages, text) if text else messages
+        completion = None
+        try:
+            completion = client.chat.completions.create(
+                model=model,
+                messages=request_messages,
+                stream=True,
+                stream_options=metrics.STREAM_OPTIONS
+            )
+            if request_metrics is not None and request_metrics.connect_time is None:
+                request_metrics.connected()
+            for chunk in completion:
+                if len(chunk.choices) > 0:
+                    chunk_text = chunk.choices[0].delta.content or ''
+                    if mid is None:
+                        mid = chunk.id
+                    if request_metrics is not None:
+                        request_metrics.chunk(chunk_text)
+                    text += chunk_text
+                    on_text(mid, chunk_text)
+                if request_metrics is not None:
+                    request_metrics.usage(chunk.usage)
+            return mid, text
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries or (text and not resume):
+                raise StreamInterrupted(mid, text, e) from e
+            delay = backoff(attempt)
+            attempt += 1
+            logger.warning(f'stream interrupted after {len(text)} chars ({type(e).__name__}: {e}), '
+                           f'retry {attempt}/{max_retries} in {delay:.0f}s')
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            time.sleep(delay)
+        except Exception as e:
+            if text:
+                raise StreamInterrupted(mid, text, e) from e
+            raise
+        finally:
+            if completion is not None:
+                completion.close()
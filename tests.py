@@ -1,5 +1,152 @@
-import random
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import openai
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PySide6.QtCore import QCoreApplication, QEvent
+from PySide6.QtWidgets import QApplication
+
+import batch_job
+from bubble_message import BubblePool, ChatWidget, MessageType
+import compression
+import database
+from mock_server import MockOpenAIServer, make_reply
+
+
+class BatchJobTest(unittest.TestCase):
+    """
+    Batch API 任务在本地模拟的 files / batches 接口上跑完整流程。
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='chatgpt_test_')
+        self.db_file = os.path.join(self.dir, 'chatgpt_local.db')
+        database.init_database(self.db_file)
+        self.server = MockOpenAIServer(reply_length=50, batch_polls=2).start()
+        self.client = openai.OpenAI(base_url=self.server.url, api_key='mock')
+        self.gpt_config = {'name': 'mock', 'type': 1, 'key': 'mock', 'endpoint': self.server.url}
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def submit(self, prompts, model='gpt-4o'):
+        items = batch_job.prompt_items(prompts)
+        job_id = batch_job.submit(self.client, self.db_file, 'mock', self.gpt_config, model, items)
+        return job_id, items
+
+    def query(self, sql, args=()):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def messages(self, cid):
+        return [(compression.decode(self.db_file, content), send) for content, send in self.query(
+            "select CONTENT, SEND from chat_message where CID = ? order by ID asc", (cid,))]
+
+    def test_submit_poll_import(self):
+        job_id, items = self.submit(['q1', 'q2', 'q3'])
+        self.assertEqual(batch_job.list_jobs(self.db_file)[0].status, 'validating')
+
+        # 第一次查询仍在进行中，第二次完成并导入
+        self.assertEqual(batch_job.refresh(self.client, self.db_file, job_id), 0)
+        self.assertEqual(batch_job.list_jobs(self.db_file, pending_only=True)[0].id, job_id)
+        self.assertEqual(batch_job.refresh(self.client, self.db_file, job_id), 3)
+
+        job = batch_job.list_jobs(self.db_file)[0]
+        self.assertEqual((job.status, job.total, job.completed, job.failed, job.imported), ('completed', 3, 3, 0, 1))
+        self.assertEqual(batch_job.list_jobs(self.db_file, pending_only=True), [])
+        for item in items:
+            self.assertEqual(self.messages(item.cid), [(item.prompt, 1), (make_reply(50), 0)])
+        self.assertEqual(self.query("select count(*) from batch_request where BATCH_ID = ? and IMPORTED = 1",
+                                    (job_id,)), [(3,)])
+
+        # 已导入的任务再次查询不会重复写入
+        self.assertEqual(batch_job.refresh(self.client, self.db_file, job_id), 0)
+        self.assertEqual(self.query("select count(*) from chat_message"), [(6,)])
+
+    def test_import_resume(self):
+        job_id, items = self.submit(['q1', 'q2', 'q3'])
+        batch = self.client.batches.retrieve(job_id)
+        while batch.status != 'completed':
+            batch = self.client.batches.retrieve(job_id)
+
+        # 模拟导入中断：第一条已经写入并标记
+        conn = sqlite3.connect(self.db_file)
+        with conn:
+            batch_job.write_results(conn, job_id, [(f'{items[0].cid}-0', (items[0].cid, items[0].prompt),
+                                                    {'id': 'chatcmpl-done', 'choices': [
+                                                        {'message': {'content': 'done'}}]})])
+        conn.close()
+
+        self.assertEqual(batch_job.import_results(self.client, self.db_file, job_id, batch.output_file_id), 2)
+        self.assertEqual(self.messages(items[0].cid), [('q1', 1), ('done', 0)])
+        for item in items[1:]:
+            self.assertEqual(self.messages(item.cid), [(item.prompt, 1), (make_reply(50), 0)])
+        self.assertEqual(self.query("select count(*) from batch_request where BATCH_ID = ? and IMPORTED = 0",
+                                    (job_id,)), [(0,)])
+
+        # 全部导入后再导入一次什么也不写
+        self.assertEqual(batch_job.import_results(self.client, self.db_file, job_id, batch.output_file_id), 0)
+        self.assertEqual(self.query("select count(*) from chat_message"), [(6,)])
+
+    def test_failed_requests_are_not_imported(self):
+        job_id, items = self.submit(['q1', 'q2'], model='error')
+        batch_job.refresh(self.client, self.db_file, job_id)
+        self.assertEqual(batch_job.refresh(self.client, self.db_file, job_id), 0)
+        job = batch_job.list_jobs(self.db_file)[0]
+        self.assertEqual((job.status, job.completed, job.failed, job.imported), ('completed', 0, 2, 1))
+        self.assertEqual(self.query("select count(*) from chat_message"), [(0,)])
+        self.assertEqual(self.query("select count(*) from batch_request where IMPORTED = 0"), [(2,)])
+
+    def test_cancel(self):
+        job_id, items = self.submit(['q1', 'q2'])
+        batch_job.cancel(self.client, self.db_file, job_id)
+        self.assertEqual(batch_job.list_jobs(self.db_file)[0].status, 'cancelled')
+        self.assertEqual(batch_job.list_jobs(self.db_file, pending_only=True), [])
+
+        self.assertEqual(batch_job.refresh(self.client, self.db_file, job_id), 0)
+        self.assertEqual(batch_job.list_jobs(self.db_file)[0].status, 'cancelled')
+        self.assertEqual(self.query("select count(*) from chat_message"), [(0,)])
+        self.assertEqual(self.query("select count(*) from batch_request where BATCH_ID = ? and IMPORTED = 0",
+                                    (job_id,)), [(2,)])
+
+
+class BubblePoolTest(unittest.TestCase):
+    """
+    被淘汰的 ChatWidget 删除后，池中回收的气泡仍然可以用在其他 ChatWidget 中。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def test_new_message_after_widget_deleted(self):
+        pool = BubblePool()
+        old = ChatWidget(pool=pool)
+        for i in range(3):
+            old.add_message_item(old.new_message(f'old {i}', ':ui/icon.png', MessageType.Markdown, False))
+        old.clear_message()
+        self.assertEqual(pool.size, 3)
+        old.deleteLater()
+        QCoreApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+
+        new = ChatWidget(pool=pool)
+        bubble = new.new_message('new', ':ui/icon.png', MessageType.Markdown, False)
+        new.add_message_item(bubble)
+        bubble.append_text(' text')
+        self.assertIs(bubble.parentWidget(), new.scrollAreaWidgetContents)
+        self.assertEqual(bubble.message.text(), 'new text')
+        self.assertEqual(pool.size, 2)
+        new.deleteLater()
+        QCoreApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+
 
 if __name__ == "__main__":
-    random.randint(0, 1)
-    pass
+    unittest.main()
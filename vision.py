@@ -0,0 +1,220 @@
+"""
+图片附件(视觉模型输入)。
+
+附件在进程池中(image_worker)缩放并重新压缩为 JPEG：先缩到 MAX_SIDE 以内，再把短边缩到 SHORT_SIDE(高精度模式下
+服务商会再缩放到这个尺寸，更大的图片只增加上传量)。处理结果按 SHA-256 存入数据库旁边的 blob 目录，
+message_attachment 表记录它属于哪条消息。发送时使用的 base64 data URL 按哈希缓存，
+历史中的图片每一轮请求都原样复用，不再重新读取和编码。
+"""
+import base64
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+
+from loguru import logger
+
+import image_worker
+from tsid import TSID
+
+MESSAGE_ATTACHMENT_SQL = """
+create table if not exists message_attachment (
+    ID INTEGER PRIMARY KEY NOT NULL,
+    CID TEXT NOT NULL,
+    MID TEXT NOT NULL,
+    HASH TEXT NOT NULL,
+    WIDTH INTEGER NOT NULL,
+    HEIGHT INTEGER NOT NULL,
+    CREATETIME DATETIME NOT NULL
+)
+"""
+
+MESSAGE_ATTACHMENT_INDEX_SQL = """
+create index if not exists idx_message_attachment_cid on message_attachment(CID)
+"""
+
+# base64 缓存的总字符数上限
+ENCODING_CACHE_CHARS = 64 * 1024 * 1024
+IMAGE_FILTER = "图片 (*.png *.jpg *.jpeg *.webp *.gif *.bmp)"
+
+
+class Attachment(NamedTuple):
+    hash: str
+    width: int
+    height: int
+
+
+def blob_dir(db_file):
+    return os.path.join(os.path.dirname(db_file), 'chatgpt_local_blobs')
+
+
+def blob_path(db_file, hash_):
+    return os.path.join(blob_dir(db_file), hash_[0:2], f'{hash_}.jpg')
+
+
+def store_blob(db_file, data):
+    hash_ = hashlib.sha256(data).hexdigest()
+    path = blob_path(db_file, hash_)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return hash_
+
+
+class EncodingCache:
+    """
+    哈希 -> data URL 的 LRU，按总字符数限制大小。
+    """
+
+    def __init__(self, max_chars=ENCODING_CACHE_CHARS):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def data_url(self, db_file, hash_):
+        with self.lock:
+            value = self.items.get(hash_)
+            if value is not None:
+                self.items.move_to_end(hash_)
+                return value
+        with open(blob_path(db_file, hash_), 'rb') as f:
+            value = 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode('ascii')
+        with self.lock:
+            if hash_ not in self.items:
+                self.items[hash_] = value
+                self.chars += len(value)
+                while self.chars > self.max_chars and len(self.items) > 1:
+                    _, old = self.items.popitem(last=False)
+                    self.chars -= len(old)
+        return value
+
+
+encodings = EncodingCache()
+
+
+class Preprocessor:
+    """
+    进程池在第一次使用时创建；同一个源文件(路径、修改时间、大小不变)只处理一次。
+    """
+
+    def __init__(self, db_file, max_workers=None):
+        self.db_file = db_file
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.executor = None
+        self.lock = threading.Lock()
+        # (路径, 修改时间, 大小) -> Attachment
+        self.done = {}
+
+    def submit(self, path):
+        """
+        返回 (源文件键, Future)，Future 的结果为 (数据, 宽, 高)；已处理过的文件直接返回它的 Attachment。
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            attachment = self.done.get(key)
+            if attachment is not None and os.path.exists(blob_path(self.db_file, attachment.hash)):
+                return attachment
+            if self.executor is None:
+                # 不 fork 带有 Qt 线程的进程
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return key, self.executor.submit(image_worker.prepare_image, path)
+
+    def result(self, path, pending):
+        """
+        等待处理结果并写入 blob 目录，返回 Attachment；pending 已经是 Attachment 时原样返回。
+        """
+        if isinstance(pending, Attachment):
+            return pending
+        key, future = pending
+        data, width, height = future.result()
+        attachment = Attachment(store_blob(self.db_file, data), width, height)
+        with self.lock:
+            self.done[key] = attachment
+        logger.info(f'image {os.path.basename(path)}: {os.path.getsize(path)} -> {len(data)} bytes, '
+                    f'{width}x{height}')
+        return attachment
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def init_tables(conn):
+    conn.execute(MESSAGE_ATTACHMENT_SQL)
+    conn.execute(MESSAGE_ATTACHMENT_INDEX_SQL)
+
+
+def insert_attachments(db_file, cid, mid, attachments):
+    conn = sqlite3.connect(db_file)
+    try:
+        with conn:
+            conn.executemany("""
+            insert into message_attachment(ID, CID, MID, HASH, WIDTH, HEIGHT, CREATETIME) values (?,?,?,?,?,?,?)
+            """, [(TSID.create().number, cid, mid, a.hash, a.width, a.height, datetime.now()) for a in attachments])
+    finally:
+        conn.close()
+
+
+def fetch_attachments(cursor, cid):
+    """
+    返回 MID -> [Attachment, ...]。
+    """
+    cursor.execute("select MID, HASH, WIDTH, HEIGHT from message_attachment where CID = ? order by ID asc", (cid,))
+    result = {}
+    for mid, hash_, width, height in cursor.fetchall():
+        result.setdefault(mid, []).append(Attachment(hash_, width, height))
+    return result
+
+
+def user_content(db_file, text, attachments):
+    """
+    有附件时按视觉模型的格式组装消息内容。
+    """
+    if not attachments:
+        return text
+    content = [{"type": "text", "text": text}] if text else []
+    for attachment in attachments:
+        content.append({"type": "image_url",
+                        "image_url": {"url": encodings.data_url(db_file, attachment.hash), "detail": "high"}})
+    return content
+
+
+def purge_orphans(db_file):
+    """
+    删除已删除对话的附件记录，以及不再被引用的 blob 文件。返回删除的文件数。
+    刚处理完、还没随消息发送的图片也没有被引用，只删除一天前写入的文件。
+    """
+    cutoff = time.time() - 24 * 3600
+    conn = sqlite3.connect(db_file)
+    try:
+        init_tables(conn)
+        with conn:
+            conn.execute("delete from message_attachment where CID not in (select CID from chat_message)")
+        used = {row[0] for row in conn.execute("select distinct HASH from message_attachment")}
+    finally:
+        conn.close()
+    removed = 0
+    root = blob_dir(db_file)
+    if not os.path.isdir(root):
+        return removed
+    for dir_path, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(dir_path, name)
+            if name.endswith('.jpg') and name[:-4] not in used and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    if removed > 0:
+        logger.info(f'removed {removed} unused image blobs')
+    return removed